@@ -0,0 +1,284 @@
+# benchmarks of loading, smoothing, measurements and rendering on synthetic
+# spectra. Each case is timed over several repeats (fresh data for every
+# repeat, so that caches do not hide the work) and its peak memory is traced
+# in one more run. Results are written as JSON; compared with an earlier
+# run, cases slower or larger than the thresholds are flagged and the exit
+# code is 1.
+#
+#   python benchmarks/bench.py -o baseline.json
+#   python benchmarks/bench.py --compare baseline.json -o results.json
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xtrimpy.WaveSpec import wavespec, sloader
+from xtrimpy import utils, continuum, session
+import synthetic
+
+# redshift of the synthetic spectra and the measurement windows around
+# H-alpha and [NII] at that redshift
+REDSHIFT = 0.1
+WINDOW = [7190., 7260.]
+
+
+def parser_init():
+    parser = argparse.ArgumentParser(description="xtrimpy benchmarks on synthetic spectra")
+    parser.add_argument('--npix', type=int, nargs='+', default=[4000, 100000], \
+                        help='Spectrum lengths (default: 4000 100000)')
+    parser.add_argument('--nspec', type=int, default=4, help='Spectra loaded and rendered at once (default: 4)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed repeats per case (default: 5)')
+    parser.add_argument('--formats', nargs='+', default=list(synthetic.FORMATS), \
+                        help='Loader formats (default: all)')
+    parser.add_argument('--nreal', type=int, default=200, help='Monte Carlo realizations (default: 200)')
+    parser.add_argument('--only', default=None, help='Only run cases whose name contains this')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the peak memory runs')
+    parser.add_argument('--workdir', default=None, help='Directory for the synthetic files (default: temporary)')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, \
+                        help='Flag cases slower than this ratio (default: 1.25)')
+    parser.add_argument('--memory-threshold', type=float, default=1.25, \
+                        help='Flag cases with a peak memory above this ratio (default: 1.25)')
+    parser.add_argument('--min-time', type=float, default=0.002, \
+                        help='Ignore slowdowns of less than this many seconds (default: 0.002)')
+    parser.add_argument('--min-memory', type=float, default=1., \
+                        help='Ignore memory increases of less than this many MB (default: 1)')
+
+    return parser
+
+
+def in_memory(wave, flux, error):
+    # spectrum object of arrays
+    ws = wavespec.wavespec_obj('synthetic', source=lambda: (wave, flux, error))
+    ws.wave
+
+    return ws
+
+
+def _load(fns, loader):
+    return [wavespec.wavespec_obj(fn, loader=loader) for fn in fns]
+
+
+def _smooth(ws, width):
+    ws.smooth(width)
+
+
+def _continuum(ws, waves):
+    continuum.continuum(ws, waves, REDSHIFT)
+
+
+def _autoscale(sess):
+    sess.autoscale()
+
+
+def render_view(sess, renderer='matplotlib'):
+    # the attributes XtrimGUI.plotspec() uses, with an Agg canvas; None if
+    # the GUI module cannot be imported
+    from types import SimpleNamespace
+    try:
+        from xtrimpy.xtrimpy import XtrimGUI
+        from xtrimpy import render
+    except ImportError:
+        return None
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=(10, 4.5))
+    canvas = FigureCanvasAgg(figure)
+    view = SimpleNamespace(session=sess, specs=sess.specs, plotting=sess.plotting, linelist=sess.linelist, \
+                           masks=sess.masks, gauss_wave=None, gauss_model=None, \
+                           lldefaults={"ls": '--', "color": 'lightblue'}, \
+                           ax=figure.add_subplot(111), canvas=canvas, figure=figure, \
+                           renderer=render.renderer(renderer))
+    view.plotspec = lambda: XtrimGUI.plotspec(view)
+
+    return view
+
+
+def _render(view):
+    view.plotspec()
+
+
+def cases(workdir, npix, nspec, formats, nreal):
+    # (name, setup, run) of the cases for one spectrum length; run(*setup())
+    # is timed
+    suffix = ' n={0:d}'.format(npix)
+    arrays = synthetic.make_spectrum(npix, redshift=REDSHIFT)
+    level = float(np.nanmedian(arrays[1][(arrays[0] > WINDOW[0] - 50) & (arrays[0] < WINDOW[0])]))
+    cp = [WINDOW[0], level, WINDOW[1], level]
+    waves = utils.read_line_list(session.LINELIST)[0]
+
+    def fresh():
+        return (in_memory(*arrays),)
+
+    def fresh_session():
+        sess = session.session(record=False)
+        for i in range(nspec):
+            ws = in_memory(*synthetic.make_spectrum(npix, redshift=REDSHIFT, seed=i))
+            ws.add = i * 2.
+            sess.specs.append(ws)
+        sess.reset_view()
+        return (sess,)
+
+    def fresh_view(renderer='matplotlib'):
+        view = render_view(fresh_session()[0], renderer)
+        return (view,)
+
+    out = []
+    for fmt in formats:
+        fns = synthetic.write_spectra(os.path.join(workdir, fmt), fmt, npix, nspec=nspec, redshift=REDSHIFT)
+        loader = getattr(sloader, fmt)
+        out.append(('load/' + fmt + suffix, lambda fns=fns, loader=loader: (fns, loader), _load))
+
+    for width in (3, 15):
+        out.append(('smooth/box{0:d}'.format(width) + suffix, lambda width=width: fresh() + (width,), _smooth))
+
+    out += [
+        ('measure/calc_ew' + suffix, lambda: fresh() + (cp,), utils.calc_ew),
+        ('measure/calc_ew_mc' + suffix, lambda: fresh() + (cp, nreal), utils.calc_ew_mc),
+        ('measure/continuum' + suffix, lambda: fresh() + (waves,), _continuum),
+        ('measure/fit_gauss' + suffix, lambda: fresh() + (WINDOW,), utils.fit_gauss),
+        ('measure/fit_gauss_mc' + suffix, lambda: fresh() + (WINDOW, nreal), utils.fit_gauss_mc),
+        ('measure/fit_lines' + suffix, lambda: fresh() + (WINDOW, waves, REDSHIFT), utils.fit_lines),
+        ('view/autoscale' + suffix, fresh_session, _autoscale)
+    ]
+    if render_view(session.session(record=False)) is not None:
+        out.append(('render/plotspec' + suffix, fresh_view, _render))
+        out.append(('render/raster' + suffix, lambda: fresh_view('raster'), _render))
+    else:
+        print("render/plotspec skipped: the GUI module cannot be imported", file=sys.stderr)
+
+    return out
+
+
+def measure(setup, run, repeat, memory=True):
+    # best and median time of repeat runs, and the peak memory traced in
+    # one more run (setup excluded)
+    times = []
+    for i in range(repeat):
+        args = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            t0 = time.perf_counter()
+            run(*args)
+            times.append(time.perf_counter() - t0)
+        finally:
+            gc.enable()
+        del args
+
+    result = {"min": min(times), "median": float(np.median(times)), "repeat": repeat, "peak_mb": None}
+    if memory:
+        args = setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run(*args)
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def compare(results, baseline, threshold=1.25, memory_threshold=1.25, min_time=0.002, min_memory=1.):
+    # {name: (time ratio, memory ratio, flags)} of the cases in both runs
+    rows = {}
+    for name, new in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        flags = []
+        ratio = new['min'] / old['min'] if old['min'] > 0 else np.inf
+        if ratio > threshold and new['min'] - old['min'] > min_time:
+            flags.append('SLOWER')
+        mratio = None
+        if new.get('peak_mb') is not None and old.get('peak_mb'):
+            mratio = new['peak_mb'] / old['peak_mb']
+            if mratio > memory_threshold and new['peak_mb'] - old['peak_mb'] > min_memory:
+                flags.append('MEMORY')
+        rows[name] = (ratio, mratio, flags)
+
+    return rows
+
+
+def metadata(args):
+    import scipy
+    import astropy
+
+    return {
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "astropy": astropy.__version__,
+        "npix": args.npix,
+        "nspec": args.nspec,
+        "repeat": args.repeat,
+        "nreal": args.nreal
+    }
+
+
+def main(argv=None):
+    args = parser_init().parse_args(argv)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='xtrimpy-bench-')
+    results = {}
+    try:
+        for npix in args.npix:
+            for name, setup, run in cases(workdir, npix, args.nspec, args.formats, args.nreal):
+                if args.only is not None and args.only not in name:
+                    continue
+                results[name] = measure(setup, run, args.repeat, memory=not args.no_memory)
+                r = results[name]
+                line = '{0:36s} {1:10.2f} ms {2:10.2f} ms'.format(name, 1e3 * r['min'], 1e3 * r['median'])
+                if r['peak_mb'] is not None:
+                    line += ' {0:9.1f} MB'.format(r['peak_mb'])
+                if baseline is not None and name in baseline:
+                    ratio, mratio, flags = compare({name: r}, baseline, args.threshold, args.memory_threshold, \
+                                                   args.min_time, args.min_memory)[name]
+                    line += '  x{0:.2f}'.format(ratio)
+                    if mratio is not None:
+                        line += ' mem x{0:.2f}'.format(mratio)
+                    line += ''.join('  ' + flag for flag in flags)
+                print(line, flush=True)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({"meta": metadata(args), "results": results}, f, indent=1)
+
+    if baseline is not None:
+        rows = compare(results, baseline, args.threshold, args.memory_threshold, args.min_time, args.min_memory)
+        regressions = [name for name, row in rows.items() if len(row[2]) > 0]
+        missing = [name for name in baseline if name not in results and \
+                   (args.only is None or args.only in name)]
+        print('{0:d} cases compared, {1:d} regressions'.format(len(rows), len(regressions)))
+        if len(missing) > 0:
+            print('Not run: ' + ', '.join(missing))
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# startup benchmark of the GUI. Every repeat starts a fresh interpreter that
+# imports xtrimpy and opens the window, and reports the times since the
+# process was started:
+#   import          xtrimpy.xtrimpy imported
+#   first_frame     the window has been drawn
+#   interactive     the spectra are loaded and drawn, and events are handled
+# Results are written and compared like those of bench.py.
+#
+#   python benchmarks/startup.py -o startup.json
+#   python benchmarks/startup.py --npix 100000 --nspec 4 --compare startup.json
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def parser_init():
+    parser = argparse.ArgumentParser(description="xtrimpy startup benchmark")
+    parser.add_argument('--nspec', type=int, nargs='+', default=[0, 1], \
+                        help='Spectra on the command line (default: 0 1)')
+    parser.add_argument('--npix', type=int, default=4000, help='Spectrum length (default: 4000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed repeats per case (default: 5)')
+    parser.add_argument('--offscreen', action='store_true', help='Use the offscreen Qt platform')
+    parser.add_argument('--timeout', type=float, default=120., help='Seconds before a start is abandoned')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, \
+                        help='Flag cases slower than this ratio (default: 1.25)')
+    parser.add_argument('--min-time', type=float, default=0.02, \
+                        help='Ignore slowdowns of less than this many seconds (default: 0.02)')
+    parser.add_argument('--child', nargs='+', default=None, help=argparse.SUPPRESS)
+
+    return parser
+
+
+def child(t0, filenames):
+    # run in the started interpreter; prints the times as JSON
+    times = {}
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtCore import QObject, QEvent, QTimer
+    app = QApplication(sys.argv[:1])
+    from xtrimpy.xtrimpy import XtrimGUI
+    times['import'] = time.time() - t0
+
+    startup = XtrimGUI.startup
+
+    def timed_startup(self):
+        if self.started:
+            return
+        startup(self)
+        # handle the events the loading left, e.g. the repaint
+        app.processEvents()
+        times.setdefault('first_frame', time.time() - t0)
+        times['interactive'] = time.time() - t0
+        app.quit()
+
+    XtrimGUI.startup = timed_startup
+
+    class first_frame(QObject):
+        def eventFilter(self, obj, event):
+            if obj is gui and event.type() == QEvent.Paint and 'first_frame' not in times:
+                # after the paint event has been handled
+                QTimer.singleShot(0, lambda: times.setdefault('first_frame', time.time() - t0))
+            return False
+
+    gui = XtrimGUI(filenames)
+    watcher = first_frame()
+    gui.installEventFilter(watcher)
+    app.exec_()
+
+    # without a journal to remove at the next start
+    gui.session.close()
+    print(json.dumps(times))
+
+    return
+
+
+def start(filenames, offscreen=False, timeout=120., home=None):
+    # times of one start in a new interpreter
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    if offscreen:
+        env['QT_QPA_PLATFORM'] = 'offscreen'
+    if home is not None:
+        # no orphaned sessions to offer for recovery
+        env['HOME'] = home
+    t0 = time.time()
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', repr(t0)] + filenames, \
+                         env=env, capture_output=True, text=True, timeout=timeout)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.strip())
+
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    args = parser_init().parse_args(argv)
+    if args.child is not None:
+        child(float(args.child[0]), args.child[1:])
+        return 0
+
+    import synthetic
+    from bench import compare
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    workdir = tempfile.mkdtemp(prefix='xtrimpy-startup-')
+    results = {}
+    try:
+        for nspec in args.nspec:
+            fns = synthetic.write_spectra(os.path.join(workdir, 'spectra'), 'default', args.npix, nspec=nspec)
+            runs = [start(fns, args.offscreen, args.timeout, home=workdir) for i in range(args.repeat)]
+            for key in ('import', 'first_frame', 'interactive'):
+                name = 'startup/{0} n={1:d}'.format(key, nspec)
+                times = [run[key] for run in runs]
+                results[name] = {"min": min(times), "median": float(np.median(times)), \
+                                 "repeat": args.repeat, "peak_mb": None}
+                line = '{0:36s} {1:10.2f} ms {2:10.2f} ms'.format(name, 1e3 * min(times), 1e3 * np.median(times))
+                if baseline is not None and name in baseline:
+                    ratio, mratio, flags = compare({name: results[name]}, baseline, args.threshold, \
+                                                   min_time=args.min_time)[name]
+                    line += '  x{0:.2f}'.format(ratio) + ''.join('  ' + flag for flag in flags)
+                print(line, flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output is not None:
+        meta = {"time": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(), \
+                "platform": platform.platform(), "nspec": args.nspec, "npix": args.npix, \
+                "repeat": args.repeat, "offscreen": args.offscreen}
+        with open(args.output, 'w') as f:
+            json.dump({"meta": meta, "results": results}, f, indent=1)
+
+    if baseline is not None:
+        rows = compare(results, baseline, args.threshold, min_time=args.min_time)
+        regressions = [name for name, row in rows.items() if len(row[2]) > 0]
+        print('{0:d} cases compared, {1:d} regressions'.format(len(rows), len(regressions)))
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# synthetic spectra for the benchmarks: a power-law continuum with Gaussian
+# emission lines from the line list, Gaussian noise and NaN gaps, written in
+# the file format of each loader in WaveSpec.sloader
+import os
+import numpy as np
+
+from xtrimpy.utils import read_line_list, C_KMS
+from xtrimpy.session import LINELIST
+
+
+def make_spectrum(npix, wmin=3500., wmax=9500., log=False, redshift=0.1, nlines=None, \
+                  sigma_kms=150., snr=20., ngaps=3, gap=0.002, seed=0):
+    # wavelength, flux and error arrays. The wavelength grid is linear or
+    # log-linear (log=True); nlines lines of the line list (all by default)
+    # are added at the redshift; ngaps runs of NaN cover a fraction gap of
+    # the pixels each.
+    rng = np.random.default_rng(seed)
+    if log:
+        wave = np.logspace(np.log10(wmin), np.log10(wmax), npix)
+    else:
+        wave = np.linspace(wmin, wmax, npix)
+
+    flux = (wave / 5000.) ** -1.5
+    lines = np.array(read_line_list(LINELIST)[0]) * (1 + redshift)
+    lines = lines[(lines > wmin) & (lines < wmax)]
+    if nlines is not None:
+        lines = lines[:nlines]
+    amps = 2 + 18 * rng.random(len(lines))
+    for center, amp in zip(lines, amps):
+        sigma = center * sigma_kms / C_KMS
+        near = np.abs(wave - center) < 8 * sigma
+        flux[near] += amp * np.exp(-0.5 * ((wave[near] - center) / sigma)**2)
+
+    error = np.full(npix, np.median(flux) / snr)
+    flux = flux + error * rng.standard_normal(npix)
+
+    width = max(int(gap * npix), 1)
+    for start in rng.integers(0, max(npix - width, 1), ngaps):
+        flux[start:start + width] = np.nan
+        error[start:start + width] = np.nan
+
+    return wave, flux, error
+
+
+def _fits_table(fn, columns):
+    from astropy.io import fits
+
+    cols = [fits.Column(name=name, format='D', array=arr) for name, arr in columns]
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns(cols)]).writeto(fn, overwrite=True)
+
+    return
+
+
+def write_default(fn, wave, flux, error):
+    # image with a linear wavelength header; no error
+    from astropy.io import fits
+
+    hdu = fits.PrimaryHDU(flux)
+    hdu.header['CTYPE1'] = 'WAVE'
+    hdu.header['CRVAL1'] = wave[0]
+    hdu.header['CDELT1'] = (wave[-1] - wave[0]) / (len(wave) - 1)
+    hdu.header['CRPIX1'] = 1
+    hdu.writeto(fn, overwrite=True)
+
+    return
+
+
+def write_HIRES(fn, wave, flux, error):
+    # image with a log10 wavelength header; no error
+    from astropy.io import fits
+
+    hdu = fits.PrimaryHDU(flux)
+    hdu.header['CRVAL1'] = np.log10(wave[0])
+    hdu.header['CDELT1'] = (np.log10(wave[-1]) - np.log10(wave[0])) / (len(wave) - 1)
+    hdu.header['CRPIX1'] = 1
+    hdu.writeto(fn, overwrite=True)
+
+    return
+
+
+def write_DJA_NIRSpec(fn, wave, flux, error):
+    _fits_table(fn, [('WAVELENGTH', wave), ('FLUX', flux), ('FLUX_ERR', error)])
+
+    return
+
+
+def write_AURORA(fn, wave, flux, error):
+    _fits_table(fn, [('lambda', wave), ('flux', flux), ('err', error)])
+
+    return
+
+
+def write_ESO_UVES(fn, wave, flux, error):
+    # one row with array columns
+    from astropy.io import fits
+
+    fmt = '{0:d}D'.format(len(wave))
+    cols = [fits.Column(name=name, format=fmt, array=arr[None, :]) for name, arr in \
+            [('WAVE', wave), ('FLUX_REDUCED', flux), ('ERR_REDUCED', error)]]
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns(cols)]).writeto(fn, overwrite=True)
+
+    return
+
+
+def write_SpitzerIRS(fn, wave, flux, error):
+    # IPAC table
+    from astropy.table import Table
+
+    Table([wave, flux, error], names=['wavelength', 'flux_density', 'error']).write( \
+        fn, format='ascii.ipac', overwrite=True)
+
+    return
+
+
+# loader name: (writer, file extension, log-linear wavelengths). BPASSv23
+# asks for a column in a dialog and is not covered.
+FORMATS = {
+    "default": (write_default, '.fits', False),
+    "HIRES": (write_HIRES, '.fits', True),
+    "DJA_NIRSpec": (write_DJA_NIRSpec, '.fits', False),
+    "AURORA": (write_AURORA, '.fits', False),
+    "ESO_UVES": (write_ESO_UVES, '.fits', False),
+    "SpitzerIRS": (write_SpitzerIRS, '.tbl', False)
+}
+
+
+def write_spectra(directory, fmt, npix, nspec=1, seed=0, **kwargs):
+    # write nspec synthetic spectra in the format of a loader; returns the
+    # file names
+    writer, ext, log = FORMATS[fmt]
+    os.makedirs(directory, exist_ok=True)
+    fns = []
+    for i in range(nspec):
+        fn = os.path.join(directory, '{0}_{1:d}_{2:d}{3}'.format(fmt, npix, i, ext))
+        writer(fn, *make_spectrum(npix, log=log, seed=seed + i, **kwargs))
+        fns.append(fn)
+
+    return fns
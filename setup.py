@@ -20,7 +20,7 @@ DESCRIPTION = metadata["description"]
 
 entry_points = {
     'console_scripts': [
-        "xtrimpy = xtrimpy.xtrimpy:main"
+        "xtrimpy = xtrimpy.cli:main"
     ]}
 
 setuptools.setup(name=NAME,
@@ -0,0 +1,44 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', 'redshift0.fits')
+
+
+@pytest.fixture
+def gui(tmp_path, monkeypatch):
+    pytest.importorskip('PyQt5')
+    from PyQt5.QtWidgets import QApplication
+    # journals go to a fresh home, without sessions to recover
+    monkeypatch.setenv('HOME', str(tmp_path))
+    app = QApplication.instance() or QApplication([])
+    from xtrimpy.xtrimpy import XtrimGUI
+
+    g = XtrimGUI([EXAMPLE])
+    while not g.started:
+        app.processEvents()
+    yield g
+    g.close()
+
+
+def press(g, key, x, y):
+    g.last_x, g.last_y = x, y
+    g.keyPressEvent(SimpleNamespace(key=key))
+
+
+def test_undo_zoom_box(gui):
+    box = list(gui.plotting['box'])
+    press(gui, 'a', 5000., 0.1)
+    press(gui, 'a', 6000., 0.5)
+    assert gui.plotting['box'] == [5000., 0.1, 6000., 0.5]
+
+    # one step back to the complete box before the first press
+    gui.undo()
+    assert gui.plotting['box'] == box
+    gui.plotspec()
+    gui.redo()
+    assert gui.plotting['box'] == [5000., 0.1, 6000., 0.5]
+    gui.plotspec()
@@ -0,0 +1,28 @@
+import numpy as np
+
+from xtrimpy import redshift
+from xtrimpy.WaveSpec import wavespec
+
+
+def spectrum(wave, flux, error):
+    return wavespec.wavespec_obj('test.fits', source=lambda: (wave, flux, error))
+
+
+def test_chi2_batch_without_good_pixels():
+    wave = np.linspace(4000., 7000., 3001)
+    twave = np.linspace(3000., 8000., 5001)
+    tflux = 1. + np.exp(-0.5 * ((twave - 5000.) / 5.)**2)
+    flux = 1. + np.exp(-0.5 * ((wave - 5500.) / 5.5)**2)
+    error = np.full(len(wave), 0.1)
+    zgrid = np.linspace(0., 0.2, 201)
+
+    specs = [spectrum(wave, flux, error), spectrum(wave, np.full(len(wave), np.nan), error), \
+             spectrum(wave, flux, np.zeros(len(wave)))]
+    chi2, amp, npix = redshift.chi2_redshift_batch(specs, twave, tflux, zgrid, nproc=1)
+
+    assert chi2.shape == (3, len(zgrid))
+    assert abs(zgrid[np.argmin(chi2[0])] - 0.1) < 2e-3
+    for i in (1, 2):
+        assert np.all(npix[i] == 0)
+        assert np.all(amp[i] == 0)
+        assert np.all(chi2[i] == 0)
@@ -0,0 +1,218 @@
+# IFU data cubes. The cube is memory-mapped: collapsed images are summed over
+# chunks of wavelength planes, and a narrow-band image is updated by adding
+# and subtracting only the planes that enter or leave the wavelength window.
+# Spectra of spaxels and circular apertures are read on demand, kept in an
+# LRU cache, and can be added to a session as lazily read wavespec objects.
+import os
+import functools
+import collections
+import numpy as np
+
+from . import sloader, wavespec
+from .spec2d import ERROR_EXTNAMES, IVAR_EXTNAMES
+
+# bytes of the planes summed at once for an image
+CHUNK_BYTES = 64 * 2**20
+# extracted spectra kept per cube
+MAXSPECTRA = 64
+
+
+class cube_obj:
+
+    def __init__(self, fn, ext=None, maxspectra=MAXSPECTRA):
+        # ext: image extension, by default the first one with a 3D image
+        from astropy.io import fits
+
+        self.filename = fn
+        # memory-mapped; astropy reads scaled (BZERO/BSCALE) images in full
+        self.hdul = fits.open(fn, memmap=True)
+        if ext is None:
+            ext = next((i for i, hdu in enumerate(self.hdul) if hdu.is_image and hdu.header.get('NAXIS', 0) == 3), None)
+            if ext is None:
+                raise ValueError("{0} has no 3D image.".format(fn))
+        self.ext = ext
+
+        hdu = self.hdul[ext]
+        if hdu.header.get('NAXIS', 0) != 3:
+            raise ValueError("Extension {0} of {1} is not a 3D image.".format(ext, fn))
+        self.header = hdu.header
+        # the wavelength axis defaults to the third one
+        self.axis = sloader._wave_axis(self.header, default=3)
+        self.wave = sloader._header_wave(self.header, self.axis)
+
+        # (wavelength, y, x) views; numpy axes are the FITS axes reversed
+        self.data = self._oriented(hdu.data)
+        self.shape = self.data.shape[1:]
+
+        self.error = None
+        self.ivar = None
+        for hdu in self.hdul:
+            name = hdu.name.upper()
+            if hdu is self.hdul[ext] or not hdu.is_image or hdu.header.get('NAXIS', 0) != 3:
+                continue
+            if name in ERROR_EXTNAMES and self.error is None and self.ivar is None:
+                self.error = self._oriented(hdu.data)
+            elif name in IVAR_EXTNAMES and self.error is None and self.ivar is None:
+                self.ivar = self._oriented(hdu.data)
+
+        self.maxspectra = maxspectra
+        self.spectra = collections.OrderedDict()
+        self.window = None      # (i0, i1, sum, number of finite pixels)
+        self.whitelight = None
+
+        return
+
+    def _oriented(self, data):
+        return np.moveaxis(data, 3 - self.axis, 0)
+
+    def close(self):
+        self.hdul.close()
+
+        return
+
+    # -- images
+
+    def _chunk(self):
+        # planes per chunk
+        return max(CHUNK_BYTES // (8 * self.shape[0] * self.shape[1]), 1)
+
+    def _sum(self, i0, i1):
+        # (sum, number of finite pixels) of the planes i0 <= i < i1
+        total = np.zeros(self.shape)
+        count = np.zeros(self.shape, dtype=int)
+        chunk = self._chunk()
+        for i in range(i0, i1, chunk):
+            planes = np.asarray(self.data[i:min(i + chunk, i1)], dtype=float)
+            good = np.isfinite(planes)
+            total += np.sum(np.where(good, planes, 0.), axis=0)
+            count += np.sum(good, axis=0)
+
+        return total, count
+
+    def _mean(self, total, count):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, total / count, np.nan)
+
+    def indices(self, w0, w1):
+        # (i0, i1) of the planes with w0 <= wave <= w1
+        inside = np.flatnonzero((self.wave >= min(w0, w1)) & (self.wave <= max(w0, w1)))
+        if len(inside) == 0:
+            return 0, 0
+
+        return inside[0], inside[-1] + 1
+
+    def white_light(self):
+        # mean over all wavelengths
+        if self.whitelight is None:
+            self.whitelight = self._mean(*self._sum(0, len(self.wave)))
+
+        return self.whitelight
+
+    def narrow_band(self, w0, w1):
+        # mean over the wavelength window [w0, w1]; the sums of the last
+        # window are updated if that reads fewer planes
+        i0, i1 = self.indices(w0, w1)
+        if self.window is not None:
+            j0, j1, total, count = self.window
+            nupdate = abs(i0 - j0) + abs(i1 - j1)
+            if max(i0, j0) < min(i1, j1) and nupdate < i1 - i0:
+                for a, b, sign in ((i0, j0, 1), (j0, i0, -1), (j1, i1, 1), (i1, j1, -1)):
+                    # planes entering (sign 1) or leaving (sign -1) the window
+                    if b > a:
+                        dtotal, dcount = self._sum(a, b)
+                        total += sign * dtotal
+                        count += sign * dcount
+                self.window = (i0, i1, total, count)
+                return self._mean(total, count)
+
+        self.window = (i0, i1) + self._sum(i0, i1)
+
+        return self._mean(*self.window[2:])
+
+    # -- spectra
+
+    def spaxels(self, x, y, radius=0.):
+        # (y, x) index arrays of the spaxels within radius of (x, y), at
+        # least the nearest one
+        ny, nx = self.shape
+        r = int(np.ceil(radius))
+        yy, xx = np.mgrid[max(int(round(y)) - r, 0):min(int(round(y)) + r + 1, ny), \
+                          max(int(round(x)) - r, 0):min(int(round(x)) + r + 1, nx)]
+        inside = (xx - x)**2 + (yy - y)**2 <= radius**2
+        if not np.any(inside):
+            inside = (xx == int(round(x))) & (yy == int(round(y)))
+        if not np.any(inside):
+            raise ValueError("({0:.1f}, {1:.1f}) is outside of the cube.".format(x, y))
+
+        return yy[inside], xx[inside]
+
+    def extract(self, x, y, radius=0.):
+        # (wave, flux, error or None) summed over the spaxels within radius
+        # of (x, y); the last maxspectra are cached
+        key = (round(float(x), 2), round(float(y), 2), round(float(radius), 2))
+        if key in self.spectra:
+            self.spectra.move_to_end(key)
+            return self.spectra[key]
+
+        self.spectra[key] = self._extract(*key)
+        if len(self.spectra) > self.maxspectra:
+            self.spectra.popitem(last=False)
+
+        return self.spectra[key]
+
+    def _extract(self, x, y, radius):
+        iy, ix = self.spaxels(x, y, radius)
+        # the bounding box is read, then the spaxels are selected
+        box = (slice(None), slice(iy.min(), iy.max() + 1), slice(ix.min(), ix.max() + 1))
+        data = np.asarray(self.data[box], dtype=float)[:, iy - iy.min(), ix - ix.min()]
+        var = None
+        if self.error is not None:
+            var = np.asarray(self.error[box], dtype=float)[:, iy - iy.min(), ix - ix.min()]**2
+        elif self.ivar is not None:
+            with np.errstate(divide='ignore'):
+                var = 1 / np.asarray(self.ivar[box], dtype=float)[:, iy - iy.min(), ix - ix.min()]
+
+        good = np.isfinite(data)
+        if var is not None:
+            good &= np.isfinite(var) & (var > 0)
+        ngood = np.sum(good, axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # sums scaled up for the missing spaxels of a plane
+            scale = len(iy) / ngood
+            flux = np.sum(np.where(good, data, 0.), axis=1) * scale
+            error = None if var is None else np.sqrt(np.sum(np.where(good, var, 0.), axis=1)) * scale
+        flux[ngood == 0] = np.nan
+        if error is not None:
+            error[ngood == 0] = np.nan
+
+        return self.wave, flux, error
+
+    def wavespec(self, x, y, radius=0.):
+        # extracted spectrum as a wavespec object, read on first use
+        x, y, radius = round(float(x), 2), round(float(y), 2), round(float(radius), 2)
+        ws = wavespec.wavespec_obj(self.filename, loader=sloader.cube_integrated, \
+                                   source=lambda: self.extract(x, y, radius))
+        ws.label = '{0} ({1:.1f}, {2:.1f})'.format(os.path.basename(self.filename), x, y)
+        if radius > 0:
+            ws.label += ' r={0:g}'.format(radius)
+        ws.extraction = {"ext": self.ext, "spaxel": [x, y], "radius": radius}
+
+        return ws
+
+
+@functools.lru_cache(maxsize=4)
+def open_cube(fn, ext=None):
+    # shared per file, so that extracted spectra and images are cached
+    return cube_obj(fn, ext)
+
+
+def extract_file(fn, ext=None, spaxel=None, radius=0.):
+    # (wave, flux, error) of a spaxel or aperture of a cube file, the sum of
+    # all spaxels by default
+    c = open_cube(fn, ext)
+    if spaxel is None:
+        ny, nx = c.shape
+        return c.extract(0.5 * (nx - 1), 0.5 * (ny - 1), np.hypot(nx, ny))
+
+    return c.extract(spaxel[0], spaxel[1], radius)
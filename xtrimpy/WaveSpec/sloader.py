@@ -1,17 +1,10 @@
 import numpy as np
-from astropy.io import fits
 
 
-def default(fn):
-
-    hdu = fits.open(fn)[0]
-    header = hdu.header
-
-    spec = hdu.data
-
-    #Select the appropriate axis.
+def _wave_axis(header, default=1):
+    # FITS axis of the wavelengths: the first one with a wavelength or
+    # velocity type, otherwise default
     naxis = header['NAXIS']
-    flag = False
     for i in range(naxis):
         #Keyword entry
         card = "CTYPE{0}".format(i+1)
@@ -20,14 +13,13 @@ def default(fn):
         
         #Possible wave types.
         if header[card] in ['AWAV', 'WAVE', 'VELO', 'Wavelength', 'WAVE-TAB']:
-            axis = i+1
-            flag = True
-            break
+            return i+1
 
     #No wavelength axis
-    if flag == False:
-        axis = 1
+    return default
 
+def _header_wave(header, axis):
+    # wavelengths of a FITS axis from its linear WCS keywords
     try:
         #Get keywords defining wavelength axis
         nwav = header["NAXIS{0}".format(axis)]
@@ -41,13 +33,47 @@ def default(fn):
         pix0 = header["CRPIX{0}".format(axis)]
 
         #Calculate and return
-        wave = np.array([wav0 + (i - pix0 + 1) * dwav for i in range(nwav)])
+        wave = wav0 + (np.arange(nwav) - pix0 + 1) * dwav
 
     except:
         raise ValueError("Header must contain a wavelength/velocity axis.")
 
+    return wave
+
+def default(fn):
+    from astropy.io import fits
+
+    hdu = fits.open(fn)[0]
+    header = hdu.header
+
+    spec = hdu.data
+    if spec is not None and spec.ndim > 1:
+        spec = np.squeeze(spec)
+        if spec.ndim > 2:
+            raise ValueError("{0} is a data cube; open it with 'File > Open Data Cube' " \
+                             "or the cube_integrated loader.".format(fn))
+        if spec.ndim > 1:
+            raise ValueError("{0} is a 2D spectrum; open it with 'File > Open 2D Spectrum' " \
+                             "or the spec2d_boxcar loader.".format(fn))
+
+    wave = _header_wave(header, _wave_axis(header))
+
     return wave, spec, None
 
+def spec2d_boxcar(fn):
+    # sum over the full slit of a 2D spectrum
+    from .spec2d import open_spec2d
+
+    s2d = open_spec2d(fn)
+
+    return s2d.extract(0, s2d.nspatial)
+
+def cube_integrated(fn):
+    # sum over all spaxels of a data cube
+    from .cube import extract_file
+
+    return extract_file(fn)
+
 def SpitzerIRS(fn):
     from astropy.io import ascii
 
@@ -57,6 +83,7 @@ def SpitzerIRS(fn):
 
 
 def DJA_NIRSpec(fn):
+    from astropy.io import fits
 
     hdu = fits.open(fn)[1]
     try:
@@ -71,6 +98,8 @@ def DJA_NIRSpec(fn):
     return wave, flux, err
 
 def AURORA(fn):
+    from astropy.io import fits
+
     hdu = fits.open(fn)[1]
     wave = hdu.data['lambda']
     flux = hdu.data['flux']
@@ -79,6 +108,7 @@ def AURORA(fn):
     return wave, flux, err
 
 def ESO_UVES(fn):
+    from astropy.io import fits
 
     hdu = fits.open(fn)[1]
     wave = hdu.data['WAVE'].flatten()
@@ -88,6 +118,8 @@ def ESO_UVES(fn):
     return wave, flux, err
 
 def HIRES(fn):
+    from astropy.io import fits
+
     hdu = fits.open(fn)[0]
     hdr = hdu.header
     spec = hdu.data
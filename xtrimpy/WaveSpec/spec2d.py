@@ -0,0 +1,177 @@
+# 2D rectified spectra. The image is memory-mapped and only the pixels that
+# are needed are read: blocks of rows for a decimated preview, and the rows
+# of an aperture for an extraction. Extractions are cached per aperture and
+# can be added to a session as lazily read wavespec objects.
+import os
+import warnings
+import functools
+import numpy as np
+
+from . import sloader, wavespec
+
+# extensions with the errors (sigma) or the inverse variance of the image
+ERROR_EXTNAMES = ('ERR', 'ERROR', 'SIGMA', 'UNC', 'NOISE')
+IVAR_EXTNAMES = ('IVAR', 'WHT')
+
+METHODS = ('boxcar', 'optimal')
+
+
+class spec2d_obj:
+
+    def __init__(self, fn, ext=None):
+        # ext: image extension, by default the first one with a 2D image
+        from astropy.io import fits
+
+        self.filename = fn
+        # memory-mapped; astropy reads scaled (BZERO/BSCALE) images in full
+        self.hdul = fits.open(fn, memmap=True)
+        if ext is None:
+            ext = next((i for i, hdu in enumerate(self.hdul) if hdu.is_image and hdu.header.get('NAXIS', 0) == 2), None)
+            if ext is None:
+                raise ValueError("{0} has no 2D image.".format(fn))
+        self.ext = ext
+
+        hdu = self.hdul[ext]
+        if hdu.header.get('NAXIS', 0) != 2:
+            raise ValueError("Extension {0} of {1} is not a 2D image.".format(ext, fn))
+        self.header = hdu.header
+        axis = sloader._wave_axis(self.header)
+        self.wave = sloader._header_wave(self.header, axis)
+
+        # (spatial, wavelength) views; numpy axes are the FITS axes reversed
+        self.transposed = axis == 2
+        self.data = self._oriented(hdu.data)
+        self.nspatial = self.data.shape[0]
+
+        self.error = None
+        self.ivar = None
+        for hdu in self.hdul:
+            name = hdu.name.upper()
+            if hdu is self.hdul[ext] or not hdu.is_image or hdu.header.get('NAXIS', 0) != 2:
+                continue
+            if name in ERROR_EXTNAMES and self.error is None and self.ivar is None:
+                self.error = self._oriented(hdu.data)
+            elif name in IVAR_EXTNAMES and self.error is None and self.ivar is None:
+                self.ivar = self._oriented(hdu.data)
+
+        self.extractions = {}
+        self.previews = {}
+
+        return
+
+    def _oriented(self, data):
+        return data.T if self.transposed else data
+
+    def close(self):
+        self.hdul.close()
+
+        return
+
+    def preview(self, nwave=2048, nspatial=256):
+        # (wave, spatial pixel, image) of block means of at most nspatial x
+        # nwave blocks, read in blocks of rows; cached per size
+        key = (nwave, nspatial)
+        if key in self.previews:
+            return self.previews[key]
+
+        ny, nx = self.data.shape
+        fy = int(np.ceil(ny / nspatial))
+        fx = int(np.ceil(nx / nwave))
+        mx = int(np.ceil(nx / fx))
+        image = np.full((int(np.ceil(ny / fy)), mx), np.nan)
+        with warnings.catch_warnings():
+            # blocks without finite pixels stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for j, y0 in enumerate(range(0, ny, fy)):
+                rows = np.asarray(self.data[y0:y0 + fy], dtype=float)
+                pad = np.full((rows.shape[0], mx * fx), np.nan)
+                pad[:, :nx] = rows
+                image[j] = np.nanmean(pad.reshape(rows.shape[0], mx, fx), axis=(0, 2))
+            wave = np.nanmean(np.append(self.wave, np.full(mx * fx - nx, np.nan)).reshape(mx, fx), axis=1)
+        spatial = np.arange(image.shape[0]) * fy + 0.5 * (min(fy, ny) - 1)
+
+        self.previews[key] = (wave, spatial, image)
+
+        return self.previews[key]
+
+    def extract(self, lo, hi, method='boxcar'):
+        # (wave, flux, error or None) of the spatial rows lo <= y < hi,
+        # cached per aperture
+        lo, hi = max(int(lo), 0), min(int(hi), self.nspatial)
+        if hi <= lo:
+            raise ValueError("Empty aperture [{0}, {1}).".format(lo, hi))
+        if method not in METHODS:
+            raise ValueError("Unknown extraction method: {0}".format(method))
+
+        key = (lo, hi, method)
+        if key not in self.extractions:
+            self.extractions[key] = self._extract(lo, hi, method)
+
+        return self.extractions[key]
+
+    def _variance(self, lo, hi):
+        # variance of the rows of an aperture; None without errors
+        if self.error is not None:
+            return np.asarray(self.error[lo:hi], dtype=float)**2
+        if self.ivar is not None:
+            with np.errstate(divide='ignore'):
+                return 1 / np.asarray(self.ivar[lo:hi], dtype=float)
+        return None
+
+    def _extract(self, lo, hi, method):
+        data = np.asarray(self.data[lo:hi], dtype=float)
+        var = self._variance(lo, hi)
+        good = np.isfinite(data)
+        if var is not None:
+            good &= np.isfinite(var) & (var > 0)
+        ngood = np.sum(good, axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if method == 'boxcar':
+                # sums scaled up for the missing pixels of a column
+                scale = (hi - lo) / ngood
+                flux = np.sum(np.where(good, data, 0.), axis=0) * scale
+                error = None if var is None else np.sqrt(np.sum(np.where(good, var, 0.), axis=0)) * scale
+            else:
+                # optimal weights (Horne 1986) with a spatial profile from
+                # the median over wavelength
+                profile = np.nanmedian(np.where(good, data, np.nan), axis=1)
+                profile = np.clip(np.nan_to_num(profile), 0, None)
+                if np.sum(profile) <= 0:
+                    profile = np.ones(hi - lo)
+                profile = (profile / np.sum(profile))[:, None]
+                weight = np.where(good, 1. if var is None else 1 / np.where(good, var, 1.), 0.)
+                norm = np.sum(weight * profile**2, axis=0)
+                flux = np.sum(weight * profile * np.where(good, data, 0.), axis=0) / norm
+                error = None if var is None else np.sqrt(1 / norm)
+
+        flux[ngood == 0] = np.nan
+        if error is not None:
+            error[ngood == 0] = np.nan
+
+        return self.wave, flux, error
+
+    def wavespec(self, lo, hi, method='boxcar'):
+        # extracted spectrum as a wavespec object, read on first use
+        lo, hi = max(int(lo), 0), min(int(hi), self.nspatial)
+        ws = wavespec.wavespec_obj(self.filename, loader=sloader.spec2d_boxcar, \
+                                   source=lambda: self.extract(lo, hi, method))
+        ws.label = '{0} [{1:d}:{2:d} {3}]'.format(os.path.basename(self.filename), lo, hi, method)
+        ws.extraction = {"ext": self.ext, "aperture": [lo, hi], "method": method}
+
+        return ws
+
+
+@functools.lru_cache(maxsize=8)
+def open_spec2d(fn, ext=None):
+    # shared per file, so that extractions are cached across apertures
+    return spec2d_obj(fn, ext)
+
+
+def extract_file(fn, ext=None, aperture=None, method='boxcar'):
+    # (wave, flux, error) of an aperture [lo, hi) of a 2D spectrum file, the
+    # full slit by default
+    s2d = open_spec2d(fn, ext)
+    lo, hi = (0, s2d.nspatial) if aperture is None else aperture
+
+    return s2d.extract(lo, hi, method)
@@ -1,13 +1,14 @@
 # defines a wave spec object to be displayed
 import os
-from astropy.convolution import Box1DKernel
-from astropy.convolution import convolve, convolve_fft
+import warnings
 import numpy as np
 from . import sloader
 
 class wavespec_obj:
 
-    def __init__(self, fn, loader=sloader.default):
+    def __init__(self, fn, loader=sloader.default, source=None):
+        # source: function returning (wave, spec, error) to be called on the
+        # first use of the data instead of reading fn now
 
         self.filename = fn
         self.loader = loader
@@ -17,7 +18,17 @@ class wavespec_obj:
         self.color = None
         self.addredshift = 0.
         self.smooth_width = 0
+        self.mask = None    # True for masked pixels (sky lines, bad regions)
+        self.extraction = None  # aperture of a spectrum extracted from a 2D spectrum or a cube
+        self.version = 0    # incremented when the data are replaced
+        self.cache = {}
         
+        self.label = os.path.basename(fn)
+
+        if source is not None:
+            self._source = source
+            return
+
         # read file
         wave, spec, error = loader(fn)
         self.wave = wave
@@ -26,7 +37,36 @@ class wavespec_obj:
 
         self.reset()
 
-        self.label = os.path.basename(fn)
+        return
+
+    def __getattr__(self, name):
+        # only called for missing attributes: read the data of a lazily
+        # loaded spectrum and redo the smoothing
+        if name in ('wave', 'spec', 'error', 'spec_display', 'error_display') and \
+            '_source' in self.__dict__:
+            self.wave, self.spec, self.error = self.__dict__['_source']()
+            del self.__dict__['_source']
+            width = self.smooth_width
+            self.reset()
+            self.smooth(width)
+            return getattr(self, name)
+
+        raise AttributeError("'{0}' object has no attribute '{1}'".format(type(self).__name__, name))
+
+    def set_data(self, wave, spec, error):
+        # replace the data, e.g. of a file that was rewritten: the display
+        # parameters are kept, smoothing and masks are redone
+        self.__dict__.pop('_source', None)
+        self.wave = wave
+        self.spec = spec
+        self.error = error
+        self.cache = {}
+        self.mask = None
+        self.mask_key = None
+        self.version = getattr(self, 'version', 0) + 1
+        width = self.smooth_width
+        self.reset()
+        self.smooth(width)
 
         return
 
@@ -39,6 +79,8 @@ class wavespec_obj:
         else:
             self.error_display = None
 
+        self.apply_mask()
+
         return
     
     def smooth(self, width):
@@ -46,14 +88,90 @@ class wavespec_obj:
         self.smooth_width = width
 
         if width > 0:
-            kernel = Box1DKernel(width)
-            self.spec_display = convolve(self.spec, kernel)
-            
-            if self.error is not None:
-                self.error_display = convolve(self.error, kernel) / np.sqrt(width)
+            # smoothed arrays are cached per width (e.g. for undo)
+            self.spec_display, self.error_display = self.cached(('smoothed',), self._smoothed)
         else:
             self.reset()
 
         return
 
+    def _smoothed(self):
+        # masked and non-finite pixels are excluded from the kernel sums
+        # (masked regions wider than the kernel stay NaN; no need to warn)
+        from astropy.convolution import Box1DKernel, convolve
+
+        width = self.smooth_width
+        bad = self.bad_pixels()
+        kernel = Box1DKernel(width)
+        error_display = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            spec_display = convolve(np.where(bad, np.nan, self.spec), kernel)
+        
+            if self.error is not None:
+                error_display = convolve(np.where(bad, np.nan, self.error), kernel) / np.sqrt(width)
+
+        if np.any(bad):
+            spec_display[bad] = np.nan
+            if error_display is not None:
+                error_display[bad] = np.nan
+
+        return spec_display, error_display
+
+    def bad_pixels(self):
+        # masked or non-finite pixels of the original spectrum
+        bad = ~np.isfinite(self.spec)
+        if self.error is not None:
+            bad = bad | ~np.isfinite(self.error)
+        if getattr(self, 'mask', None) is not None:
+            bad = bad | self.mask
+
+        return bad
+
+    def apply_mask(self):
+        # bad pixels are NaN in the displayed arrays, which the plot shows as
+        # gaps and every measurement skips
+        bad = self.bad_pixels()
+        if np.any(bad):
+            self.spec_display = np.where(bad, np.nan, self.spec_display)
+            if self.error_display is not None:
+                self.error_display = np.where(bad, np.nan, self.error_display)
+
+        return
+
+    def set_mask(self, mask):
+        # set the pixel mask and redo the smoothing if it changed
+        if mask is not None and not np.any(mask):
+            mask = None
+        old = getattr(self, 'mask', None)
+        if (old is None and mask is None) or \
+            (old is not None and mask is not None and np.array_equal(old, mask)):
+            return
+
+        self.mask = mask
+        self.cache = {}
+        self.smooth(self.smooth_width)
+
+        return
+
+    def noise_kernel(self):
+        # convolution kernel that correlates the noise of spec_display with
+        # respect to the original spec; None when no smoothing is applied
+        if self.smooth_width > 0:
+            from astropy.convolution import Box1DKernel
+            return Box1DKernel(self.smooth_width).array
+        return None
+
+    def cached(self, key, func, maxsize=16):
+        # derived data of the displayed spectrum (e.g. a continuum), computed
+        # by func() once per key and smoothing width
+        if not hasattr(self, 'cache'):
+            self.cache = {}
+
+        key = (self.smooth_width,) + tuple(key)
+        if key not in self.cache:
+            if len(self.cache) >= maxsize:
+                del self.cache[next(iter(self.cache))]
+            self.cache[key] = func()
 
+        return self.cache[key]
@@ -0,0 +1,499 @@
+# headless batch measurements: apply a recipe of measurements (as made in
+# the GUI) to many spectra in a process pool, streaming one table row per
+# spectrum as it finishes, and QA sheets of many spectra (qasheet.py).
+# Nothing here imports Qt.
+import os
+import sys
+import csv
+import json
+import glob
+import argparse
+import warnings
+import numpy as np
+
+from .WaveSpec import wavespec, sloader
+from .utils import calc_ew, calc_ew_mc, calc_ew_continuum, fit_gauss, fit_gauss_mc, fit_lines, \
+    pool_imap, read_line_list
+
+# recipe keys and defaults. Windows are in the displayed (addredshift)
+# wavelength frame, except 'ew', which is the continuum points
+# [x0, y0, x1, y1] of the 'e' key.
+RECIPE = {
+    "smooth": 0,
+    "addredshift": 0.,
+    "mult": 1.,
+    "add": 0.,
+    "redshift": 0.,
+    "ew": [],           # 'e': EW on a straight continuum through two points
+    "ew_auto": [],      # 'E': EW in [w0, w1] on the automatic continuum
+    "gauss": [],        # 'k': single Gaussian fit in [w0, w1]
+    "fit_lines": [],    # 'K': line list fit in [w0, w1] at the redshift
+    "mc_errors": 0,     # Monte Carlo realizations for 'e' and 'k', 0 = off
+    "masks": []         # mask list files
+}
+
+
+def make_recipe(**kwargs):
+    # recipe with defaults for the missing keys
+    unknown = set(kwargs) - set(RECIPE)
+    if len(unknown) > 0:
+        raise ValueError("Unknown recipe keys: {0}".format(', '.join(sorted(unknown))))
+    recipe = json.loads(json.dumps(RECIPE))
+    recipe.update(kwargs)
+
+    return recipe
+
+
+def read_recipe(fn):
+    with open(fn) as f:
+        return make_recipe(**json.load(f))
+
+
+def recipe_from_workspace(fn):
+    # the measurements of a saved workspace as a recipe, and its line list.
+    # Display parameters are taken from the first spectrum.
+    from .workspace import load_workspace
+
+    wks = load_workspace(fn)
+    plotting = wks['plotting']
+    recipe = make_recipe(redshift=float(plotting.get('redshift', 0.)), \
+                         mc_errors=int(plotting.get('mc_errors', 0)))
+    if len(wks['specs']) > 0:
+        ws = wks['specs'][0]
+        recipe.update(smooth=int(ws.smooth_width), addredshift=float(ws.addredshift), \
+                      mult=float(ws.mult), add=float(ws.add))
+
+    def complete(values):
+        return values is not None and all(v is not None for v in values)
+
+    if complete(plotting.get('ew_cont')):
+        recipe['ew'].append([float(v) for v in plotting['ew_cont']])
+    if complete(plotting.get('ew_window')):
+        recipe['ew_auto'].append([float(v) for v in plotting['ew_window']])
+    if complete(plotting.get('gauss_lim')):
+        key = 'gauss' if plotting.get('lines_fit') is None else 'fit_lines'
+        recipe[key].append([float(v) for v in plotting['gauss_lim']])
+
+    return recipe, wks['linelist']
+
+
+def expand_files(args):
+    # file names from arguments that may be files, glob patterns,
+    # directories (all FITS files) or @file lists (one name per line)
+    fns = []
+    for arg in args:
+        if arg.startswith('@'):
+            with open(arg[1:]) as f:
+                fns.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        elif os.path.isdir(arg):
+            fns.extend(sorted(glob.glob(os.path.join(arg, '*.fits'))))
+        elif glob.has_magic(arg):
+            fns.extend(sorted(glob.glob(arg)))
+        else:
+            fns.append(arg)
+
+    return fns
+
+
+def _lines_in_window(linelist, window, redshift):
+    # (label, rest wavelength) of the line list entries within a window
+    return [(label, w) for label, w in zip(linelist['labels'], linelist['waves']) \
+            if window[0] <= w * (1 + redshift) <= window[1]]
+
+
+def _line_column(label, rest_wave):
+    return '{0}_{1:.2f}'.format(label, rest_wave)
+
+
+def measure_columns(recipe, linelist):
+    # table columns of measure_file() for a recipe
+    columns = ['filename', 'message']
+    for i in range(len(recipe['ew'])):
+        columns += ['ew{0}'.format(i), 'ew{0}_err'.format(i), 'flux{0}'.format(i), 'flux{0}_err'.format(i)]
+    for i in range(len(recipe['ew_auto'])):
+        columns += ['ewauto{0}'.format(i), 'ewauto{0}_err'.format(i), \
+                    'fluxauto{0}'.format(i), 'fluxauto{0}_err'.format(i)]
+    for i in range(len(recipe['gauss'])):
+        for q in ('flux', 'ew', 'center'):
+            columns += ['gauss{0}_{1}'.format(i, q), 'gauss{0}_{1}_err'.format(i, q)]
+    for i, window in enumerate(recipe['fit_lines']):
+        columns += ['lines{0}_z'.format(i), 'lines{0}_z_err'.format(i), \
+                    'lines{0}_sigma_v'.format(i), 'lines{0}_sigma_v_err'.format(i)]
+        for label, rest_wave in _lines_in_window(linelist, window, recipe['redshift']):
+            name = _line_column(label, rest_wave)
+            columns += ['lines{0}_flux_{1}'.format(i, name), 'lines{0}_flux_{1}_err'.format(i, name), \
+                        'lines{0}_ew_{1}'.format(i, name), 'lines{0}_ew_{1}_err'.format(i, name)]
+
+    return columns
+
+
+def _measure(row, name, func):
+    # run one measurement; failures go to the message column
+    try:
+        with warnings.catch_warnings():
+            # e.g. empty slices of fully masked regions
+            warnings.simplefilter('ignore', RuntimeWarning)
+            func()
+    except Exception as e:
+        row['message'] += '{0}: {1}: {2}; '.format(name, type(e).__name__, e)
+
+
+def measure_file(item):
+    # worker: all measurements of a recipe on one spectrum; never raises
+    from . import continuum, masks
+
+    fn, loader, recipe, linelist = item
+    row = {"filename": fn, "message": ''}
+    try:
+        ws = wavespec.wavespec_obj(fn, loader=loader)
+    except Exception as e:
+        row['message'] = 'load: {0}: {1}'.format(type(e).__name__, e)
+        return row
+
+    ws.addredshift = recipe['addredshift']
+    ws.mult = recipe['mult']
+    ws.add = recipe['add']
+    if len(recipe['masks']) > 0:
+        mask_list = masks.mask_list()
+        for mfn in recipe['masks']:
+            mask_list.load(mfn)
+        mask_list.apply(ws, recipe['redshift'])
+    ws.smooth(recipe['smooth'])
+    mc = recipe['mc_errors'] > 0 and ws.error_display is not None
+
+    for i, cp in enumerate(recipe['ew']):
+        def ew_cont():
+            ew, flux = calc_ew_mc(ws, cp, nreal=recipe['mc_errors']) if mc else calc_ew(ws, cp)
+            row.update({'ew{0}'.format(i): ew[0], 'ew{0}_err'.format(i): ew[1], \
+                        'flux{0}'.format(i): flux[0], 'flux{0}_err'.format(i): flux[1]})
+        _measure(row, 'ew{0}'.format(i), ew_cont)
+
+    for i, window in enumerate(recipe['ew_auto']):
+        def ew_auto():
+            # as the Gaussian fit, a window without data is an error rather
+            # than an EW of 0
+            wave = ws.wave * (1 + ws.addredshift)
+            if not np.any((wave >= window[0]) & (wave < window[1]) & np.isfinite(ws.spec_display)):
+                raise ValueError("No pixels in the window.")
+            cont = continuum.continuum(ws, linelist['waves'], recipe['redshift'])
+            ew, flux = calc_ew_continuum(ws, window, cont)
+            row.update({'ewauto{0}'.format(i): ew[0], 'ewauto{0}_err'.format(i): ew[1], \
+                        'fluxauto{0}'.format(i): flux[0], 'fluxauto{0}_err'.format(i): flux[1]})
+        _measure(row, 'ewauto{0}'.format(i), ew_auto)
+
+    for i, window in enumerate(recipe['gauss']):
+        def gauss_fit():
+            if mc:
+                flux, ew, center = fit_gauss_mc(ws, window, nreal=recipe['mc_errors'])[:3]
+            else:
+                flux, ew, center = fit_gauss(ws, window)[:3]
+            for q, values in zip(('flux', 'ew', 'center'), (flux, ew, center)):
+                row['gauss{0}_{1}'.format(i, q)] = values[0]
+                row['gauss{0}_{1}_err'.format(i, q)] = values[1]
+        _measure(row, 'gauss{0}'.format(i), gauss_fit)
+
+    for i, window in enumerate(recipe['fit_lines']):
+        def lines_fit():
+            res = fit_lines(ws, window, linelist['waves'], recipe['redshift'], labels=linelist['labels'])
+            row['lines{0}_z'.format(i)], row['lines{0}_z_err'.format(i)] = res['redshift']
+            row['lines{0}_sigma_v'.format(i)], row['lines{0}_sigma_v_err'.format(i)] = res['sigma_v']
+            for label, rest_wave, flux, ew in zip(res['labels'], res['rest_waves'], res['flux'], res['ew']):
+                name = _line_column(label, rest_wave)
+                row['lines{0}_flux_{1}'.format(i, name)], row['lines{0}_flux_{1}_err'.format(i, name)] = flux
+                row['lines{0}_ew_{1}'.format(i, name)], row['lines{0}_ew_{1}_err'.format(i, name)] = ew
+        _measure(row, 'lines{0}'.format(i), lines_fit)
+
+    row['message'] = row['message'].rstrip('; ')
+
+    return row
+
+
+def detect_columns(topk):
+    columns = ['filename', 'message', 'nlines']
+    for k in range(topk):
+        columns += ['z{0}'.format(k), 'nmatch{0}'.format(k), 'score{0}'.format(k), 'lines{0}'.format(k)]
+
+    return columns
+
+
+def detect_file(item):
+    # worker: the line detection worker of linedetect, as a table row
+    from .linedetect import _detect_file
+
+    result = _detect_file(item)
+    row = {"filename": result['filename'], "message": result['message']}
+    if result['lines'] is None:
+        return row
+
+    row['nlines'] = len(result['lines']['wave'])
+    for k, c in enumerate(result['redshifts']):
+        row['z{0}'.format(k)] = c['z']
+        row['nmatch{0}'.format(k)] = c['nmatch']
+        row['score{0}'.format(k)] = c['score']
+        row['lines{0}'.format(k)] = ' '.join(label for _, label in c['lines'])
+
+    return row
+
+
+class table_writer:
+    # rows written to a CSV file as they come (flushed every row), or
+    # collected and written to a FITS table on close
+
+    def __init__(self, fn, columns):
+
+        self.fn = fn
+        self.columns = columns
+        self.fits = os.path.splitext(fn)[1].lower() in ('.fits', '.fit', '.fts')
+        self.rows = []
+        if not self.fits:
+            self.file = sys.stdout if fn == '-' else open(fn, 'w', newline='')
+            self.writer = csv.DictWriter(self.file, fieldnames=columns, restval='', extrasaction='ignore')
+            self.writer.writeheader()
+            self.file.flush()
+
+        return
+
+    def write(self, row):
+        if self.fits:
+            self.rows.append(row)
+        else:
+            self.writer.writerow({k: _format(v) for k, v in row.items()})
+            self.file.flush()
+
+        return
+
+    def close(self):
+        if self.fits:
+            from astropy.table import Table
+
+            data = {}
+            for name in self.columns:
+                values = [row.get(name) for row in self.rows]
+                if name in ('filename', 'message') or any(isinstance(v, str) for v in values):
+                    data[name] = ['' if v is None else str(v) for v in values]
+                else:
+                    data[name] = np.array([np.nan if v is None else v for v in values], dtype=float)
+            Table(data, names=self.columns).write(self.fn, overwrite=True)
+        elif self.file is not sys.stdout:
+            self.file.close()
+
+        return
+
+
+def _format(value):
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    return value
+
+
+def run(worker, items, columns, output, nproc=None, progress=True):
+    # run a worker over items in a process pool and stream the rows to
+    # output; returns the number of spectra without any measurement
+    writer = table_writer(output, columns)
+    nfail = 0
+    try:
+        for n, (i, row) in enumerate(pool_imap(worker, items, nproc=nproc)):
+            writer.write(row)
+            if all(k in ('filename', 'message') for k in row):
+                nfail += 1
+            if progress:
+                sys.stderr.write("\r{0}/{1} done, {2} failed".format(n + 1, len(items), nfail))
+                sys.stderr.flush()
+    finally:
+        writer.close()
+        if progress:
+            sys.stderr.write('\n')
+
+    return nfail
+
+
+def get_loader(name):
+    loader = getattr(sloader, name, None)
+    if loader is None or not callable(loader):
+        raise SystemExit("Unknown loader '{0}'".format(name))
+    return loader
+
+
+def get_linelist(fn):
+    # line list dict as in the GUI; the packaged list by default
+    if fn is None:
+        fn = os.path.join(os.path.dirname(__file__), 'lib', 'line_list.dat')
+    waves, labels, kwargs = read_line_list(fn)
+
+    return {"waves": waves, "labels": labels, "kwargs": kwargs}
+
+
+def sheet(args, loader, fns):
+    # `batch sheet`: QA sheets of fns; returns the number of failed panels
+    from . import qasheet
+    from .workspace import load_workspace
+
+    redshift, trim_lines = 0., []
+    display = {}
+    linelist = None
+    if args.workspace is not None:
+        wks = load_workspace(args.workspace)
+        redshift = float(wks['plotting'].get('redshift', 0.))
+        trim_lines = list(wks['plotting'].get('trim_lines', []))
+        linelist = wks['linelist']
+        if len(wks['specs']) > 0:
+            ws = wks['specs'][0]
+            display = {"smooth": ws.smooth_width, "addredshift": ws.addredshift, "mult": ws.mult, "add": ws.add}
+    if args.linelist is not None or linelist is None:
+        linelist = get_linelist(args.linelist)
+    # command line options override the workspace
+    if args.redshift is not None:
+        redshift = args.redshift
+    if args.trim_line is not None:
+        trim_lines = args.trim_line
+    if args.smooth is not None:
+        display['smooth'] = args.smooth
+    redshifts = {} if args.redshifts is None else qasheet.read_redshifts(args.redshifts)
+
+    items = []
+    for fn in fns:
+        z, lines = qasheet.lookup_redshift(redshifts, fn, default=(redshift, trim_lines))
+        items.append(qasheet.file_item(fn, loader, redshift=z, trim_lines=lines, **display))
+
+    def progress(n, ntotal, message):
+        if message and not args.quiet:
+            sys.stderr.write("\r{0}: {1}\n".format(items[n - 1]['filename'], message))
+        progress.nfail += bool(message)
+        if not args.quiet:
+            sys.stderr.write("\r{0}/{1} done, {2} failed".format(n, ntotal, progress.nfail))
+            sys.stderr.flush()
+    progress.nfail = 0
+
+    try:
+        npages, nfail = qasheet.write_sheets(items, args.output, linelist, \
+                                             layout=args.layout or qasheet.LAYOUT, dpi=args.dpi or qasheet.DPI, \
+                                             nproc=args.nproc, progress=progress)
+    finally:
+        if not args.quiet:
+            sys.stderr.write('\n')
+    if not args.quiet:
+        sys.stderr.write("{0} pages written\n".format(npages))
+
+    return nfail
+
+
+def parser_init():
+    parser = argparse.ArgumentParser(prog='xtrimpy batch', description="Xtrim headless batch measurements")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def common(p):
+        p.add_argument('files', nargs='+', help='spectra: files, glob patterns, directories or @list files')
+        p.add_argument('-o', '--output', default='-', help='output table (.csv or .fits; default: CSV to stdout)')
+        p.add_argument('--loader', default='default', help='loading function in WaveSpec.sloader')
+        p.add_argument('--linelist', default=None, help='line list file (default: the packaged list)')
+        p.add_argument('-j', '--nproc', type=int, default=None, help='number of processes (default: all CPUs)')
+        p.add_argument('-q', '--quiet', action='store_true', help='no progress output')
+
+    measure = sub.add_parser('measure', help='measure EWs, fluxes and line fits with a recipe')
+    common(measure)
+    measure.add_argument('--recipe', default=None, help='recipe JSON file')
+    measure.add_argument('--workspace', default=None, help='use the measurements and line list of a workspace')
+    measure.add_argument('--smooth', type=int, default=None)
+    measure.add_argument('--redshift', type=float, default=None)
+    measure.add_argument('--ew', type=float, nargs=4, action='append', metavar=('X0', 'Y0', 'X1', 'Y1'), \
+                         help="EW on the continuum through two points ('e'); repeatable")
+    measure.add_argument('--ew-auto', type=float, nargs=2, action='append', metavar=('W0', 'W1'), \
+                         help="EW on the automatic continuum ('E'); repeatable")
+    measure.add_argument('--gauss', type=float, nargs=2, action='append', metavar=('W0', 'W1'), \
+                         help="Gaussian fit ('k'); repeatable")
+    measure.add_argument('--fit-lines', type=float, nargs=2, action='append', metavar=('W0', 'W1'), \
+                         help="line list fit at the redshift ('K'); repeatable")
+    measure.add_argument('--mc-errors', type=int, default=None, help='Monte Carlo realizations for errors')
+    measure.add_argument('--mask', action='append', default=None, help='mask list file; repeatable')
+
+    detect = sub.add_parser('detect', help='detect lines and propose redshifts')
+    common(detect)
+    detect.add_argument('--nsigma', type=float, default=5.)
+    detect.add_argument('--zmin', type=float, default=0.)
+    detect.add_argument('--zmax', type=float, default=10.)
+    detect.add_argument('--topk', type=int, default=3)
+
+    sheet = sub.add_parser('sheet', help='QA figure sheets with one panel per spectrum')
+    sheet.add_argument('files', nargs='+', help='spectra: files, glob patterns, directories or @list files')
+    sheet.add_argument('-o', '--output', required=True, \
+                       help='sheets: a multi-page .pdf, or one .png per page (name_001.png, ...)')
+    sheet.add_argument('--loader', default='default', help='loading function in WaveSpec.sloader')
+    sheet.add_argument('--linelist', default=None, help='line list file (default: the packaged list)')
+    sheet.add_argument('-j', '--nproc', type=int, default=None, help='number of processes (default: all CPUs)')
+    sheet.add_argument('-q', '--quiet', action='store_true', help='no progress output')
+    sheet.add_argument('--workspace', default=None, \
+                       help='use the redshift, trim lines, line list and display parameters of a workspace')
+    sheet.add_argument('--redshift', type=float, default=None, help='redshift of all spectra')
+    sheet.add_argument('--redshifts', default=None, \
+                       help='table (.csv or .fits) of filename and z (or redshift, z0, e.g. from batch detect), '
+                            'and optionally trim_lines (space-separated), per spectrum')
+    sheet.add_argument('--trim-line', type=float, action='append', default=None, metavar='W', \
+                       help='trim line of all spectra; repeatable')
+    sheet.add_argument('--smooth', type=int, default=None)
+    sheet.add_argument('--layout', type=int, nargs=2, default=None, metavar=('ROWS', 'COLUMNS'), \
+                       help='panels per page (default: 4 2)')
+    sheet.add_argument('--dpi', type=int, default=None, help='resolution of the pages (default: 150)')
+
+    recipe = sub.add_parser('recipe', help='write the recipe of a workspace as JSON')
+    recipe.add_argument('workspace')
+    recipe.add_argument('-o', '--output', default='-')
+
+    return parser
+
+
+def main(argv=None):
+    args = parser_init().parse_args(argv)
+
+    if args.command == 'recipe':
+        recipe, _ = recipe_from_workspace(args.workspace)
+        text = json.dumps(recipe, indent=1)
+        if args.output == '-':
+            print(text)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+        return 0
+
+    loader = get_loader(args.loader)
+    fns = expand_files(args.files)
+    if len(fns) == 0:
+        raise SystemExit("No input files.")
+
+    if args.command == 'measure':
+        linelist = None
+        if args.workspace is not None:
+            recipe, linelist = recipe_from_workspace(args.workspace)
+        elif args.recipe is not None:
+            recipe = read_recipe(args.recipe)
+        else:
+            recipe = make_recipe()
+        if args.linelist is not None or linelist is None:
+            linelist = get_linelist(args.linelist)
+
+        # command line options override the recipe
+        for key in ('smooth', 'redshift', 'mc_errors'):
+            if getattr(args, key) is not None:
+                recipe[key] = getattr(args, key)
+        for key in ('ew', 'ew_auto', 'gauss', 'fit_lines'):
+            if getattr(args, key) is not None:
+                recipe[key] = getattr(args, key)
+        if args.mask is not None:
+            recipe['masks'] = [os.path.abspath(fn) for fn in args.mask]
+
+        items = [(fn, loader, recipe, linelist) for fn in fns]
+        columns = measure_columns(recipe, linelist)
+        nfail = run(measure_file, items, columns, args.output, nproc=args.nproc, progress=not args.quiet)
+
+    elif args.command == 'detect':
+        linelist = get_linelist(args.linelist)
+        match_kwargs = {"zmin": args.zmin, "zmax": args.zmax, "topk": args.topk}
+        items = [(fn, loader, linelist['waves'], linelist['labels'], {"nsigma": args.nsigma}, match_kwargs) \
+                 for fn in fns]
+        nfail = run(detect_file, items, detect_columns(args.topk), args.output, nproc=args.nproc, \
+                    progress=not args.quiet)
+
+    elif args.command == 'sheet':
+        nfail = sheet(args, loader, fns)
+
+    # exit status 1 only if nothing could be measured at all
+    return 1 if nfail == len(fns) else 0
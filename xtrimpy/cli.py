@@ -0,0 +1,80 @@
+# console entry point: `xtrimpy batch ...` runs headless batch measurements,
+# anything else starts the GUI. Qt is only imported for the GUI; in
+# single-instance mode the files are handed to a running GUI if there is one.
+import sys
+import argparse
+
+
+def parser_init():
+    """Create command-line argument parser for this script."""
+    parser = argparse.ArgumentParser(description="Xtrim GUI")
+    parser.add_argument(
+        'filenames',
+        type=str,
+        help='Spectrum to be displayed',
+        default=None,
+        nargs='*'
+        )
+    parser.add_argument(
+        '--loader',
+        type=str,
+        help='Loading function in WaveSpec.sloader (default: default)',
+        default='default'
+        )
+    parser.add_argument(
+        '--single-instance',
+        action='store_true',
+        help='Open the files in a running xtrimpy started with this option, '
+             'or start one that later calls open their files in '
+             '(also XTRIMPY_SINGLE_INSTANCE=1)'
+        )
+    parser.add_argument(
+        '--renderer',
+        type=str,
+        # render.RENDERERS, without importing matplotlib here
+        choices=('raster', 'matplotlib'),
+        help='Drawing of the spectra: raster (fast, default) or matplotlib '
+             '(as in saved figures)',
+        default='raster'
+        )
+    parser.add_argument(
+        '--watch',
+        action='store_const',
+        const='auto',
+        default=None,
+        help='Reload spectra whose files change on disk (inotify where available, polling otherwise)'
+        )
+    parser.add_argument(
+        '--watch-poll',
+        action='store_const',
+        const='poll',
+        dest='watch',
+        help='As --watch, always polling the files (e.g. on network file systems)'
+        )
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if len(argv) > 0 and argv[0] == 'batch':
+        from . import batch
+        sys.exit(batch.main(argv[1:]))
+
+    args = parser_init().parse_args(argv)
+    from . import instance
+    if instance.enabled(args.single_instance):
+        reply = instance.forward(args.filenames, args.loader)
+        if reply == 'ok':
+            sys.exit(0)
+        if reply is not None:
+            print(reply if reply else "The running instance did not reply.", file=sys.stderr)
+            sys.exit(1)
+
+    from . import xtrimpy
+    xtrimpy.main(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# automatic continuum fitting for EWs and normalization
+import numpy as np
+
+from .utils import C_KMS
+
+
+def line_mask(wave, rest_waves, redshift, width_kms=500.):
+    # True for pixels within width_kms of any line list entry at redshift
+    wave = np.asarray(wave, dtype=float)
+    lines = np.sort(np.asarray(rest_waves, dtype=float)) * (1 + redshift)
+    if len(lines) == 0:
+        return np.zeros(len(wave), dtype=bool)
+
+    # distance to the nearest line from the sorted line positions
+    k = np.searchsorted(lines, wave)
+    left = lines[np.clip(k - 1, 0, len(lines) - 1)]
+    right = lines[np.clip(k, 0, len(lines) - 1)]
+    dist = np.minimum(np.abs(wave - left), np.abs(wave - right))
+
+    return dist < wave * width_kms / C_KMS
+
+
+def percentile_continuum(wave, flux, good, block=101, q=50.):
+    # running percentile filter evaluated in blocks of good pixels and
+    # interpolated between the block centers; O(N)
+    idx = np.flatnonzero(good)
+    if len(idx) == 0:
+        return np.full(len(flux), np.nan)
+    nblock = int(np.ceil(len(idx) / block))
+
+    fpack = np.full(nblock * block, np.nan)
+    wpack = np.full(nblock * block, np.nan)
+    fpack[:len(idx)] = flux[idx]
+    wpack[:len(idx)] = wave[idx]
+    fblock = np.nanpercentile(fpack.reshape(nblock, block), q, axis=1)
+    wblock = np.nanmedian(wpack.reshape(nblock, block), axis=1)
+
+    return np.interp(wave, wblock, fblock)
+
+
+def spline_continuum(wave, flux, good, sigma=None, knot_spacing=100, nsigma=(2.5, 3.), niter=5):
+    # iteratively sigma-clipped least-squares cubic spline with a knot every
+    # knot_spacing good pixels. nsigma is the (lower, upper) clipping limit,
+    # in units of sigma if given and of the robust residual scatter if not.
+    from scipy.interpolate import LSQUnivariateSpline
+
+    use = good.copy()
+    cont = percentile_continuum(wave, flux, good, block=knot_spacing)
+    for _ in range(niter):
+        idx = np.flatnonzero(use)
+        if len(idx) < 2 * knot_spacing:
+            break
+        knots = wave[idx[knot_spacing:-knot_spacing:knot_spacing]]
+        w = None if sigma is None else 1. / sigma[idx]
+        try:
+            spline = LSQUnivariateSpline(wave[idx], flux[idx], knots, w=w, k=3)
+        except ValueError:
+            break
+        cont = spline(wave)
+
+        resid = flux - cont
+        if sigma is None:
+            scale = 1.4826 * np.median(np.abs(resid[use]))
+        else:
+            scale = sigma
+        clipped = good & (resid > -nsigma[0] * scale) & (resid < nsigma[1] * scale)
+        if np.array_equal(clipped, use):
+            break
+        use = clipped
+
+    return cont
+
+
+def fit_continuum(wave, flux, err=None, mask=None, method='spline', **kwargs):
+    # continuum of a spectrum on its own pixels. wave must be sorted; mask
+    # marks pixels (e.g. lines) to ignore. method is 'spline' or 'percentile'.
+    wave = np.asarray(wave, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(wave) & np.isfinite(flux)
+    if err is not None:
+        err = np.asarray(err, dtype=float)
+        good = good & np.isfinite(err) & (err > 0)
+    if mask is not None:
+        good = good & ~mask
+
+    if method == 'percentile':
+        return percentile_continuum(wave, flux, good, **kwargs)
+    elif method == 'spline':
+        return spline_continuum(wave, flux, good, sigma=err, **kwargs)
+    else:
+        raise ValueError("Unknown continuum method: {0}".format(method))
+
+
+def continuum(wavespec, rest_waves=(), redshift=0., width_kms=500., method='spline', **kwargs):
+    # continuum of the displayed spectrum with the line list masked at the
+    # redshift, cached on the spectrum per parameter set
+    key = ('continuum', wavespec.addredshift, tuple(rest_waves), redshift, width_kms, method, tuple(sorted(kwargs.items())))
+
+    def compute():
+        wave = wavespec.wave * (1 + wavespec.addredshift)
+        order = np.argsort(wave)
+        mask = line_mask(wave[order], rest_waves, redshift, width_kms=width_kms)
+        err = None if wavespec.error_display is None else wavespec.error_display[order]
+        cont = np.empty(len(wave))
+        cont[order] = fit_continuum(wave[order], wavespec.spec_display[order], err=err, mask=mask, \
+                                    method=method, **kwargs)
+        return cont
+
+    return wavespec.cached(key, compute)
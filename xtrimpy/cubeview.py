@@ -0,0 +1,116 @@
+# panel of an IFU data cube: a white-light image, or a narrow-band image of
+# the wavelength range of the main plot that follows panning and zooming.
+# Clicking a spaxel adds the spectrum summed within the aperture radius to
+# the session.
+import os
+import logging
+import numpy as np
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QComboBox, QLabel, QDoubleSpinBox
+from PyQt5.QtCore import Qt, QTimer
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+from matplotlib.patches import Circle
+
+logger = logging.getLogger(__name__)
+
+MODES = ('White light', 'Narrow band (plot range)')
+
+
+class cube_view(QDialog):
+
+    def __init__(self, session, cube, parent=None):
+        super().__init__(parent)
+
+        self.session = session
+        self.cube = cube
+        self.pending = False
+
+        self.setWindowTitle('Data Cube: ' + os.path.basename(cube.filename))
+        self.resize(500, 550)
+        layout = QVBoxLayout(self)
+
+        self.figure = Figure()
+        self.canvas = FigureCanvas(self.figure)
+        self.canvas.setFocusPolicy(Qt.ClickFocus)
+        self.ax = self.figure.add_axes([0.1, 0.08, 0.85, 0.88])
+        self.ax.set_xlabel('x')
+        self.ax.set_ylabel('y')
+        layout.addWidget(self.canvas)
+
+        controls = QHBoxLayout()
+        self.label = QLabel('Click a spaxel to extract its spectrum')
+        controls.addWidget(self.label, 1)
+        self.mode = QComboBox()
+        self.mode.addItems(MODES)
+        self.mode.currentIndexChanged.connect(self.update_image)
+        controls.addWidget(self.mode)
+        controls.addWidget(QLabel('Radius'))
+        self.radius = QDoubleSpinBox()
+        self.radius.setRange(0, 50)
+        self.radius.setSingleStep(0.5)
+        self.radius.setSuffix(' spaxels')
+        controls.addWidget(self.radius)
+        layout.addLayout(controls)
+
+        self.image = self.ax.imshow(self.cube.white_light(), origin='lower', cmap='gray', \
+                                    interpolation='nearest')
+        self.update_image()
+
+        self.canvas.mpl_connect('button_press_event', self.on_press)
+        self.session.subscribe(self.on_session_changed)
+
+        return
+
+    def narrow_band(self):
+        return self.mode.currentIndex() == 1
+
+    def update_image(self):
+        self.pending = False
+        box = self.session.plotting['box']
+        if self.narrow_band() and box[0] is not None and box[2] is not None:
+            image = self.cube.narrow_band(box[0], box[2])
+            i0, i1 = self.cube.window[:2]
+            title = '{0:.1f} - {1:.1f} ({2:d} planes)'.format(box[0], box[2], i1 - i0)
+        else:
+            image = self.cube.white_light()
+            title = 'White light'
+
+        self.image.set_data(image)
+        finite = image[np.isfinite(image)]
+        if len(finite) > 0:
+            self.image.set_clim(*np.percentile(finite, [1, 99.5]))
+        self.ax.set_title(title, fontsize='small')
+        self.canvas.draw_idle()
+
+        return
+
+    def on_session_changed(self, events):
+        # one image per event loop iteration, e.g. while panning
+        if 'view' in events and self.narrow_band() and not self.pending:
+            self.pending = True
+            QTimer.singleShot(0, self.update_image)
+
+        return
+
+    def on_press(self, event):
+        if event.inaxes is not self.ax or event.button != 1 or event.xdata is None:
+            return
+        radius = self.radius.value()
+        try:
+            ws = self.cube.wavespec(event.xdata, event.ydata, radius)
+            # read now so that errors are reported here
+            ws.wave
+        except Exception as e:
+            logger.error("Extraction failed: {0}".format(e))
+            return
+        self.session.add([ws], reset_view=len(self.session.specs) == 0)
+        logger.info("Extracted {0}".format(ws.label))
+
+        self.ax.add_patch(Circle((event.xdata, event.ydata), max(radius, 0.5), fill=False, color=ws.color))
+        self.canvas.draw_idle()
+
+        return
+
+    def closeEvent(self, event):
+        self.session.unsubscribe(self.on_session_changed)
+        super().closeEvent(event)
@@ -0,0 +1,139 @@
+# undo/redo history of the session. Snapshots refer to the wavespec
+# objects and model arrays instead of copying them, and the stacks only keep
+# the parameters that changed between consecutive snapshots.
+import copy
+from collections import deque
+
+from .journal import diff
+from .workspace import TRANSIENT
+
+# display parameters of a spectrum
+SPEC_PARAMS = ('addredshift', 'mult', 'add', 'smooth_width', 'color', 'label')
+
+
+def snapshot(specs, plotting, linelist, gauss_wave=None, gauss_model=None):
+    # state of the session; arrays are shared, only small values are copied
+    return {
+        "specs": tuple(specs),
+        "params": {id(ws): tuple(getattr(ws, k) for k in SPEC_PARAMS) for ws in specs},
+        "plotting": {k: copy.deepcopy(v) for k, v in plotting.items() if k not in TRANSIENT},
+        "linelist": dict(linelist),
+        "gauss": (gauss_wave, gauss_model)
+    }
+
+
+def delta(old, new):
+    # {component: (old, new)} of what changed between two snapshots, None if
+    # nothing did. Plotting keys and spectrum parameters are compared
+    # separately so that only those that changed are kept.
+    changes = {}
+    if old["specs"] != new["specs"]:
+        changes["specs"] = (old["specs"], new["specs"])
+
+    params = {}
+    for ws in new["specs"]:
+        if id(ws) in old["params"] and old["params"][id(ws)] != new["params"][id(ws)]:
+            params[ws] = (old["params"][id(ws)], new["params"][id(ws)])
+    if len(params) > 0:
+        changes["params"] = params
+
+    plotting = {}
+    for k in set(old["plotting"]) | set(new["plotting"]):
+        if diff(old["plotting"].get(k), new["plotting"].get(k)) is not None:
+            plotting[k] = (old["plotting"].get(k), new["plotting"].get(k))
+    if len(plotting) > 0:
+        changes["plotting"] = plotting
+
+    if old["linelist"] != new["linelist"]:
+        changes["linelist"] = (old["linelist"], new["linelist"])
+    if old["gauss"][0] is not new["gauss"][0] or old["gauss"][1] is not new["gauss"][1]:
+        changes["gauss"] = (old["gauss"], new["gauss"])
+
+    return changes if len(changes) > 0 else None
+
+
+def _apply(state, changes, which):
+    # snapshot with the old (which=0) or new (which=1) side of a delta
+    state = dict(state)
+    if "specs" in changes:
+        state["specs"] = changes["specs"][which]
+    params = dict(state["params"])
+    for ws, values in changes.get("params", {}).items():
+        params[id(ws)] = values[which]
+    # spectra coming back keep their last parameters
+    state["params"] = {id(ws): params[id(ws)] if id(ws) in params else \
+                       tuple(getattr(ws, k) for k in SPEC_PARAMS) for ws in state["specs"]}
+    if "plotting" in changes:
+        state["plotting"] = dict(state["plotting"])
+        for k, values in changes["plotting"].items():
+            state["plotting"][k] = values[which]
+    if "linelist" in changes:
+        state["linelist"] = changes["linelist"][which]
+    if "gauss" in changes:
+        state["gauss"] = changes["gauss"][which]
+
+    return state
+
+
+class history:
+
+    def __init__(self, maxlen=500):
+
+        self.undo_stack = deque(maxlen=maxlen)
+        self.redo_stack = []
+        self.current = None
+
+        return
+
+    def record(self, action, state):
+        # push the change from the current snapshot to state; returns False
+        # if nothing changed
+        if self.current is None:
+            self.current = state
+            return False
+        changes = delta(self.current, state)
+        self.current = state
+        if changes is None:
+            return False
+
+        self.undo_stack.append((action, changes))
+        self.redo_stack = []
+
+        return True
+
+    def undo(self):
+        # (action, snapshot before it), or None if there is nothing to undo
+        if len(self.undo_stack) == 0:
+            return None
+        action, changes = self.undo_stack.pop()
+        self.redo_stack.append((action, changes))
+        self.current = _apply(self.current, changes, 0)
+
+        return action, self.current
+
+    def redo(self):
+        # (action, snapshot after it), or None if there is nothing to redo
+        if len(self.redo_stack) == 0:
+            return None
+        action, changes = self.redo_stack.pop()
+        self.undo_stack.append((action, changes))
+        self.current = _apply(self.current, changes, 1)
+
+        return action, self.current
+
+
+def restore(state):
+    # set the spectrum parameters of a snapshot; returns specs, plotting,
+    # linelist, gauss_wave and gauss_model for the GUI. Smoothing reuses the
+    # arrays cached on the spectra.
+    for ws in state["specs"]:
+        values = dict(zip(SPEC_PARAMS, state["params"][id(ws)]))
+        width = values.pop('smooth_width')
+        for k, v in values.items():
+            setattr(ws, k, v)
+        if width != ws.smooth_width:
+            ws.smooth(width)
+
+    plotting = {k: copy.deepcopy(v) for k, v in state["plotting"].items()}
+
+    return list(state["specs"]), plotting, dict(state["linelist"]), state["gauss"][0], state["gauss"][1]
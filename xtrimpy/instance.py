@@ -0,0 +1,94 @@
+# single-instance mode: a GUI started with --single-instance (or with
+# XTRIMPY_SINGLE_INSTANCE=1) listens on a per-user local socket, and later
+# calls in this mode hand their files to it instead of opening another
+# window. The client side only uses the standard library, so that forwarding
+# files does not import numpy, Qt or matplotlib.
+import os
+import json
+import socket
+import getpass
+import tempfile
+
+ENVIRON = 'XTRIMPY_SINGLE_INSTANCE'
+TIMEOUT = 5.
+
+
+def address():
+    # per-user socket path, in the runtime directory if there is one
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(directory, 'xtrimpy-{0}.sock'.format(getpass.getuser()))
+
+
+def enabled(single_instance=False):
+    return single_instance or os.environ.get(ENVIRON, '') not in ('', '0')
+
+
+def request(filenames, loader='default'):
+    # message to a running instance; file names are made absolute since its
+    # working directory may differ
+    msg = {"files": [os.path.abspath(fn) for fn in filenames], "loader": loader}
+
+    return (json.dumps(msg) + '\n').encode()
+
+
+def parse_request(data):
+    # (file names, loader name) of a message
+    try:
+        msg = json.loads(data)
+    except ValueError:
+        raise ValueError("Invalid request.")
+    files = msg.get('files') if isinstance(msg, dict) else None
+    loader = msg.get('loader', 'default') if isinstance(msg, dict) else None
+    if not isinstance(files, list) or not all(isinstance(fn, str) for fn in files) or \
+        not isinstance(loader, str):
+        raise ValueError("Invalid request.")
+
+    return files, loader
+
+
+def _connect(path, timeout):
+    # connected socket, or None if no instance listens at path
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        # no socket, or one left by an instance that crashed
+        sock.close()
+        return None
+
+    return sock
+
+
+def running(path=None, timeout=TIMEOUT):
+    sock = _connect(address() if path is None else path, timeout)
+    if sock is None:
+        return False
+    sock.close()
+
+    return True
+
+
+def forward(filenames, loader='default', path=None, timeout=TIMEOUT):
+    # hand the files to a running instance; returns its reply ('ok' or an
+    # error message), or None if there is no instance
+    sock = _connect(address() if path is None else path, timeout)
+    if sock is None:
+        return None
+
+    reply = b''
+    try:
+        sock.sendall(request(filenames, loader))
+        while not reply.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    except OSError as e:
+        return "No reply from the running instance: " + str(e)
+    finally:
+        sock.close()
+
+    return reply.decode().strip()
@@ -0,0 +1,292 @@
+# append-only journal of the session state for crash recovery. Every
+# recorded action appends the difference to the previous state as one JSON
+# line; every checkpoint_every entries the full state is written to a
+# checkpoint and the journal starts over. Files are written by a background
+# thread in batches.
+import os
+import json
+import time
+import queue
+import shutil
+import threading
+import numpy as np
+
+from .workspace import spec_entry, restore_spec, TRANSIENT, jsonable
+
+JOURNAL = 'journal.jsonl'
+CHECKPOINT = 'checkpoint.json'
+
+
+def default_directory():
+    # sessions of this process, ~/.xtrimpy/sessions/<pid>
+    return os.path.join(os.path.expanduser('~'), '.xtrimpy', 'sessions', str(os.getpid()))
+
+
+def session_state(specs, plotting, linelist, gauss_wave=None, gauss_model=None):
+    # JSON-able snapshot of everything needed to restore a session, apart
+    # from the spectrum arrays
+    state = {
+        "specs": [spec_entry(ws, os.getcwd()) for ws in specs],
+        "plotting": {k: v for k, v in plotting.items() if k not in TRANSIENT},
+        "linelist": linelist,
+        "gauss": None if gauss_wave is None or gauss_model is None else [gauss_wave, gauss_model]
+    }
+
+    return json.loads(json.dumps(state, default=jsonable))
+
+
+def _equal(a, b):
+    # equality with NaN == NaN
+    if isinstance(a, float) and isinstance(b, float):
+        return a == b or (a != a and b != b)
+    return type(a) == type(b) and a == b
+
+
+def diff(old, new):
+    # patch turning old into new, None if equal. Patches are {"=": value}
+    # (replace), {"d": {key: patch}, "-": [keys]} (dict) or
+    # {"l": {index: patch}} (list of the same length).
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for k, v in new.items():
+            if k not in old:
+                changes[k] = {"=": v}
+            else:
+                p = diff(old[k], v)
+                if p is not None:
+                    changes[k] = p
+        removed = [k for k in old if k not in new]
+        if len(changes) == 0 and len(removed) == 0:
+            return None
+        patch = {"d": changes}
+        if len(removed) > 0:
+            patch["-"] = removed
+        return patch
+
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        changes = {}
+        for i, (a, b) in enumerate(zip(old, new)):
+            p = diff(a, b)
+            if p is not None:
+                changes[str(i)] = p
+        if len(changes) == 0:
+            return None
+        # replacing short lists is more compact
+        if len(changes) == len(new):
+            return {"=": new}
+        return {"l": changes}
+
+    if _equal(old, new):
+        return None
+
+    return {"=": new}
+
+
+def apply(state, patch):
+    # state with a patch from diff() applied; modifies dicts and lists in place
+    if "=" in patch:
+        return patch["="]
+    if "d" in patch:
+        for k, p in patch["d"].items():
+            state[k] = apply(state.get(k), p)
+        for k in patch.get("-", []):
+            state.pop(k, None)
+        return state
+    if "l" in patch:
+        for i, p in patch["l"].items():
+            state[int(i)] = apply(state[int(i)], p)
+        return state
+
+    raise ValueError("Invalid journal patch.")
+
+
+class journal:
+
+    def __init__(self, directory=None, checkpoint_every=200, flush_interval=0.5):
+
+        self.directory = default_directory() if directory is None else directory
+        self.checkpoint_every = checkpoint_every
+        self.flush_interval = flush_interval
+
+        self.state = None
+        self.seq = 0
+        self.nentries = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        return
+
+    def record(self, action, state):
+        # queue the change of state by an action; returns False if nothing
+        # changed. Called from the GUI thread; state must not be modified
+        # afterwards (session_state() returns a fresh copy).
+        patch = diff(self.state, state)
+        if patch is None:
+            return False
+
+        self.seq += 1
+        self.state = state
+        self.queue.put(('entry', {"seq": self.seq, "time": time.time(), "action": action, "patch": patch}))
+
+        self.nentries += 1
+        if self.nentries >= self.checkpoint_every:
+            self.checkpoint()
+
+        return True
+
+    def checkpoint(self):
+        # queue a checkpoint of the current state
+        if self.state is not None:
+            self.queue.put(('checkpoint', {"seq": self.seq, "time": time.time(), "state": self.state}))
+            self.nentries = 0
+
+        return
+
+    def _write_checkpoint(self, item):
+        # atomic replacement, then a new journal
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(item, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        return open(os.path.join(self.directory, JOURNAL), 'w')
+
+    def _run(self):
+        # writer thread: collects the entries queued within flush_interval
+        # and writes them with one flush
+        f = open(os.path.join(self.directory, JOURNAL), 'a')
+        running = True
+        while running:
+            items = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while items[-1] is not None:
+                try:
+                    items.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+            lines = []
+            for item in items:
+                if item is None:
+                    running = False
+                    break
+                kind, data = item
+                if kind == 'entry':
+                    lines.append(json.dumps(data) + '\n')
+                else:
+                    f.writelines(lines)
+                    lines = []
+                    f.close()
+                    f = self._write_checkpoint(data)
+
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+        f.close()
+
+        return
+
+    def close(self, discard=True):
+        # stop the writer; a clean exit discards the journal
+        self.queue.put(None)
+        self.thread.join()
+        if discard:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+        return
+
+
+def read_journal(directory):
+    # last state in a journal directory: the checkpoint with the later
+    # entries applied. An incomplete last line (a crash while writing) is
+    # ignored. Returns (state, number of entries replayed).
+    state = None
+    seq = 0
+    path = os.path.join(directory, CHECKPOINT)
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        state = checkpoint['state']
+        seq = checkpoint['seq']
+
+    nreplay = 0
+    path = os.path.join(directory, JOURNAL)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry['seq'] <= seq:
+                    continue
+                state = apply(state, entry['patch'])
+                seq = entry['seq']
+                nreplay += 1
+
+    return state, nreplay
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def orphaned_sessions(root=None):
+    # journal directories left behind by processes that are no longer
+    # running, newest first
+    if root is None:
+        root = os.path.dirname(default_directory())
+    if not os.path.isdir(root):
+        return []
+
+    sessions = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.isdigit() or int(name) == os.getpid() or _alive(int(name)):
+            continue
+        if os.path.exists(os.path.join(path, JOURNAL)) or os.path.exists(os.path.join(path, CHECKPOINT)):
+            sessions.append(path)
+
+    return sorted(sessions, key=os.path.getmtime, reverse=True)
+
+
+def _complete_marks(plotting):
+    # plotting without the marks of which only the first point was set, as
+    # in journals written between the two presses by earlier versions
+    plotting = dict(plotting)
+    for k in ('box', 'ew_cont', 'ew_window', 'gauss_lim'):
+        if isinstance(plotting.get(k), list) and any(v is None for v in plotting[k]):
+            plotting[k] = [None] * len(plotting[k])
+
+    return plotting
+
+
+def restore_state(state, search_paths=()):
+    # specs, plotting, linelist, gauss_wave, gauss_model and missing files
+    # of a state from read_journal(); spectra are read on first use
+    specs = []
+    missing = []
+    for entry in state['specs']:
+        ws = restore_spec(entry, os.getcwd(), search_paths=search_paths)
+        if ws is None:
+            missing.append(entry['filename'])
+        else:
+            specs.append(ws)
+
+    gauss_wave, gauss_model = None, None
+    if state.get('gauss') is not None:
+        gauss_wave, gauss_model = np.array(state['gauss'][0]), np.array(state['gauss'][1])
+
+    return specs, _complete_marks(state['plotting']), state['linelist'], gauss_wave, gauss_model, missing
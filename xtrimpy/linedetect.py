@@ -0,0 +1,196 @@
+# automatic detection of emission/absorption lines and redshift proposals
+# from matching them against a line list
+import os
+import glob
+import numpy as np
+
+from .utils import pool_map
+
+
+def matched_filter(resid, weight, sigma_pix):
+    # S/N and amplitude of a Gaussian of sigma_pix pixels centered at every
+    # pixel, for inverse-variance weights (0 for bad pixels)
+    from scipy.ndimage import correlate1d
+
+    half = int(np.ceil(4 * sigma_pix))
+    x = np.arange(-half, half + 1)
+    g = np.exp(-.5 * (x / sigma_pix)**2)
+
+    num = correlate1d(weight * resid, g, mode='constant')
+    den = correlate1d(weight, g**2, mode='constant')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        snr = np.where(den > 0, num / np.sqrt(den), 0.)
+        amp = np.where(den > 0, num / den, 0.)
+
+    return snr, amp
+
+
+def detect_lines(wave, flux, err=None, widths=(1, 2, 4, 8), nsigma=5., cont_width=101):
+    # find significant emission (sign +1) and absorption (sign -1) features
+    # with matched filters of several widths (in pixels) on the
+    # continuum-subtracted spectrum. Returns a dict of arrays sorted in
+    # wavelength: wave, snr, sign, sigma (in wavelength units), amplitude.
+    from scipy.ndimage import median_filter
+
+    wave = np.asarray(wave, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    order = np.argsort(wave)
+    wave = wave[order]
+    flux = flux[order]
+
+    good = np.isfinite(wave) & np.isfinite(flux)
+    if err is not None:
+        err = np.asarray(err, dtype=float)[order]
+        good = good & np.isfinite(err) & (err > 0)
+
+    # running median continuum over the good pixels
+    cont = np.zeros(len(flux))
+    cont[good] = median_filter(flux[good], size=min(cont_width, max(good.sum(), 1)), mode='nearest')
+    resid = np.where(good, flux - cont, 0.)
+
+    if err is not None:
+        weight = np.zeros(len(flux))
+        weight[good] = 1. / err[good]**2
+    else:
+        # uniform noise from the robust scatter of the residual
+        mad = 1.4826 * np.median(np.abs(resid[good])) if np.any(good) else 0.
+        weight = np.where(good, 1. / mad**2 if mad > 0 else 1., 0.)
+
+    # best S/N over the filter widths
+    best_snr = np.zeros(len(flux))
+    best_amp = np.zeros(len(flux))
+    best_width = np.zeros(len(flux))
+    for sigma_pix in widths:
+        snr, amp = matched_filter(resid, weight, sigma_pix)
+        better = np.abs(snr) > np.abs(best_snr)
+        best_snr = np.where(better, snr, best_snr)
+        best_amp = np.where(better, amp, best_amp)
+        best_width = np.where(better, sigma_pix, best_width)
+
+    # local extrema of |S/N| above the threshold
+    a = np.abs(best_snr)
+    ipeak = np.flatnonzero((a[1:-1] >= nsigma) & (a[1:-1] > a[:-2]) & (a[1:-1] >= a[2:])) + 1
+
+    # suppress weaker peaks within two filter widths of a stronger one
+    ipeak = ipeak[np.argsort(a[ipeak])[::-1]]
+    keep = []
+    for i in ipeak:
+        if all(abs(i - j) > 2 * max(best_width[i], best_width[j]) for j in keep):
+            keep.append(i)
+    keep = np.sort(np.array(keep, dtype=int))
+
+    # parabolic refinement of the centers
+    centers = wave[keep].copy()
+    dwave = np.gradient(wave)
+    for k, i in enumerate(keep):
+        denom = a[i-1] - 2 * a[i] + a[i+1]
+        if denom != 0:
+            centers[k] += 0.5 * (a[i-1] - a[i+1]) / denom * dwave[i]
+
+    return {
+        "wave": centers,
+        "snr": best_snr[keep],
+        "sign": np.sign(best_snr[keep]),
+        "sigma": best_width[keep] * dwave[keep],
+        "amplitude": best_amp[keep]
+    }
+
+
+def match_lines(obs_waves, rest_waves, labels=None, tol=5e-4, zmin=0., zmax=10., snr=None, topk=5):
+    # propose redshifts from the detected lines. The log wavelength ratios of
+    # all detected pairs are looked up in the sorted array of the ratios of
+    # all line list pairs; every hit gives a trial redshift, which is then
+    # scored by how many detected lines it explains within tol (in log).
+    obs = np.sort(np.asarray(obs_waves, dtype=float))
+    rest = np.asarray(rest_waves, dtype=float)
+    if labels is None:
+        labels = ['{0:.2f}'.format(w) for w in rest]
+    rorder = np.argsort(rest)
+    rest = rest[rorder]
+    labels = [labels[i] for i in rorder]
+    lnrest = np.log(rest)
+    lnobs = np.log(obs)
+    if snr is None:
+        snr = np.ones(len(obs))
+    else:
+        snr = np.abs(np.asarray(snr, dtype=float))[np.argsort(obs_waves)]
+
+    if len(obs) < 2 or len(rest) < 2:
+        return []
+
+    # sorted ratios of the line list pairs (a < b)
+    ia, ib = np.triu_indices(len(rest), k=1)
+    rratio = lnrest[ib] - lnrest[ia]
+    rorder = np.argsort(rratio)
+    rratio, ia, ib = rratio[rorder], ia[rorder], ib[rorder]
+
+    # every detected pair against the line list ratios
+    oa, ob = np.triu_indices(len(obs), k=1)
+    oratio = lnobs[ob] - lnobs[oa]
+    j0 = np.searchsorted(rratio, oratio - tol, side='left')
+    j1 = np.searchsorted(rratio, oratio + tol, side='right')
+    nhit = j1 - j0
+    if np.sum(nhit) == 0:
+        return []
+    pair = np.repeat(np.arange(len(oa)), nhit)
+    hit = np.concatenate([np.arange(s, e) for s, e in zip(j0, j1) if e > s])
+    lnz = lnobs[oa[pair]] - lnrest[ia[hit]]
+    lnz = lnz[(lnz >= np.log1p(zmin)) & (lnz <= np.log1p(zmax))]
+    if len(lnz) == 0:
+        return []
+
+    # score every trial redshift by the lines it explains
+    shifted = lnobs[None, :] - lnz[:, None]
+    k = np.clip(np.searchsorted(lnrest, shifted), 1, len(rest) - 1)
+    near = np.where(np.abs(shifted - lnrest[k-1]) < np.abs(shifted - lnrest[k]), k - 1, k)
+    matched = np.abs(shifted - lnrest[near]) < tol
+    score = np.sum(matched * snr[None, :], axis=1)
+    nmatch = np.sum(matched, axis=1)
+
+    candidates = []
+    for i in np.lexsort((-score, -nmatch)):
+        # refine with the mean over the matched lines
+        m = matched[i]
+        z = np.expm1(np.mean(lnobs[m] - lnrest[near[i, m]]))
+        if any(abs(np.log1p(z) - np.log1p(c['z'])) < tol for c in candidates):
+            continue
+        candidates.append({
+            "z": z,
+            "nmatch": int(nmatch[i]),
+            "score": score[i],
+            "lines": [(obs[j], labels[near[i, j]]) for j in np.flatnonzero(m)]
+        })
+        if len(candidates) >= topk:
+            break
+
+    return candidates
+
+
+def _detect_file(item):
+    # worker for detect_lines_files(); never raises
+    from .WaveSpec import wavespec
+
+    fn, loader, rest_waves, labels, kwargs, match_kwargs = item
+    try:
+        ws = wavespec.wavespec_obj(fn, loader=loader)
+        lines = detect_lines(ws.wave, ws.spec, ws.error, **kwargs)
+        redshifts = match_lines(lines['wave'], rest_waves, labels=labels, snr=lines['snr'], **match_kwargs)
+        return {"filename": fn, "lines": lines, "redshifts": redshifts, "message": ''}
+    except Exception as e:
+        return {"filename": fn, "lines": None, "redshifts": [], "message": '{0}: {1}'.format(type(e).__name__, e)}
+
+
+def detect_lines_files(fns, loader, rest_waves, labels=None, nproc=None, match_kwargs=None, **kwargs):
+    # detect_lines() and match_lines() over many files in a process pool.
+    # fns is a list of files, a glob pattern or a directory.
+    if isinstance(fns, str):
+        if os.path.isdir(fns):
+            fns = sorted(glob.glob(os.path.join(fns, '*.fits')))
+        else:
+            fns = sorted(glob.glob(fns))
+    if match_kwargs is None:
+        match_kwargs = {}
+
+    items = [(fn, loader, rest_waves, labels, kwargs, match_kwargs) for fn in fns]
+
+    return pool_map(_detect_file, items, nproc=nproc)
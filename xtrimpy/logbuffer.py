@@ -0,0 +1,106 @@
+# bounded store of the log of a session. Records are kept as (time, level,
+# action, message, arguments) and formatted only when they are shown or
+# saved. The oldest records leave a ring buffer of maxlen records in
+# batches; with spill they are appended to a file first (a temporary file if
+# spill is True), so that the whole log can still be saved.
+import re
+import time
+import shutil
+import tempfile
+from collections import deque
+
+MAXLEN = 10000
+
+# GUI messages start with their key, e.g. "'z': ..."
+KEY = re.compile(r"'(.+?)':")
+
+
+def entry(record):
+    # (time, level, action, message, arguments) of a logging record; the
+    # action is the key of GUI messages, otherwise the function that logged
+    msg = record.msg if isinstance(record.msg, str) else str(record.msg)
+    match = KEY.match(msg)
+    action = match.group(1) if match is not None else record.funcName
+
+    return (record.created, record.levelname, action, msg, record.args)
+
+
+def message(e):
+    return e[3] % e[4] if e[4] else e[3]
+
+
+def format_entry(e):
+    # as logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    msecs = int((e[0] - int(e[0])) * 1000)
+    return '{0},{1:03d} - {2} - {3}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(e[0])), \
+                                            msecs, e[1], message(e))
+
+
+class log_buffer:
+
+    def __init__(self, maxlen=MAXLEN, spill=None):
+
+        self.maxlen = maxlen
+        self.entries = deque()
+        self.nspilled = 0       # records written to the spill file
+        self.ndropped = 0       # records discarded without a spill file
+
+        if spill is True:
+            self.spill = tempfile.TemporaryFile('w+', prefix='xtrimpy-log-', suffix='.log')
+        elif spill:
+            self.spill = open(spill, 'w+')
+        else:
+            self.spill = None
+
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def first(self):
+        # number of records before those in memory
+        return self.nspilled + self.ndropped
+
+    @property
+    def total(self):
+        return self.first + len(self.entries)
+
+    def append(self, e):
+        if len(self.entries) >= self.maxlen:
+            self.evict(max(self.maxlen // 4, 1))
+        self.entries.append(e)
+
+        return
+
+    def evict(self, n):
+        # remove the oldest n records, spilled with one write
+        old = [self.entries.popleft() for i in range(min(n, len(self.entries)))]
+        if self.spill is not None:
+            self.spill.seek(0, 2)
+            self.spill.write(''.join(format_entry(e) + '\n' for e in old))
+            self.nspilled += len(old)
+        else:
+            self.ndropped += len(old)
+
+        return
+
+    def save(self, fn):
+        # stream the spilled and the buffered records to a file
+        entries = list(self.entries)
+        with open(fn, 'w') as f:
+            if self.spill is not None:
+                self.spill.flush()
+                self.spill.seek(0)
+                shutil.copyfileobj(self.spill, f)
+            for e in entries:
+                f.write(format_entry(e) + '\n')
+
+        return
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+        return
@@ -0,0 +1,127 @@
+# masks of sky lines, telluric bands and bad regions
+import numpy as np
+
+
+class interval_index:
+    # sorted, merged [start, end) wavelength intervals for fast lookups
+
+    def __init__(self, starts=(), ends=()):
+
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        order = np.argsort(starts)
+        starts = starts[order]
+        ends = ends[order]
+
+        # merge overlapping intervals so that the index stays sorted
+        merged_starts = []
+        merged_ends = []
+        for start, end in zip(starts, ends):
+            if len(merged_ends) > 0 and start <= merged_ends[-1]:
+                merged_ends[-1] = max(merged_ends[-1], end)
+            else:
+                merged_starts.append(start)
+                merged_ends.append(end)
+
+        self.starts = np.array(merged_starts)
+        self.ends = np.array(merged_ends)
+
+        return
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contains(self, wave):
+        # True for wavelengths inside any interval; O(N log M)
+        wave = np.asarray(wave, dtype=float)
+        if len(self.starts) == 0:
+            return np.zeros(wave.shape, dtype=bool)
+        k = np.searchsorted(self.starts, wave, side='right') - 1
+        return (k >= 0) & (wave < self.ends[np.maximum(k, 0)])
+
+    def overlapping(self, w0, w1):
+        # the intervals that overlap [w0, w1)
+        i0 = np.searchsorted(self.ends, w0, side='right')
+        i1 = np.searchsorted(self.starts, w1, side='left')
+        return self.starts[i0:i1], self.ends[i0:i1]
+
+
+def parse_mask_list(line):
+    # "wmin wmax label [frame=obs|rest]"; the observed frame is the default
+    parts = line.strip().split()
+
+    wmin = float(parts[0])
+    wmax = float(parts[1])
+    label = parts[2] if len(parts) > 2 and '=' not in parts[2] else ''
+
+    kwargs = {}
+    for param in parts[2:]:
+        if '=' in param:
+            key, value = param.split('=')
+            kwargs[key.strip()] = value.strip().strip("'\"")
+
+    return wmin, wmax, label, kwargs
+
+
+def read_mask_list(fn):
+    f = open(fn, 'r')
+
+    intervals = []
+    for line in f:
+        if len(line.strip()) == 0 or line.strip().startswith('#'):
+            continue
+        intervals.append(parse_mask_list(line))
+
+    f.close()
+
+    return intervals
+
+
+class mask_list:
+    # observed- and rest-frame mask intervals, applied to spectra once per
+    # redshift
+
+    def __init__(self):
+
+        self.intervals = []     # (wmin, wmax, label, kwargs) as read
+        self.obs = interval_index()
+        self.rest = interval_index()
+        self.version = 0
+
+        return
+
+    def load(self, fn):
+        # add the intervals of a mask file
+        self.intervals = self.intervals + read_mask_list(fn)
+        self.rebuild()
+
+        return
+
+    def clear(self):
+        self.intervals = []
+        self.rebuild()
+
+        return
+
+    def rebuild(self):
+        obs = [iv for iv in self.intervals if iv[3].get('frame', 'obs') != 'rest']
+        rest = [iv for iv in self.intervals if iv[3].get('frame', 'obs') == 'rest']
+        self.obs = interval_index([iv[0] for iv in obs], [iv[1] for iv in obs])
+        self.rest = interval_index([iv[0] for iv in rest], [iv[1] for iv in rest])
+        self.version += 1
+
+        return
+
+    def build(self, wave, redshift):
+        # boolean mask for observed wavelengths at the redshift
+        return self.obs.contains(wave) | self.rest.contains(np.asarray(wave) / (1 + redshift))
+
+    def apply(self, wavespec, redshift):
+        # set the mask of a spectrum unless it is already up to date
+        key = (id(self), self.version, redshift, wavespec.addredshift)
+        if getattr(wavespec, 'mask_key', None) == key:
+            return
+        wavespec.set_mask(self.build(wavespec.wave * (1 + wavespec.addredshift), redshift))
+        wavespec.mask_key = key
+
+        return
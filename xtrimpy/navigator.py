@@ -0,0 +1,198 @@
+# overview strip under the main plot: min/max thumbnails of all spectra over
+# their full wavelength range and a rectangle for the plotting range. The
+# thumbnails are only redrawn when the displayed spectra change; moving the
+# rectangle restores the saved background and blits it. Dragging the
+# rectangle (or clicking next to it) moves the plotting range, double-click
+# shows the full range.
+import numpy as np
+from PyQt5.QtCore import Qt, QTimer
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+
+NBINS = 512
+
+
+class navigator:
+
+    def __init__(self, gui, height=70):
+
+        self.gui = gui
+        self.session = gui.session
+
+        self.figure = Figure()
+        self.canvas = FigureCanvas(self.figure)
+        self.canvas.setFixedHeight(height)
+        # keys stay with the main plot
+        self.canvas.setFocusPolicy(Qt.NoFocus)
+        # aligned with the main axes
+        self.ax = self.figure.add_axes([0.125, 0.04, 0.775, 0.92])
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+
+        self.rect = Rectangle((0, 0), 0, 1, transform=self.ax.get_xaxis_transform(), \
+                              facecolor='grey', edgecolor='k', alpha=0.3, animated=True)
+        self.ax.add_patch(self.rect)
+        self.background = None
+        self.drawn = None       # displayed spectra of the thumbnails
+        self.extent = None      # (x0, x1) of all spectra
+
+        self.start = None       # plotting range before a drag
+        self.drag = None        # offset of the press from the left edge
+        self.pending = False
+
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.mpl_connect('button_press_event', self.on_press)
+        self.canvas.mpl_connect('motion_notify_event', self.on_motion)
+        self.canvas.mpl_connect('button_release_event', self.on_release)
+
+        return
+
+    def signature(self):
+        # what the thumbnails depend on
+        return (self.session.plotting.get('normalize', False), self.session.plotting['redshift'], \
+                tuple((id(ws), getattr(ws, 'version', 0), ws.smooth_width, id(ws.mask), ws.addredshift, \
+                       ws.mult, ws.add, ws.color) for ws in self.session.specs))
+
+    def refresh(self):
+        # after a session action: redraw the thumbnails if the spectra
+        # changed, otherwise only move the rectangle
+        signature = self.signature()
+        if signature != self.drawn:
+            self.drawn = signature
+            self.draw_thumbnails()
+        else:
+            self.blit()
+
+        return
+
+    def draw_thumbnails(self):
+        self.ax.cla()
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+        self.ax.add_patch(self.rect)
+        self.extent = None
+
+        if len(self.session.specs) > 0:
+            self.session.apply_masks()
+            xmin, xmax, ymin, ymax = np.inf, -np.inf, np.inf, -np.inf
+            for ws in self.session.specs:
+                wave, lo, hi = self.session.thumbnail_of(ws, NBINS)
+                wave = wave * (ws.addredshift + 1)
+                lo, hi = lo * ws.mult + ws.add, hi * ws.mult + ws.add
+                if ws.mult < 0:
+                    lo, hi = hi, lo
+                good = np.isfinite(lo) & np.isfinite(hi)
+                if not np.any(good):
+                    continue
+                self.ax.fill_between(wave, lo, hi, step='mid', color=ws.color, lw=0.5, alpha=0.8)
+                xmin, xmax = min(xmin, np.min(wave)), max(xmax, np.max(wave))
+                ymin, ymax = min(ymin, np.min(lo[good])), max(ymax, np.max(hi[good]))
+
+            if np.isfinite(xmin):
+                dy = 0.05 * (ymax - ymin) if ymax > ymin else 0.5
+                self.ax.set_xlim(xmin, xmax)
+                self.ax.set_ylim(ymin - dy, ymax + dy)
+                self.extent = (xmin, xmax)
+
+        # the background is saved by on_draw
+        self.canvas.draw()
+
+        return
+
+    def on_draw(self, event):
+        # background without the rectangle, e.g. after a resize
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_rect()
+
+        return
+
+    def draw_rect(self):
+        box = self.session.plotting['box']
+        visible = self.extent is not None and box[0] is not None and box[2] is not None
+        self.rect.set_visible(visible)
+        if visible:
+            self.rect.set_x(box[0])
+            self.rect.set_width(box[2] - box[0])
+            self.ax.draw_artist(self.rect)
+
+        return
+
+    def blit(self):
+        if self.background is None:
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_rect()
+        self.canvas.blit(self.ax.bbox)
+
+        return
+
+    # -- navigation
+
+    def on_press(self, event):
+        box = self.session.plotting['box']
+        if event.inaxes is not self.ax or event.button != 1 or self.extent is None or \
+            any(v is None for v in box):
+            return
+        if self.session.plotting['blocking'] is not None:
+            # a mark in progress, e.g. the other corner of the zoom box
+            return
+
+        if event.dblclick:
+            # full wavelength range
+            self.drag = None
+            self.session.set_box(self.extent[0], box[1], self.extent[1], box[3])
+            return
+
+        self.start = list(box)
+        if box[0] <= event.xdata <= box[2]:
+            self.drag = event.xdata - box[0]
+        else:
+            # jump with the center to the click
+            self.drag = 0.5 * (box[2] - box[0])
+            self.move(event.xdata)
+
+        return
+
+    def on_motion(self, event):
+        if self.drag is None or event.xdata is None:
+            return
+        self.move(event.xdata)
+
+        return
+
+    def on_release(self, event):
+        if self.drag is None:
+            return
+        self.drag = None
+        # the whole drag is one action; the range was set directly
+        box = self.session.plotting['box']
+        end = list(box)
+        box[:] = self.start
+        self.session.set_box(*end)
+
+        return
+
+    def move(self, x):
+        # move the plotting range during a drag, without an action for every
+        # step; the main plot is redrawn once per event loop iteration
+        box = self.session.plotting['box']
+        width = box[2] - box[0]
+        box[0] = x - self.drag
+        box[2] = box[0] + width
+        self.blit()
+        if not self.pending:
+            self.pending = True
+            QTimer.singleShot(0, self.redraw_main)
+
+        return
+
+    def redraw_main(self):
+        # only the x range of the main plot changes while dragging; its
+        # artists cover the full spectra, and the release redraws them
+        self.pending = False
+        box = self.session.plotting['box']
+        self.gui.ax.set_xlim(box[0], box[2])
+        self.gui.canvas.draw()
+
+        return
@@ -0,0 +1,355 @@
+# QA sheets: pages with one panel per spectrum, with the line list at the
+# redshift of the spectrum and its trim lines. The panels are drawn in a
+# process pool, each worker on its own Agg figure from decimated data, and
+# pages are assembled in order and written as soon as they are complete
+# (one multi-page PDF, or one PNG per page), so that only a few pages of
+# panels are in memory for any number of spectra. Nothing here imports Qt.
+import os
+import csv
+import zlib
+import numpy as np
+
+from .WaveSpec import wavespec
+from .utils import pool_imap
+
+# panels per page (rows, columns), page size in inches (A4) and resolution
+LAYOUT = (4, 2)
+PAGESIZE = (8.27, 11.69)
+DPI = 150
+# points per panel after decimation
+MAXPOINTS = 2000
+# line list style, as in the GUI
+LINELIST_DEFAULTS = {
+    "ls": '--',
+    "color": 'lightblue'
+}
+# redshift columns of a redshift table, e.g. the output of `batch detect`
+REDSHIFT_COLUMNS = ('z', 'redshift', 'z0')
+
+# figure of this process, made by _start_worker()
+_worker = {}
+
+
+def decimate(wave, flux, error=None, npoints=MAXPOINTS):
+    # about npoints samples: the minimum and maximum of each bin in their
+    # order, so that lines and spikes are kept
+    n = len(wave)
+    k = int(np.ceil(2 * n / npoints))
+    if k <= 2:
+        return wave, flux, error
+
+    nbin = -(-n // k)
+    padded = np.full(nbin * k, np.nan)
+    padded[:n] = flux
+    padded = padded.reshape(nbin, k)
+    good = np.isfinite(padded)
+    imin = np.argmin(np.where(good, padded, np.inf), axis=1)
+    imax = np.argmax(np.where(good, padded, -np.inf), axis=1)
+    index = np.arange(nbin)[:, None] * k + np.sort(np.stack([imin, imax], axis=1), axis=1)
+    index = np.minimum(index, n - 1).ravel()
+
+    flux = np.asarray(flux, dtype=float)[index]
+    # empty bins stay gaps
+    flux[np.repeat(~np.any(good, axis=1), 2)] = np.nan
+    if error is not None:
+        error = np.asarray(error)[index]
+
+    return np.asarray(wave)[index], flux, error
+
+
+def file_item(fn, loader, redshift=0., trim_lines=(), smooth=0, addredshift=0., mult=1., add=0., \
+              label=None, color=None):
+    # panel of a spectrum file, read by the worker
+    return {
+        "filename": fn,
+        "loader": loader,
+        "data": None,
+        "label": os.path.basename(fn) if label is None else label,
+        "color": color,
+        "redshift": float(redshift),
+        "trim_lines": [float(w) for w in trim_lines],
+        "smooth": int(smooth),
+        "addredshift": float(addredshift),
+        "mult": float(mult),
+        "add": float(add)
+    }
+
+
+def session_items(sess):
+    # panels of the spectra of a session as displayed, with its redshift and
+    # trim lines; the data are decimated here, so that spectra that only
+    # exist in the session (e.g. extractions) are drawn the same way
+    items = []
+    for ws in sess.specs:
+        item = file_item(ws.filename, None, redshift=sess.plotting['redshift'], \
+                         trim_lines=sess.plotting['trim_lines'], label=ws.label, color=ws.color)
+        item['data'] = decimate(*sess.displayed(ws))
+        items.append(item)
+
+    return items
+
+
+def read_redshifts(fn):
+    # {filename: (redshift, trim lines)} from a CSV or FITS table with a
+    # filename column, a redshift column and optionally a trim_lines column
+    # of space-separated wavelengths. Files are also matched by base name.
+    if os.path.splitext(fn)[1].lower() in ('.fits', '.fit', '.fts'):
+        from astropy.table import Table
+
+        table = Table.read(fn)
+        rows = [{name: row[name] for name in table.colnames} for row in table]
+    else:
+        with open(fn, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    columns = rows[0].keys() if len(rows) > 0 else ()
+    zcolumn = next((name for name in REDSHIFT_COLUMNS if name in columns), None)
+    if 'filename' not in columns or zcolumn is None:
+        raise ValueError("{0} needs a filename column and one of the columns {1}.".format( \
+            fn, ', '.join(REDSHIFT_COLUMNS)))
+
+    redshifts = {}
+    for row in rows:
+        try:
+            z = float(row[zcolumn])
+        except (TypeError, ValueError):
+            z = np.nan
+        trim_lines = [float(w) for w in str(row.get('trim_lines') or '').split()]
+        name = str(row['filename']).strip()
+        redshifts[name] = (z, trim_lines)
+        redshifts.setdefault(os.path.basename(name), (z, trim_lines))
+
+    return redshifts
+
+
+def lookup_redshift(redshifts, fn, default=(0., [])):
+    return redshifts.get(fn, redshifts.get(os.path.basename(fn), default))
+
+
+def _start_worker(linelist, panelsize, dpi):
+    # pool initializer: one figure per process, reused for every panel
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=panelsize, dpi=dpi)
+    _worker['canvas'] = FigureCanvasAgg(figure)
+    _worker['ax'] = figure.add_axes([0.09, 0.17, 0.88, 0.72])
+    _worker['linelist'] = linelist
+
+
+def _load(item):
+    # displayed (wave, flux, error) of a panel, decimated
+    if item['data'] is not None:
+        return item['data']
+
+    ws = wavespec.wavespec_obj(item['filename'], loader=item['loader'])
+    ws.smooth(item['smooth'])
+    wave = ws.wave * (1 + item['addredshift'])
+    flux = ws.spec_display * item['mult'] + item['add']
+    error = None if ws.error_display is None else ws.error_display * item['mult']
+
+    return decimate(wave, flux, error)
+
+
+def _draw(ax, item, linelist):
+    wave, flux, error = _load(item)
+    color = 'k' if item['color'] is None else item['color']
+    ax.step(wave, flux, where='mid', color=color, lw=0.6)
+    if error is not None:
+        ax.fill_between(wave, flux - error, flux + error, step='mid', color=color, alpha=0.25, lw=0)
+    ax.axhline(0, color='k', ls=':', lw=0.5)
+
+    x0, x1 = np.nanmin(wave), np.nanmax(wave)
+    finite = flux[np.isfinite(flux)]
+    if len(finite) > 0:
+        # robust limits, not set by single bad pixels
+        y0, y1 = np.percentile(finite, [0.5, 99.5])
+        margin = 0.1 * (y1 - y0) if y1 > y0 else 1.
+        ax.set_ylim(y0 - margin, y1 + margin)
+    ax.set_xlim(x0, x1)
+    ytop = ax.get_ylim()[1]
+
+    z = item['redshift']
+    if np.isfinite(z):
+        for w, label, kwargs in zip(linelist['waves'], linelist['labels'], linelist['kwargs']):
+            if x0 <= w * (1 + z) <= x1:
+                kwargs = {**LINELIST_DEFAULTS, **kwargs}
+                ax.axvline(w * (1 + z), lw=0.8, **kwargs)
+                ax.text(w * (1 + z), ytop, label, rotation=90, ha='right', va='top', \
+                        color=kwargs['color'], fontsize=5)
+    for tl in item['trim_lines']:
+        ax.axvline(tl, color='red', lw=0.8)
+
+    ax.text(0.99, 1.02, 'z = {0:.5f}'.format(z), ha='right', va='bottom', fontsize=7, transform=ax.transAxes)
+
+
+def draw_panel(item):
+    # worker: RGB image of the panel of one spectrum and an error message;
+    # never raises, failures are drawn into the panel
+    ax = _worker['ax']
+    ax.cla()
+    message = ''
+    try:
+        _draw(ax, item, _worker['linelist'])
+    except Exception as e:
+        message = '{0}: {1}'.format(type(e).__name__, e)
+        ax.text(0.5, 0.5, message, ha='center', va='center', color='red', fontsize=7, \
+                wrap=True, transform=ax.transAxes)
+    ax.set_title(item['label'], loc='left', fontsize=7)
+    ax.tick_params(labelsize=6)
+    canvas = _worker['canvas']
+    canvas.draw()
+
+    return np.asarray(canvas.buffer_rgba())[..., :3].copy(), message
+
+
+class pdf_writer:
+    # PDF file of one RGB image per page (lossless, Flate compressed) that is
+    # written page by page: only the object offsets are kept until close().
+    # matplotlib's PDF backend keeps all images until the file is closed.
+
+    def __init__(self, fn, dpi=DPI):
+
+        self.file = open(fn, 'wb')
+        self.dpi = dpi
+        # objects 1 and 2, the catalog and the page tree, are written last
+        self.offsets = [None, None]
+        self.pages = []
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+        return
+
+    def _object(self, content, stream=None, number=None):
+        if number is None:
+            self.offsets.append(None)
+            number = len(self.offsets)
+        self.offsets[number - 1] = self.file.tell()
+        self.file.write(b'%d 0 obj\n' % number + content)
+        if stream is not None:
+            self.file.write(b'\nstream\n' + stream + b'\nendstream')
+        self.file.write(b'\nendobj\n')
+
+        return number
+
+    def add_page(self, image):
+        height, width = image.shape[:2]
+        data = zlib.compress(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+        ximage = self._object(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB '
+                              b'/BitsPerComponent 8 /Filter /FlateDecode /Length %d >>' % (width, height, len(data)), \
+                              stream=data)
+        # the image scaled to the page, in points
+        size = b'%.2f 0 0 %.2f 0 0' % (width * 72. / self.dpi, height * 72. / self.dpi)
+        contents = b'q ' + size + b' cm /Im0 Do Q'
+        contents = self._object(b'<< /Length %d >>' % len(contents), stream=contents)
+        self.pages.append(self._object(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+                                       b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>' % \
+                                       (width * 72. / self.dpi, height * 72. / self.dpi, ximage, contents)))
+        self.file.flush()
+
+        return
+
+    def close(self):
+        kids = b' '.join(b'%d 0 R' % n for n in self.pages)
+        self._object(b'<< /Type /Pages /Kids [' + kids + b'] /Count %d >>' % len(self.pages), number=2)
+        self._object(b'<< /Type /Catalog /Pages 2 0 R >>', number=1)
+        xref = self.file.tell()
+        self.file.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(self.offsets) + 1))
+        self.file.write(b''.join(b'%010d 00000 n \n' % offset for offset in self.offsets))
+        self.file.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % \
+                        (len(self.offsets) + 1, xref))
+        self.file.close()
+
+        return
+
+
+class sheet_writer:
+    # pages of panels in rows and columns, written as they are complete:
+    # to one PDF file, or to <name>_001.png, <name>_002.png, ... otherwise
+
+    def __init__(self, fn, layout=LAYOUT, pagesize=PAGESIZE, dpi=DPI):
+
+        self.fn = fn
+        self.layout = layout
+        self.pagesize = pagesize
+        self.dpi = dpi
+        self.npages = 0
+        self.page = None
+        self.npanels = 0
+        self.pdf = None
+        if os.path.splitext(fn)[1].lower() == '.pdf':
+            self.pdf = pdf_writer(fn, dpi=dpi)
+
+        return
+
+    def panelsize(self):
+        # panel size in inches
+        return self.pagesize[0] / self.layout[1], self.pagesize[1] / self.layout[0]
+
+    def add(self, panel):
+        nrows, ncols = self.layout
+        if self.page is None:
+            self.page = np.full((int(round(self.pagesize[1] * self.dpi)), \
+                                 int(round(self.pagesize[0] * self.dpi)), 3), 255, dtype=np.uint8)
+        row, col = divmod(self.npanels, ncols)
+        height, width = self.page.shape[0] // nrows, self.page.shape[1] // ncols
+        panel = panel[:height, :width]
+        self.page[row * height:row * height + panel.shape[0], col * width:col * width + panel.shape[1]] = panel
+        self.npanels += 1
+        if self.npanels == nrows * ncols:
+            self.write_page()
+
+        return
+
+    def write_page(self):
+        if self.page is None:
+            return
+        self.npages += 1
+        if self.pdf is not None:
+            self.pdf.add_page(self.page)
+        else:
+            import matplotlib.image
+
+            base, ext = os.path.splitext(self.fn)
+            matplotlib.image.imsave('{0}_{1:03d}{2}'.format(base, self.npages, ext or '.png'), \
+                                    self.page, dpi=self.dpi)
+        self.page = None
+        self.npanels = 0
+
+        return
+
+    def close(self):
+        self.write_page()
+        if self.pdf is not None:
+            self.pdf.close()
+
+        return
+
+
+def write_sheets(items, output, linelist, layout=LAYOUT, pagesize=PAGESIZE, dpi=DPI, nproc=None, \
+                 progress=None):
+    # draw the panels of items (file_item() or session_items()) in a process
+    # pool and write the pages in order. progress(ndone, ntotal, message) is
+    # called after each panel; returning False stops. Returns the number of
+    # pages and of panels that failed.
+    writer = sheet_writer(output, layout=layout, pagesize=pagesize, dpi=dpi)
+    if nproc is None:
+        nproc = os.cpu_count() or 1
+    nproc = min(nproc, max(len(items), 1))
+    # panels being drawn or held back for the page order: a page or two
+    # processes each, whichever is more
+    max_pending = max(layout[0] * layout[1], 2 * nproc)
+    results = pool_imap(draw_panel, items, nproc=nproc, initializer=_start_worker, \
+                        initargs=(linelist, writer.panelsize(), dpi), max_pending=max_pending, ordered=True)
+    nfail = 0
+    try:
+        for n, (i, (panel, message)) in enumerate(results):
+            writer.add(panel)
+            if message:
+                nfail += 1
+            if progress is not None and progress(n + 1, len(items), message) is False:
+                break
+    finally:
+        results.close()
+        writer.close()
+
+    return writer.npages, nfail
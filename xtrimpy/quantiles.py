@@ -0,0 +1,151 @@
+# precomputed block quantile summaries for viewport-aware autoscaling, and
+# min/max thumbnails for the overview
+import numpy as np
+
+
+class quantile_sketch:
+    # multi-level block summaries of one spectrum. Level 0 summarizes blocks
+    # of `block` pixels (in wavelength order) by the quantiles at the centers
+    # of equal-mass bins, finer in the tails, and a count of finite pixels;
+    # each further level groups `fanout` times more pixels.
+    # A wavelength range is covered by the coarsest blocks that fit inside
+    # it, finer blocks near its ends and raw pixels at the very ends.
+
+    def __init__(self, wave, values, block=256, fanout=16, tail=0.04, ntail=16, ncore=46):
+
+        wave = np.asarray(wave)
+        if np.all(np.diff(wave) >= 0):
+            self.wave = wave
+            self.values = values
+        else:
+            order = np.argsort(wave)
+            self.wave = wave[order]
+            self.values = np.asarray(values)[order]
+        self.n = len(self.wave)
+        edges = np.concatenate([np.linspace(0, tail, ntail + 1), \
+                                np.linspace(tail, 1 - tail, ncore + 1)[1:-1], \
+                                np.linspace(1 - tail, 1, ntail + 1)])
+        self.quantiles = 50 * (edges[1:] + edges[:-1])
+        self.mass = np.diff(edges)
+
+        self.sizes = []
+        self.q = []
+        self.count = []
+        size = block
+        while True:
+            nblock = int(np.ceil(self.n / size))
+            pack = np.full(nblock * size, np.nan)
+            pack[:self.n] = self.values
+            # NaNs sort to the end of each block
+            pack = np.sort(pack.reshape(nblock, size), axis=1)
+            count = np.sum(np.isfinite(pack), axis=1)
+            pos = np.outer(np.maximum(count - 1, 0), self.quantiles / 100)
+            lo = np.floor(pos).astype(int)
+            hi = np.minimum(lo + 1, np.maximum(count - 1, 0)[:, None])
+            frac = pos - lo
+            q = (1 - frac) * np.take_along_axis(pack, lo, axis=1) + frac * np.take_along_axis(pack, hi, axis=1)
+
+            self.sizes.append(size)
+            self.q.append(q)
+            self.count.append(count)
+            if nblock <= 1:
+                break
+            size *= fanout
+
+        return
+
+    def _cover(self, i0, i1, level, blocks, raw):
+        # split the pixel range [i0, i1) into whole blocks and raw pixels
+        if i0 >= i1:
+            return
+        if level < 0:
+            raw.append((i0, i1))
+            return
+
+        size = self.sizes[level]
+        b0 = -(-i0 // size)
+        b1 = int(np.ceil(self.n / size)) if i1 == self.n else i1 // size
+        if b0 >= b1:
+            self._cover(i0, i1, level - 1, blocks, raw)
+            return
+
+        blocks.append((level, b0, b1))
+        self._cover(i0, b0 * size, level - 1, blocks, raw)
+        self._cover(min(b1 * size, self.n), i1, level - 1, blocks, raw)
+
+    def samples(self, x0, x1):
+        # weighted samples that represent the values within [x0, x1]
+        i0, i1 = np.searchsorted(self.wave, [x0, x1], side='left')
+        blocks = []
+        raw = []
+        self._cover(i0, i1, len(self.sizes) - 1, blocks, raw)
+
+        values = []
+        weights = []
+        for level, b0, b1 in blocks:
+            q = self.q[level][b0:b1]
+            values.append(q.ravel())
+            weights.append(np.outer(self.count[level][b0:b1], self.mass).ravel())
+        for r0, r1 in raw:
+            v = self.values[r0:r1]
+            values.append(v)
+            weights.append(np.ones(len(v)))
+
+        if len(values) == 0:
+            return np.array([]), np.array([])
+        values = np.concatenate(values)
+        weights = np.concatenate(weights)
+        good = np.isfinite(values) & (weights > 0)
+
+        return values[good], weights[good]
+
+
+def weighted_quantile(values, weights, q):
+    # quantiles q (in percent) of weighted samples
+    if len(values) == 0:
+        return np.full(len(np.atleast_1d(q)), np.nan)
+    order = np.argsort(values)
+    values = values[order]
+    cumw = np.cumsum(weights[order])
+    centers = cumw - 0.5 * weights[order]
+
+    return np.interp(np.asarray(q) / 100 * cumw[-1], centers, values)
+
+
+def viewport_quantiles(sketches, x0, x1, q=(1, 99)):
+    # quantiles of the displayed values of several spectra within [x0, x1].
+    # sketches is a list of (sketch, wavelength factor, mult, add), where
+    # the displayed wavelength is wave * factor and the displayed value is
+    # value * mult + add.
+    values = []
+    weights = []
+    for sketch, factor, mult, add in sketches:
+        v, w = sketch.samples(x0 / factor, x1 / factor)
+        values.append(v * mult + add)
+        weights.append(w)
+
+    if len(values) == 0:
+        return np.full(len(q), np.nan)
+
+    return weighted_quantile(np.concatenate(values), np.concatenate(weights), q)
+
+
+def thumbnail(wave, values, nbins=512):
+    # (wave, min, max) of nbins blocks of pixels in wavelength order, at the
+    # mean wavelength of each block; NaN for blocks without finite values.
+    # Short spectra are returned as they are.
+    wave = np.asarray(wave, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if np.any(np.diff(wave) < 0):
+        order = np.argsort(wave)
+        wave, values = wave[order], values[order]
+    if len(wave) <= 2 * nbins:
+        return wave, values, values
+
+    starts = np.linspace(0, len(wave), nbins + 1).astype(int)[:-1]
+    counts = np.diff(np.append(starts, len(wave)))
+    # fmin/fmax skip NaN unless a block has nothing else
+    lo = np.fmin.reduceat(values, starts)
+    hi = np.fmax.reduceat(values, starts)
+
+    return np.add.reduceat(wave, starts) / counts, lo, hi
@@ -0,0 +1,364 @@
+# automated redshift estimates from templates
+import numpy as np
+
+from .utils import C_KMS, pool_map
+
+DLNL = 5e-5     # default log-lambda step, ~15 km/s
+
+
+class template_obj:
+    # a cross-correlation template on the global log-lambda grid
+    # exp(i * dlnl), starting at pixel index i0 in the rest frame
+
+    def __init__(self, name, i0, flux, dlnl=DLNL):
+
+        self.name = name
+        self.i0 = i0
+        self.flux = flux
+        self.dlnl = dlnl
+
+        return
+
+
+def resample_loglam(wave, flux, dlnl=DLNL, err=None):
+    # resample a spectrum to the global log-lambda grid. Returns the index of
+    # the first pixel, the flux and a 0/1 weight that is 0 in gaps and NaNs.
+    wave = np.asarray(wave, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(wave) & np.isfinite(flux) & (wave > 0)
+    if err is not None:
+        err = np.asarray(err, dtype=float)
+        good = good & np.isfinite(err) & (err > 0)
+    if not np.any(good):
+        # no data: no weight anywhere, chi2 0 with npix 0
+        return np.zeros(len(wave)), np.zeros(len(wave))
+
+    order = np.argsort(wave[good])
+    lnw = np.log(wave[good][order])
+    f = flux[good][order]
+
+    i0 = int(np.ceil(lnw[0] / dlnl))
+    i1 = int(np.floor(lnw[-1] / dlnl))
+    lngrid = np.arange(i0, i1 + 1) * dlnl
+
+    fgrid = np.interp(lngrid, lnw, f)
+    # pixels that fall in gaps wider than a few native pixels get no weight
+    dnative = np.median(np.diff(lnw))
+    gap = np.diff(lnw) > 3 * dnative
+    j = np.clip(np.searchsorted(lnw, lngrid) - 1, 0, len(gap) - 1)
+    weight = np.where(gap[j], 0., 1.)
+
+    if err is not None:
+        # down-weight noisy regions by the inverse error
+        egrid = np.interp(lngrid, lnw, err[good][order])
+        weight = weight * np.median(egrid) / egrid
+
+    return i0, fgrid, weight
+
+
+def highpass(flux, weight, width):
+    # subtract a weighted running mean of the given width in pixels
+    from scipy.ndimage import uniform_filter1d
+
+    width = max(int(width), 3)
+    num = uniform_filter1d(flux * (weight > 0), width, mode='nearest')
+    den = uniform_filter1d((weight > 0).astype(float), width, mode='nearest')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cont = np.where(den > 0, num / den, 0.)
+
+    return (flux - cont) * weight
+
+
+def taper(n, frac=0.05):
+    # cosine bell that apodizes the ends of an array of length n
+    w = np.ones(n)
+    m = max(int(frac * n), 1)
+    ramp = 0.5 * (1 - np.cos(np.pi * (np.arange(m) + 0.5) / m))
+    w[:m] = ramp
+    w[n-m:] = ramp[::-1]
+
+    return w
+
+
+def linelist_template(rest_waves, dlnl=DLNL, sigma_kms=100., amplitudes=None, name='line list'):
+    # synthetic emission line spectrum from a line list
+    rest_waves = np.asarray(rest_waves, dtype=float)
+    if amplitudes is None:
+        amplitudes = np.ones(len(rest_waves))
+    sig = sigma_kms / C_KMS
+
+    i0 = int(np.floor((np.log(rest_waves.min()) - 10 * sig) / dlnl))
+    i1 = int(np.ceil((np.log(rest_waves.max()) + 10 * sig) / dlnl))
+    lngrid = np.arange(i0, i1 + 1) * dlnl
+
+    flux = np.zeros(len(lngrid))
+    for w, a in zip(np.log(rest_waves), amplitudes):
+        j0, j1 = np.searchsorted(lngrid, [w - 6 * sig, w + 6 * sig])
+        flux[j0:j1] += a * np.exp(-.5 * ((lngrid[j0:j1] - w) / sig)**2)
+
+    return template_obj(name, i0, flux - flux.mean(), dlnl=dlnl)
+
+
+def spectrum_template(wave, flux, dlnl=DLNL, highpass_kms=3000., name='spectrum'):
+    # template from a rest-frame spectrum, e.g. a BPASS model loaded with
+    # sloader.BPASSv23
+    i0, f, weight = resample_loglam(wave, flux, dlnl=dlnl)
+    f = highpass(f, weight, highpass_kms / C_KMS / dlnl)
+
+    return template_obj(name, i0, f, dlnl=dlnl)
+
+
+def xcorr(wave, flux, template, err=None, highpass_kms=3000.):
+    # normalized cross-correlation of a spectrum with a template via FFT.
+    # Returns the trial redshifts (increasing) and the correlation.
+    dlnl = template.dlnl
+    i0, f, weight = resample_loglam(wave, flux, dlnl=dlnl, err=err)
+    f = highpass(f, weight, highpass_kms / C_KMS / dlnl) * taper(len(f))
+    t = template.flux * taper(len(template.flux))
+
+    na, nb = len(f), len(t)
+    nfft = 1 << int(np.ceil(np.log2(na + nb)))
+    cc = np.fft.irfft(np.fft.rfft(f, nfft) * np.conj(np.fft.rfft(t, nfft)), nfft)
+    norm = np.sqrt(np.sum(f**2) * np.sum(t**2))
+    if norm > 0:
+        cc = cc / norm
+
+    # lag m shifts template pixel n onto spectrum pixel n + m
+    lags = np.arange(-(nb - 1), na)
+    cc = cc[lags % nfft]
+    z = np.exp((i0 - template.i0 + lags) * dlnl) - 1
+
+    return z, cc
+
+
+def find_peaks(z, cc, topk=5, min_sep=10):
+    # the topk highest local maxima separated by at least min_sep pixels,
+    # refined with a parabola. Significance is the peak height above the
+    # median in units of the robust scatter of the correlation.
+    if len(cc) < 3:
+        return []
+    med = np.median(cc)
+    mad = 1.4826 * np.median(np.abs(cc - med))
+
+    imax = np.flatnonzero((cc[1:-1] > cc[:-2]) & (cc[1:-1] >= cc[2:])) + 1
+    imax = imax[np.argsort(cc[imax])[::-1]]
+
+    peaks = []
+    taken = []
+    for i in imax:
+        if len(peaks) >= topk:
+            break
+        if any(abs(i - j) < min_sep for j in taken):
+            continue
+        taken.append(i)
+
+        # parabolic refinement in pixel space
+        denom = cc[i-1] - 2 * cc[i] + cc[i+1]
+        shift = 0.5 * (cc[i-1] - cc[i+1]) / denom if denom != 0 else 0.
+        lnz = np.interp(i + shift, np.arange(len(z)), np.log1p(z))
+        peaks.append({
+            "z": np.expm1(lnz),
+            "cc": cc[i],
+            "significance": (cc[i] - med) / mad if mad > 0 else np.inf
+        })
+
+    return peaks
+
+
+def xcorr_redshift(wave, flux, templates, err=None, zmin=0., zmax=10., topk=5, highpass_kms=3000.):
+    # top-k redshift solutions over all templates, by significance
+    if isinstance(templates, template_obj):
+        templates = [templates]
+
+    peaks = []
+    for template in templates:
+        z, cc = xcorr(wave, flux, template, err=err, highpass_kms=highpass_kms)
+        inrange = (z >= zmin) & (z <= zmax)
+        for peak in find_peaks(z[inrange], cc[inrange], topk=topk):
+            peak['template'] = template.name
+            peaks.append(peak)
+
+    peaks.sort(key=lambda peak: peak['significance'], reverse=True)
+
+    return peaks[:topk]
+
+
+def _xcorr_item(item):
+    # worker for xcorr_redshift_batch()
+    wave, flux, err, templates, kwargs = item
+    try:
+        return xcorr_redshift(wave, flux, templates, err=err, **kwargs)
+    except Exception:
+        return []
+
+
+def xcorr_redshift_batch(wavespecs, templates, nproc=None, **kwargs):
+    # xcorr_redshift() for many spectra in a process pool. Spectra that
+    # cannot be cross-correlated get an empty list of peaks.
+    items = []
+    for ws in wavespecs:
+        items.append((ws.wave * (1 + ws.addredshift), ws.spec_display, ws.error_display, templates, kwargs))
+
+    return pool_map(_xcorr_item, items, nproc=nproc)
+
+
+def zgrid_loglam(zmin, zmax, dlnl):
+    # trial redshifts evenly spaced in log(1+z)
+    return np.expm1(np.arange(np.log1p(zmin), np.log1p(zmax) + dlnl / 2, dlnl))
+
+
+def template_grid(twave, tflux, wave, zgrid):
+    # the template resampled onto the sorted wavelengths wave at every trial
+    # redshift, (nz, npix). Pixels not covered by the redshifted template are
+    # zero, and [lo, hi) is the covered pixel range at each redshift.
+    twave = np.asarray(twave, dtype=float)
+    tflux = np.asarray(tflux, dtype=float)
+    good = np.isfinite(twave) & np.isfinite(tflux)
+    order = np.argsort(twave[good])
+    twave = twave[good][order]
+    tflux = tflux[good][order]
+
+    zgrid = np.asarray(zgrid, dtype=float)
+    tgrid = np.interp(wave[None, :] / (1 + zgrid[:, None]), twave, tflux, left=0., right=0.)
+    lo = np.searchsorted(wave, twave[0] * (1 + zgrid), side='left')
+    hi = np.searchsorted(wave, twave[-1] * (1 + zgrid), side='right')
+
+    return tgrid, lo, hi
+
+
+def chi2_batch(tgrid, tgrid2, lo, hi, flux, weight):
+    # chi2(z) of a (nspec, npix) batch of spectra on the grid of tgrid with
+    # the amplitude solved analytically (and kept >= 0) at every redshift.
+    # Only the pixels covered by the template at each z enter the sum.
+    flux = np.where(weight > 0, np.nan_to_num(flux), 0.)
+    wf = weight * flux
+    cross = wf @ tgrid.T
+    norm = weight @ tgrid2.T
+
+    # sum of w f^2 and number of pixels over [lo, hi) from cumulative sums
+    csum = np.zeros((len(flux), flux.shape[1] + 1))
+    np.cumsum(wf * flux, axis=1, out=csum[:, 1:])
+    ccount = np.zeros((len(flux), flux.shape[1] + 1))
+    np.cumsum(weight > 0, axis=1, out=ccount[:, 1:])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        amp = np.where(norm > 0, cross / norm, 0.)
+    amp = np.maximum(amp, 0.)
+    chi2 = csum[:, hi] - csum[:, lo] - amp * cross
+    npix = ccount[:, hi] - ccount[:, lo]
+
+    return chi2, amp, npix
+
+
+def _spectrum_on_grid(ws, wave):
+    # flux and inverse-variance weight of a spectrum on the common grid
+    w = ws.wave * (1 + ws.addredshift)
+    flux = ws.spec_display * ws.mult + ws.add
+    err = ws.error_display
+    if err is not None:
+        err = err * np.abs(ws.mult)
+
+    good = np.isfinite(w) & np.isfinite(flux)
+    if err is not None:
+        good = good & np.isfinite(err) & (err > 0)
+    if not np.any(good):
+        # no data: no weight anywhere, chi2 0 with npix 0
+        return np.zeros(len(wave)), np.zeros(len(wave))
+
+    # grid points next to a masked or NaN pixel get no weight rather than
+    # flux interpolated across the gap
+    finite = np.isfinite(w)
+    order = np.argsort(w[finite])
+    covered = np.interp(wave, w[finite][order], good[finite][order].astype(float), left=0., right=0.)
+
+    order = np.argsort(w[good])
+    w = w[good][order]
+    f = np.interp(wave, w, flux[good][order], left=0., right=0.)
+    if err is not None:
+        weight = 1. / np.interp(wave, w, err[good][order])**2
+    else:
+        weight = np.ones(len(wave))
+    weight[(wave < w[0]) | (wave > w[-1]) | (covered < 1)] = 0.
+
+    return f, weight
+
+
+# template grid attached by the pool workers of chi2_redshift_batch()
+_shared_grid = {}
+
+
+def _attach_grid(names, shape):
+    # pool initializer: map the shared template grids into this process
+    from multiprocessing import shared_memory
+
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    _shared_grid['blocks'] = blocks
+    _shared_grid['tgrid'] = np.ndarray(shape, dtype=float, buffer=blocks[0].buf)
+    _shared_grid['tgrid2'] = np.ndarray(shape, dtype=float, buffer=blocks[1].buf)
+
+
+def _chi2_item(item):
+    # worker for chi2_redshift_batch()
+    lo, hi, flux, weight = item
+    return chi2_batch(_shared_grid['tgrid'], _shared_grid['tgrid2'], lo, hi, flux, weight)
+
+
+def chi2_redshift(wave, flux, err, twave, tflux, zgrid):
+    # chi2(z) of a single spectrum against a template
+    wave = np.asarray(wave, dtype=float)
+    order = np.argsort(wave)
+    wave = wave[order]
+    flux = np.asarray(flux, dtype=float)[order]
+    if err is None:
+        weight = np.ones(len(wave))
+    else:
+        err = np.asarray(err, dtype=float)[order]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(np.isfinite(err) & (err > 0), 1. / err**2, 0.)
+    weight = np.where(np.isfinite(flux), weight, 0.)
+
+    tgrid, lo, hi = template_grid(twave, tflux, wave, zgrid)
+    chi2, amp, npix = chi2_batch(tgrid, tgrid**2, lo, hi, flux[None, :], weight[None, :])
+
+    return chi2[0], amp[0], npix[0]
+
+
+def chi2_redshift_batch(wavespecs, twave, tflux, zgrid, wave=None, nproc=None, nbatch=64):
+    # chi2(z) for many spectra against one template. The template is
+    # resampled once onto a common wavelength grid at every trial redshift
+    # and placed in shared memory; the spectra are interpolated onto that
+    # grid and evaluated in batches of nbatch with matrix products, split
+    # across a process pool. wave defaults to the grid of the first spectrum.
+    # Returns chi2, amplitude and number of pixels, each (nspec, nz).
+    from multiprocessing import shared_memory
+
+    if wave is None:
+        wave = np.sort(wavespecs[0].wave * (1 + wavespecs[0].addredshift))
+    wave = np.asarray(wave, dtype=float)
+
+    tgrid, lo, hi = template_grid(twave, tflux, wave, zgrid)
+
+    items = []
+    for start in range(0, len(wavespecs), nbatch):
+        batch = [_spectrum_on_grid(ws, wave) for ws in wavespecs[start:start + nbatch]]
+        items.append((lo, hi, np.array([b[0] for b in batch]), np.array([b[1] for b in batch])))
+
+    blocks = [shared_memory.SharedMemory(create=True, size=max(tgrid.nbytes, 1)) for _ in range(2)]
+    try:
+        np.ndarray(tgrid.shape, dtype=float, buffer=blocks[0].buf)[:] = tgrid
+        np.square(tgrid, out=np.ndarray(tgrid.shape, dtype=float, buffer=blocks[1].buf))
+        del tgrid
+
+        results = pool_map(_chi2_item, items, nproc=nproc, chunksize=1, initializer=_attach_grid, \
+                           initargs=([block.name for block in blocks], (len(zgrid), len(wave))))
+    finally:
+        _shared_grid.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    chi2 = np.concatenate([r[0] for r in results])
+    amp = np.concatenate([r[1] for r in results])
+    npix = np.concatenate([r[2] for r in results])
+
+    return chi2, amp, npix
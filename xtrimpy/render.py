@@ -0,0 +1,400 @@
+# renderers of the spectra in the main plot. plotspec() hands the displayed
+# spectra to a renderer as (wave, flux, error or None, color) traces; the
+# rest of the plot (line list, masks, labels) are matplotlib artists either
+# way. update() replaces the data of one trace of the last draw, e.g. of a
+# file read again, without drawing the others anew.
+#   matplotlib  a step line and error bars per spectrum, as in saved figures
+#   raster      all spectra in one image at the resolution of the axes. At
+#               every draw the visible part of each trace is taken from a
+#               decimated copy with about two blocks per pixel column, and
+#               reduced to the range of its values in every column (the
+#               errors to a band), with the same few array operations for
+#               all traces: the cost depends on the pixels of the axes
+#               rather than on the number of artists or of data points.
+import numpy as np
+import matplotlib
+from matplotlib.colors import to_rgba
+from matplotlib.image import AxesImage
+
+RENDERERS = ('raster', 'matplotlib')
+# opacity of the error bands of the raster renderer
+ERROR_ALPHA = 0.3
+# pixels per block of a decimation level, and the longest trace that is not
+# decimated further
+FACTOR = 4
+MINBLOCKS = 256
+FIELDS = ('wave', 'fmin', 'fmax', 'lower', 'upper')
+# line pixels per pixel of the axes above which lines are not ordered
+DENSE = 4
+
+
+class mpl_renderer:
+
+    name = 'matplotlib'
+
+    def __init__(self):
+        self.artists = []   # (step line, error bars or None) of the traces
+
+        return
+
+    def draw(self, ax, traces):
+        self.artists = [self._draw_trace(ax, trace) for trace in traces]
+
+        return
+
+    def _draw_trace(self, ax, trace):
+        wave, flux, error, color = trace
+        line, = ax.step(wave, flux, where='mid', color=color)
+        bars = None
+        if error is not None:
+            bars = ax.errorbar(wave, flux, yerr=error, \
+                               ls='none', color=color, alpha=0.8)
+
+        return line, bars
+
+    def update(self, ax, index, trace):
+        # replace the data of one trace of the last draw, leaving the other
+        # artists alone; False if there is no such trace
+        if index >= len(self.artists) or self.artists[index][0].axes is not ax:
+            return False
+        line, bars = self.artists[index]
+        wave, flux, error, color = trace
+        line.set_data(wave, flux)
+        if bars is not None:
+            bars.remove()
+        bars = None
+        if error is not None:
+            bars = ax.errorbar(wave, flux, yerr=error, ls='none', color=color, alpha=0.8)
+        self.artists[index] = (line, bars)
+
+        return True
+
+
+class raster_renderer:
+
+    name = 'raster'
+
+    def __init__(self, error_alpha=ERROR_ALPHA):
+        self.error_alpha = error_alpha
+        self.image = None
+        self.traces = []
+
+        return
+
+    def draw(self, ax, traces):
+        self.traces = list(traces)
+        packed = pack(self.traces)
+        self.image = raster_image(ax, packed, self.error_alpha)
+        ax.add_image(self.image)
+
+        # data limits as the step lines would have set them
+        if packed['limits'] is not None:
+            xmin, ymin, xmax, ymax = packed['limits']
+            ax.update_datalim([(xmin, ymin), (xmax, ymax)])
+            ax.autoscale_view()
+
+        return
+
+    def update(self, ax, index, trace):
+        # replace the data of one trace of the last draw: the image is
+        # rasterized again at the next draw, the axes are left alone
+        if self.image is None or self.image.axes is not ax or index >= len(self.traces):
+            return False
+        self.traces[index] = trace
+        self.image.packed = pack(self.traces)
+        self.image.key = None
+        self.image.stale = True
+
+        return True
+
+
+def renderer(name):
+    # renderer of a name in RENDERERS
+    if name == 'raster':
+        return raster_renderer()
+    if name == 'matplotlib':
+        return mpl_renderer()
+
+    raise ValueError("Unknown renderer: {0}".format(name))
+
+
+class raster_image(AxesImage):
+    # image that covers the axes and is rasterized again when their limits
+    # or their size in pixels have changed since the last draw
+
+    def __init__(self, ax, packed, error_alpha=ERROR_ALPHA):
+        super().__init__(ax, interpolation='nearest', origin='upper')
+        self.packed = packed
+        self.error_alpha = error_alpha
+        self.key = None     # limits and size of the last raster
+
+        return
+
+    def get_extent(self):
+        x0, x1 = self.axes.get_xlim()
+        y0, y1 = self.axes.get_ylim()
+
+        return x0, x1, y0, y1
+
+    def draw(self, renderer, *args, **kwargs):
+        bbox = self.axes.bbox
+        width, height = max(int(round(bbox.width)), 1), max(int(round(bbox.height)), 1)
+        key = (self.axes.get_xlim(), self.axes.get_ylim(), width, height)
+        if key != self.key:
+            self.key = key
+            self.set_data(render(self.packed, key[0], key[1], width, height, self.error_alpha))
+        super().draw(renderer, *args, **kwargs)
+
+        return
+
+
+def _ranges(start, n):
+    # concatenated aranges start <= i < start + n
+    offset = np.repeat(start - (np.cumsum(n) - n), n)
+
+    return offset + np.arange(np.sum(n))
+
+
+def _decimate(level):
+    # level of blocks of FACTOR pixels of every trace: the wavelength in the
+    # middle of a block, the range of its fluxes and of its error band
+    n = (level['n'] + FACTOR - 1) // FACTOR
+    start = np.cumsum(n) - n
+    # first pixel of every block
+    first = np.repeat(level['start'], n) + _ranges(np.zeros_like(n), n) * FACTOR
+    last = np.minimum(first + FACTOR, np.repeat(level['start'] + level['n'], n)) - 1
+
+    coarse = {"start": start, "n": n, "wave": 0.5 * (level['wave'][first] + level['wave'][last])}
+    with np.errstate(invalid='ignore'):
+        for name, ufunc in (('fmin', np.fmin), ('fmax', np.fmax), ('lower', np.fmin), ('upper', np.fmax)):
+            coarse[name] = ufunc.reduceat(level[name], first) if len(first) > 0 else np.zeros(0)
+
+    return coarse
+
+
+def pack(traces):
+    # the traces sorted by wavelength and decimated by FACTOR until they
+    # have at most MINBLOCKS blocks. Each level has the wavelengths, the
+    # range of the fluxes (fmin, fmax) and of the error band (lower, upper;
+    # NaN without errors) of its blocks, all levels concatenated; start[l]
+    # and n[l] are where the traces of level l are.
+    level = {name: [np.zeros(0)] for name in FIELDS}
+    for wave, flux, error, color in traces:
+        wave, flux = np.asarray(wave, dtype=float), np.asarray(flux, dtype=float)
+        error = np.full(len(flux), np.nan) if error is None else np.asarray(error, dtype=float)
+        if len(wave) > 1 and not np.all(wave[1:] >= wave[:-1]):
+            order = np.argsort(wave, kind='stable')
+            wave, flux, error = wave[order], flux[order], error[order]
+        for name, values in zip(FIELDS, (wave, flux, flux, flux - error, flux + error)):
+            level[name].append(values)
+    n = np.array([len(wave) for wave in level['wave'][1:]], dtype=int)
+    level = {name: np.concatenate(values) for name, values in level.items()}
+    level['start'], level['n'] = np.cumsum(n) - n, n
+
+    levels = [level]
+    while len(n) > 0 and np.max(levels[-1]['n']) > MINBLOCKS:
+        levels.append(_decimate(levels[-1]))
+
+    packed = {name: np.concatenate([level[name] for level in levels]) for name in FIELDS}
+    offsets = np.cumsum([0] + [len(level['wave']) for level in levels])
+    packed['start'] = [level['start'] + offset for level, offset in zip(levels, offsets)]
+    packed['n'] = [level['n'] for level in levels]
+    # colors of the property cycle for traces without one, as for lines
+    cycle = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+    packed['colors'] = np.array([to_rgba(cycle[i % len(cycle)] if trace[3] is None else trace[3]) \
+                                 for i, trace in enumerate(traces)], dtype=float).reshape(-1, 4)
+
+    wave, flux = levels[0]['wave'], levels[0]['fmin']
+    good = np.isfinite(flux) & np.isfinite(wave)
+    packed['limits'] = (np.min(wave[good]), np.min(flux[good]), np.max(wave[good]), np.max(flux[good])) \
+        if np.any(good) else None
+
+    return packed
+
+
+def select(packed, x0, x1, width):
+    # the blocks of every trace between x0 < x1 (and one more on either
+    # side), from the coarsest level with at least two blocks per pixel
+    # column: the fields of pack() with the trace of every block, and the
+    # start and length of every trace
+    starts, ns = packed['start'], packed['n']
+    wave = packed['wave']
+    first, count = np.zeros(len(ns[0]), dtype=int), np.zeros(len(ns[0]), dtype=int)
+    for k in range(len(ns[0])):
+        s, n = starts[0][k], ns[0][k]
+        w = wave[s:s + n]
+        a = max(np.searchsorted(w, x0) - 1, 0)
+        b = min(np.searchsorted(w, x1, 'right') + 1, n)
+        if b <= a:
+            continue
+        # pixels per column where the trace is
+        span = (min(x1, w[b - 1]) - max(x0, w[a])) / (x1 - x0) * width
+        level = 0
+        while level + 1 < len(ns) and FACTOR**(level + 1) * 2 <= (b - a) / max(span, 1.):
+            level += 1
+        f = FACTOR**level
+        a, b = max(a // f - 1, 0), min(-(-b // f) + 1, ns[level][k])
+        first[k], count[k] = starts[level][k] + a, b - a
+
+    index = _ranges(first, count)
+    view = {name: packed[name][index] for name in FIELDS}
+    view['trace'] = np.repeat(np.arange(len(count)), count)
+    view['start'], view['n'] = np.cumsum(count) - count, count
+
+    return view
+
+
+def _edges(view, x0, x1, width):
+    # left and right edges in pixel columns of every block; blocks reach
+    # halfway to their neighbours in the same trace
+    px = (view['wave'] - x0) * (width / (x1 - x0))
+    left, right = np.empty_like(px), np.empty_like(px)
+    mid = 0.5 * (px[1:] + px[:-1])
+    left[1:], right[:-1] = mid, mid
+
+    start, n = view['start'], view['n']
+    start, n = start[n > 0], n[n > 0]
+    end = start + n - 1
+    # the first and last blocks of a trace reach as far out as in
+    single, multi = n == 1, n > 1
+    left[start[single]], right[end[single]] = px[start[single]] - 0.5, px[end[single]] + 0.5
+    left[start[multi]] = 2 * px[start[multi]] - right[start[multi]]
+    right[end[multi]] = 2 * px[end[multi]] - left[end[multi]]
+
+    return left, right
+
+
+def columns(view, x0, x1, width):
+    # (keys, lo, hi, visible) for x0 < x1: the pixel columns covered by the
+    # traces as trace * width + column, and for every one the blocks
+    # lo <= i <= hi in it, as indices into the visible blocks
+    left, right = _edges(view, x0, x1, width)
+    visible = np.flatnonzero((right > 0) & (left < width) & np.isfinite(view['wave']))
+    if len(visible) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=int), visible
+    offset = view['trace'][visible] * width
+    first = offset + np.clip(np.floor(left[visible]).astype(int), 0, width - 1)
+    last = offset + np.clip(np.ceil(right[visible]).astype(int) - 1, 0, width - 1)
+    last = np.maximum(last, first)
+
+    # the columns from the first to the last column of every block
+    size = len(view['n']) * width + 1
+    covered = np.cumsum(np.bincount(first, minlength=size) - np.bincount(last + 1, minlength=size)) > 0
+    keys = np.flatnonzero(covered)
+    # at most the block hi also reaches into the next column
+    lo = np.searchsorted(last, keys, 'left')
+    hi = np.searchsorted(first, keys, 'right') - 1
+
+    return keys, lo, hi, visible
+
+
+def _reduce(lo, hi, lower, upper):
+    # (min of lower, max of upper) of the blocks lo <= i <= hi
+    with np.errstate(invalid='ignore'):
+        vmin = np.fmin(np.fmin.reduceat(lower, lo), lower[hi])
+        vmax = np.fmax(np.fmax.reduceat(upper, lo), upper[hi])
+
+    return vmin, vmax
+
+
+def _rows(vmin, vmax, y0, y1, height):
+    # (good, top, bottom) rows of value ranges, clipped to the image
+    scale = height / (y1 - y0)
+    with np.errstate(invalid='ignore'):
+        ra = np.floor((y1 - vmax) * scale)
+        rb = np.floor((y1 - vmin) * scale)
+        top, bottom = np.fmin(ra, rb), np.fmax(ra, rb)
+        good = np.isfinite(top) & np.isfinite(bottom) & (bottom >= 0) & (top <= height - 1)
+    top = np.clip(top[good], 0, height - 1).astype(int)
+    bottom = np.clip(bottom[good], 0, height - 1).astype(int)
+
+    return good, top, bottom
+
+
+def _bands(cols, top, bottom, colors, width, height):
+    # premultiplied RGBA of translucent bands, blended where they overlap.
+    # Only where a band starts and ends is marked in every column, and one
+    # cumulative sum over the rows fills them: the cost does not depend on
+    # the height of the bands.
+    size = (height + 1) * width
+    marks = np.concatenate([top * width + cols, (bottom + 1) * width + cols])
+
+    def fill(weights=None):
+        if weights is None:
+            counts = np.bincount(marks[:len(cols)], minlength=size) - np.bincount(marks[len(cols):], minlength=size)
+        else:
+            counts = np.bincount(marks, np.concatenate([weights, -weights]), size)
+        return np.cumsum(counts.reshape(height + 1, width), axis=0)[:-1]
+
+    # exact counts of the bands in every pixel, since the weighted sums
+    # leave rounding errors where there are none
+    covered = fill() > 0
+    alpha = colors[:, 3]
+    image = np.zeros((height, width, 4), dtype=np.float32)
+    # the transmission of overlapping bands is the product of (1 - alpha)
+    opacity = np.where(covered, 1 - np.exp(fill(np.log1p(-np.minimum(alpha, 1 - 1e-6)))), 0.)
+    weight = fill(alpha)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(3):
+            # mean color of the bands, weighted by their opacity
+            image[..., i] = np.where(covered, fill(colors[:, i] * alpha) / weight, 0.) * opacity
+    image[..., 3] = opacity
+
+    return np.clip(image, 0, 1, out=image)
+
+
+def render(packed, xlim, ylim, width, height, error_alpha=ERROR_ALPHA):
+    # RGBA image (height, width, 4) of packed traces. The error bands of all
+    # traces are below the lines; a line is above the lines of the traces
+    # before it.
+    (x0, x1), (y0, y1) = xlim, ylim
+    image = np.zeros((height, width, 4), dtype=np.float32)
+    if x1 == x0 or y1 == y0 or len(packed['colors']) == 0:
+        return image
+    if x1 < x0:
+        # inverted wavelength axis
+        return render(packed, (x1, x0), ylim, width, height, error_alpha)[:, ::-1]
+
+    view = select(packed, x0, x1, width)
+    keys, lo, hi, visible = columns(view, x0, x1, width)
+    if len(keys) == 0:
+        return image
+    trace, cols = keys // width, keys % width
+    colors = packed['colors']
+
+    vmin, vmax = _reduce(lo, hi, view['lower'][visible], view['upper'][visible])
+    good, top, bottom = _rows(vmin, vmax, y0, y1, height)
+    if len(top) > 0:
+        band = colors[trace[good]]
+        band[:, 3] *= error_alpha
+        image = _bands(cols[good], top, bottom, band, width, height)
+
+    vmin, vmax = _reduce(lo, hi, view['fmin'][visible], view['fmax'][visible])
+    good, top, bottom = _rows(vmin, vmax, y0, y1, height)
+    n = bottom - top + 1
+    if np.sum(n) > DENSE * width * height:
+        # too many pixels to order the lines, e.g. of many noisy spectra:
+        # the mean color of the lines in a pixel, filled like the bands
+        lines = _bands(cols[good], top, bottom, colors[trace[good]], width, height)
+        image = lines + image * (1 - lines[..., 3:])
+    elif len(n) > 0:
+        # index of the last line in every pixel
+        rows = _ranges(top, n)
+        label = np.full(height * width, -1, dtype=np.int32)
+        np.maximum.at(label, rows * width + np.repeat(cols[good], n), np.repeat(trace[good], n).astype(np.int32))
+        drawn = np.flatnonzero(label >= 0)
+        line = colors[label[drawn]].astype(np.float32)
+        a = line[:, 3:]
+        pixels = image.reshape(-1, 4)
+        pixels[drawn] = np.concatenate([line[:, :3] * a, a], axis=1) + pixels[drawn] * (1 - a)
+
+    # straight alpha
+    np.divide(image[..., :3], image[..., 3:], out=image[..., :3], where=image[..., 3:] > 0)
+
+    return image
+
+
+def rasterize(traces, xlim, ylim, width, height, error_alpha=ERROR_ALPHA):
+    # RGBA image (height, width, 4) of (wave, flux, error or None, color)
+    # traces
+    return render(pack(traces), xlim, ylim, width, height, error_alpha)
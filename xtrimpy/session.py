@@ -0,0 +1,849 @@
+# the analysis session: spectra, plotting range, annotations and
+# measurements, without Qt or matplotlib. Every change is made by a method
+# that groups it into one action (one undo step, one journal entry) and
+# notifies the observers once the action has finished; the GUI is one such
+# observer, scripts and notebooks can use a session on their own.
+import os
+import logging
+import contextlib
+import numpy as np
+
+from .WaveSpec import wavespec, sloader
+from .utils import calc_ew, calc_ew_mc, calc_ew_continuum, fit_gauss, fit_gauss_mc, fit_lines, \
+    read_line_list
+from . import redshift, linedetect, continuum, masks, quantiles, workspace, journal, history
+
+logger = logging.getLogger(__name__)
+
+# line list shipped with the package
+LINELIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib', 'line_list.dat')
+
+# change notifications: the list of spectra, display parameters of some
+# spectra or their data read again (both listed in session.changed_specs),
+# the plotting range, trim lines/redshift/marks, measurement results, the
+# line list, the masks and the redshift templates
+EVENTS = ('specs', 'spec_params', 'spec_data', 'view', 'annotations', 'measurements', 'linelist', 'masks', \
+          'templates')
+
+
+def default_plotting():
+    # plotting keywords
+    return {
+        "box": [None, None, None, None],
+        "redshift": 0.,
+        "ew_cont": [None, None, None, None],
+        "ew_window": [None, None],  # EW window on the automatic continuum
+        "ew": [np.nan, np.nan],
+        "flux": [np.nan, np.nan],
+        "gauss_lim": [None, None],
+        "gauss_center": [np.nan, np.nan],
+        "lines_fit": None,  # results of the multi-line fit
+        "mc_errors": 0,     # number of Monte Carlo realizations for errors, 0 = off
+        "normalize": False, # display spectra divided by their continuum
+        "trim_lines": [],
+        "redshift_line": np.nan,
+        "blocking": None    # operation in progress, blocking other key events
+    }
+
+
+class session:
+
+    def __init__(self, filenames=None, loader=sloader.default, linelist=LINELIST, record=True):
+
+        self.specs = []
+        self.plotting = default_plotting()
+
+        # gauss model
+        self.gauss_wave = None
+        self.gauss_model = None
+
+        # line list
+        self.linelist = {
+            "waves": [],
+            "labels": [],
+            "kwargs": []
+        }
+
+        # sky line, telluric and bad region masks
+        self.masks = masks.mask_list()
+
+        # redshift templates and cross-correlation candidates
+        self.xcorr_templates = []
+        self.template_specs = []
+        self.z_candidates = []
+        self.z_candidate_index = 0
+        self.z_previous = 0.
+
+        # colors assigned to the spectra in order, if set
+        self.colors = None
+
+        # undo/redo of the actions and the crash recovery journal;
+        # record=False skips the snapshots (e.g. for benchmarks)
+        self.recording = record
+        self.history = history.history()
+        self.journal = None
+
+        self.observers = []
+        self.changed_specs = []
+        self._depth = 0
+        self._events = set()
+        self._changed_specs = {}
+
+        if linelist is not None:
+            self.load_linelist(linelist)
+        if filenames:
+            self.load(filenames, loader=loader)
+
+        return
+
+    # -- notifications and actions
+
+    def subscribe(self, callback):
+        # callback(events) is called with the set of EVENTS changed by each
+        # action once it has finished
+        self.observers.append(callback)
+
+        return callback
+
+    def unsubscribe(self, callback):
+        self.observers.remove(callback)
+
+        return
+
+    def notify(self, *events, specs=()):
+        # specs are the spectra of a 'spec_params' or 'spec_data' change;
+        # changes made outside an action are sent right away
+        self._events.update(events)
+        for ws in specs:
+            self._changed_specs[id(ws)] = ws
+        if self._depth == 0:
+            self._flush()
+
+        return
+
+    def _flush(self):
+        events, self._events = self._events, set()
+        self.changed_specs = list(self._changed_specs.values())
+        self._changed_specs = {}
+        if len(events) > 0:
+            for callback in list(self.observers):
+                callback(events)
+
+        return
+
+    @contextlib.contextmanager
+    def action(self, name):
+        # group the changes made inside into one undo step and one
+        # notification; actions may be nested
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.record(name)
+                self._flush()
+
+    def record(self, action):
+        # add the change of state by an action to the undo history and the
+        # journal
+        # a mark of which only the first point is set (box, ew_cont, ...) is
+        # no state to go back or recover to; it is recorded with its second
+        # point
+        if not self.recording or self.plotting['blocking'] is not None:
+            return
+        self.history.record(action, history.snapshot(self.specs, self.plotting, self.linelist, \
+                                                     self.gauss_wave, self.gauss_model))
+        if self.journal is not None:
+            state = journal.session_state(self.specs, self.plotting, self.linelist, \
+                                          self.gauss_wave, self.gauss_model)
+            self.journal.record(action, state)
+
+        return
+
+    def _set_state(self, specs, plotting, linelist, gauss_wave, gauss_model):
+        # replace the whole state (workspace, journal, undo/redo)
+        self.specs = specs
+        self.plotting.update(plotting)
+        self.plotting['blocking'] = None
+        self.linelist = linelist
+        self.gauss_wave = gauss_wave
+        self.gauss_model = gauss_model
+        self.z_candidates = []
+        self.notify(*EVENTS)
+
+        return
+
+    def undo(self):
+        # name of the action undone, None if there is nothing to undo
+        return self._restore(self.history.undo(), 'undo')
+
+    def redo(self):
+        return self._restore(self.history.redo(), 'redo')
+
+    def _restore(self, step, name):
+        if step is None:
+            return None
+
+        action, state = step
+        with self.action(name):
+            self._set_state(*history.restore(state))
+
+        return action
+
+    # -- spectra
+
+    def load(self, fns, loader=sloader.default, reset_view=True):
+        # add spectra; returns the new wavespec objects
+        if isinstance(fns, str):
+            fns = [fns]
+
+        with self.action('load'):
+            new = [wavespec.wavespec_obj(fn, loader=loader) for fn in fns]
+            self.add(new, reset_view=reset_view)
+
+        return new
+
+    def add(self, new, reset_view=True):
+        # add wavespec objects, e.g. spectra extracted from a 2D spectrum
+        with self.action('add'):
+            self.specs.extend(new)
+            self.assign_colors()
+            self.notify('specs')
+            if reset_view:
+                self.reset_view()
+
+        return new
+
+    def remove(self, index):
+        with self.action('remove'):
+            ws = self.specs.pop(index)
+            self.assign_colors()
+            self.notify('specs')
+
+        return ws
+
+    def reload(self, ws, data):
+        # replace the data of a spectrum with (wave, spec, error) read again,
+        # e.g. from a rewritten file, keeping its display parameters. Not an
+        # undo step: the history and the journal refer to the file.
+        ws.set_data(*data)
+        self.masks.apply(ws, self.plotting['redshift'])
+        self.notify('spec_data', specs=[ws])
+
+        return
+
+    def assign_colors(self):
+        if self.colors is None or len(self.colors) == 0:
+            return
+        for i, ws in enumerate(self.specs):
+            ws.color = self.colors[i % len(self.colors)]
+        self.notify('spec_params', specs=self.specs)
+
+        return
+
+    def set_spec_param(self, index, name, value):
+        # set a display parameter of a spectrum: addredshift, mult, add,
+        # smooth_width, color or label
+        if name not in history.SPEC_PARAMS:
+            raise ValueError("Unknown spectrum parameter: {0}".format(name))
+
+        with self.action('set ' + name):
+            ws = self.specs[index]
+            if name == 'smooth_width':
+                ws.smooth(max(int(value), 0))
+            else:
+                setattr(ws, name, value)
+            self.notify('spec_params', specs=[ws])
+
+        return
+
+    def smooth(self, width):
+        # smooth all spectra with a box of width pixels, 0 = off
+        with self.action('smooth'):
+            for ws in self.specs:
+                ws.smooth(max(int(width), 0))
+            self.notify('spec_params', specs=self.specs)
+
+        return
+
+    def apply_masks(self):
+        # masks are only rebuilt when the redshift or the masks change
+        for ws in self.specs:
+            self.masks.apply(ws, self.plotting['redshift'])
+
+        return
+
+    def load_masks(self, fn):
+        self.masks.load(fn)
+        self.notify('masks')
+
+        return
+
+    def clear_masks(self):
+        self.masks.clear()
+        self.notify('masks')
+
+        return
+
+    def load_linelist(self, fn):
+        waves, labels, kwargs = read_line_list(fn)
+
+        with self.action('load_linelist'):
+            self.linelist = {
+                "waves": waves,
+                "labels": labels,
+                "kwargs": kwargs
+            }
+            self.notify('linelist')
+
+        return
+
+    def load_templates(self, fns, loader=sloader.default):
+        # spectra used as cross-correlation and chi-square templates
+        if isinstance(fns, str):
+            fns = [fns]
+
+        for fn in fns:
+            ws = wavespec.wavespec_obj(fn, loader=loader)
+            self.template_specs.append(ws)
+            self.xcorr_templates.append(redshift.spectrum_template(ws.wave, ws.spec, name=ws.label))
+        self.notify('templates')
+
+        return
+
+    def clear_templates(self):
+        self.xcorr_templates = []
+        self.template_specs = []
+        self.notify('templates')
+
+        return
+
+    def set_mc_errors(self, nreal):
+        # number of Monte Carlo realizations for the errors, 0 = off
+        with self.action('mc_errors'):
+            self.plotting['mc_errors'] = int(nreal)
+
+        return
+
+    def set_normalize(self, normalize):
+        # display the spectra divided by their continuum
+        with self.action('normalize'):
+            self.plotting['normalize'] = bool(normalize)
+            self.notify('view')
+            self.reset_view()
+
+        return
+
+    # -- displayed data
+
+    def continuum_of(self, ws):
+        # cached automatic continuum with the line list masked at the redshift
+        return continuum.continuum(ws, self.linelist['waves'], self.plotting['redshift'])
+
+    def quantile_sketch_of(self, ws):
+        # cached block quantile summaries of the displayed (unscaled) spectrum
+        if self.plotting.get('normalize', False):
+            key = ('quantile_sketch', ws.addredshift, tuple(self.linelist['waves']), self.plotting['redshift'])
+            return ws.cached(key, lambda: quantiles.quantile_sketch(ws.wave, ws.spec_display / self.continuum_of(ws)))
+
+        return ws.cached(('quantile_sketch',), lambda: quantiles.quantile_sketch(ws.wave, ws.spec_display))
+
+    def thumbnail_of(self, ws, nbins=512):
+        # cached min/max thumbnail of the displayed (unscaled) spectrum for
+        # the overview; scaled as in displayed() by the caller
+        if self.plotting.get('normalize', False):
+            key = ('thumbnail', nbins, ws.addredshift, tuple(self.linelist['waves']), self.plotting['redshift'])
+            return ws.cached(key, lambda: quantiles.thumbnail(ws.wave, ws.spec_display / self.continuum_of(ws), nbins))
+
+        return ws.cached(('thumbnail', nbins), lambda: quantiles.thumbnail(ws.wave, ws.spec_display, nbins))
+
+    def displayed(self, ws):
+        # wavelength, flux and error (or None) of a spectrum as displayed
+        spec_display = ws.spec_display
+        error_display = ws.error_display
+        if self.plotting.get('normalize', False):
+            cont = self.continuum_of(ws)
+            spec_display = spec_display / cont
+            if error_display is not None:
+                error_display = error_display / cont
+
+        wave = ws.wave * (ws.addredshift + 1)
+        flux = spec_display * ws.mult + ws.add
+        error = None if error_display is None else error_display * ws.mult
+
+        return wave, flux, error
+
+    def use_mc_errors(self):
+        # Monte Carlo errors are switched on and possible for the first spectrum
+        return self.plotting.get('mc_errors', 0) > 0 and len(self.specs) > 0 and \
+            self.specs[0].error_display is not None
+
+    # -- plotting range
+
+    def data_limits(self, margin=0.05):
+        # (x0, y0, x1, y1) of the displayed spectra and their errors, with
+        # margins as matplotlib autoscales; None without finite data
+        self.apply_masks()
+        xmin, ymin, xmax, ymax = np.inf, np.inf, -np.inf, -np.inf
+        for ws in self.specs:
+            wave, flux, error = self.displayed(ws)
+            if error is not None:
+                error = np.abs(error)
+                lo, hi = flux - error, flux + error
+            else:
+                lo, hi = flux, flux
+            with np.errstate(invalid='ignore'):
+                good = np.isfinite(wave) & np.isfinite(flux)
+            if not np.any(good):
+                continue
+            xmin, xmax = min(xmin, np.min(wave[good])), max(xmax, np.max(wave[good]))
+            lo, hi = lo[good & np.isfinite(lo)], hi[good & np.isfinite(hi)]
+            ymin = min(ymin, np.min(lo) if len(lo) > 0 else np.min(flux[good]))
+            ymax = max(ymax, np.max(hi) if len(hi) > 0 else np.max(flux[good]))
+
+        if not np.isfinite(xmin):
+            return None
+        if xmin == xmax:
+            xmin, xmax = xmin - 0.5, xmax + 0.5
+        if ymin == ymax:
+            ymin, ymax = ymin - 0.5, ymax + 0.5
+        dx, dy = margin * (xmax - xmin), margin * (ymax - ymin)
+
+        return [float(xmin - dx), float(ymin - dy), float(xmax + dx), float(ymax + dy)]
+
+    def set_box(self, x0, y0, x1, y1):
+        # plotting range; corners in any order
+        with self.action('set_box'):
+            self.plotting['box'][:] = min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+            self.notify('view')
+
+        return
+
+    def reset_view(self):
+        # plotting range of all data; False if there is none
+        box = self.data_limits()
+        if box is None:
+            return False
+        with self.action('reset_view'):
+            self.plotting['box'][:] = box
+            self.notify('view')
+
+        return True
+
+    def _range(self, axis):
+        # indices of an axis in the box
+        if axis not in ('x', 'y'):
+            raise ValueError("axis must be 'x' or 'y'")
+        return (0, 2) if axis == 'x' else (1, 3)
+
+    def zoom(self, axis, factor):
+        # scale the range of an axis by factor about its center (>1 zooms out)
+        i0, i1 = self._range(axis)
+        with self.action('zoom'):
+            box = self.plotting['box']
+            delta = (factor - 1) / 2 * (box[i1] - box[i0])
+            box[i0] -= delta
+            box[i1] += delta
+            self.notify('view')
+
+        return
+
+    def pan(self, axis, fraction):
+        # shift the range of an axis by a fraction of its width
+        i0, i1 = self._range(axis)
+        with self.action('pan'):
+            box = self.plotting['box']
+            delta = fraction * (box[i1] - box[i0])
+            box[i0] += delta
+            box[i1] += delta
+            self.notify('view')
+
+        return
+
+    def baseline(self):
+        # put y=0 at the bottom, or at the top of a negative range
+        with self.action('baseline'):
+            if self.plotting['box'][3] > 0:
+                self.plotting['box'][1] = 0
+            else:
+                self.plotting['box'][3] = 0
+            self.notify('view')
+
+        return
+
+    def autoscale(self, q=(1, 99)):
+        # y range from the q percentiles of the displayed values in the
+        # visible wavelength range; returns it, or None without data
+        if len(self.specs) == 0:
+            return None
+        box = self.plotting['box']
+        if box[0] is None or box[2] is None:
+            self.reset_view()
+
+        self.apply_masks()
+        sketches = [(self.quantile_sketch_of(ws), ws.addredshift + 1, ws.mult, ws.add) for ws in self.specs]
+        ymin, ymax = quantiles.viewport_quantiles(sketches, box[0], box[2], q)
+        if not (np.isfinite(ymin) and np.isfinite(ymax)):
+            return None
+        if ymin == ymax:
+            ymin, ymax = ymin - 0.5, ymax + 0.5
+
+        with self.action('autoscale'):
+            box[1] = ymin
+            box[3] = ymax
+            self.notify('view')
+
+        return ymin, ymax
+
+    # -- annotations
+
+    def clear_pending(self):
+        # drop measurements of which only the first point was marked
+        with self.action('clear_pending'):
+            if self.plotting['ew_cont'][2] is None:
+                self.plotting['ew_cont'] = [None, None, None, None]
+            if self.plotting['gauss_lim'][1] is None:
+                self.plotting['gauss_lim'] = [None, None]
+            if self.plotting.get('ew_window', [None, None])[1] is None:
+                self.plotting['ew_window'] = [None, None]
+            self.plotting['blocking'] = None
+            self.notify('annotations')
+
+        return
+
+    def add_trim_line(self, wave):
+        with self.action('add_trim_line'):
+            self.plotting['trim_lines'].append(float(wave))
+            self.notify('annotations')
+
+        return
+
+    def _nearest_trim_line(self, wave):
+        if len(self.plotting['trim_lines']) == 0:
+            return None
+        return int(np.argmin(np.abs(np.asarray(self.plotting['trim_lines']) - wave)))
+
+    def remove_trim_line(self, wave):
+        # remove the trim line nearest to wave; returns its position
+        index = self._nearest_trim_line(wave)
+        if index is None:
+            return None
+        with self.action('remove_trim_line'):
+            removed = self.plotting['trim_lines'].pop(index)
+            self.notify('annotations')
+
+        return removed
+
+    def move_trim_line(self, wave):
+        # move the trim line nearest to wave there; returns its old position
+        index = self._nearest_trim_line(wave)
+        if index is None:
+            return None
+        old = self.plotting['trim_lines'][index]
+        self.set_trim_line(index, wave)
+
+        return old
+
+    def set_trim_line(self, index, wave):
+        with self.action('set_trim_line'):
+            self.plotting['trim_lines'][index] = float(wave)
+            self.notify('annotations')
+
+        return
+
+    def set_redshift(self, z):
+        with self.action('set_redshift'):
+            self.plotting['redshift'] = float(z)
+            self.notify('annotations')
+
+        return
+
+    def mark_line(self, wave):
+        # observed wavelength of a line, for mark_redshift()
+        with self.action('mark_line'):
+            self.plotting['redshift_line'] = float(wave)
+            self.notify('annotations')
+
+        return
+
+    def mark_redshift(self, wave0):
+        # redshift from the marked line at rest wavelength wave0; the mark is
+        # cleared either way. Returns the redshift.
+        with self.action('mark_redshift'):
+            try:
+                z = (self.plotting['redshift_line'] - wave0) / wave0
+                if not np.isfinite(z):
+                    raise ValueError("No line marked or invalid rest wavelength.")
+                self.plotting['redshift'] = float(z)
+            finally:
+                self.plotting['redshift_line'] = np.nan
+                self.notify('annotations')
+
+        return self.plotting['redshift']
+
+    # -- measurements on the first spectrum
+
+    def measure_ew(self, cont=None):
+        # EW and flux over a straight continuum through the points
+        # [x0, y0, x1, y1] (default: the marked ones); returns (ew, flux)
+        if cont is not None:
+            x0, y0, x1, y1 = cont
+            if x1 < x0:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            self.plotting['ew_cont'] = [x0, y0, x1, y1]
+
+        self.apply_masks()
+        with self.action('measure_ew'):
+            if self.use_mc_errors():
+                ew, flux = calc_ew_mc(self.specs[0], self.plotting['ew_cont'], nreal=self.plotting['mc_errors'])
+            else:
+                ew, flux = calc_ew(self.specs[0], self.plotting['ew_cont'])
+            self.plotting['ew'] = ew
+            self.plotting['flux'] = flux
+            self.notify('annotations', 'measurements')
+
+        return ew, flux
+
+    def measure_ew_auto(self, window=None):
+        # EW and flux in [w0, w1] on the automatic continuum; returns (ew, flux)
+        if window is not None:
+            self.plotting['ew_window'] = sorted(window)
+
+        self.apply_masks()
+        with self.action('measure_ew_auto'):
+            ws = self.specs[0]
+            ew, flux = calc_ew_continuum(ws, self.plotting['ew_window'], self.continuum_of(ws))
+            self.plotting['ew'] = ew
+            self.plotting['flux'] = flux
+            self.notify('annotations', 'measurements')
+
+        return ew, flux
+
+    def fit_gauss(self, window=None):
+        # single Gaussian in [w0, w1]; returns (flux, ew, center), NaN if
+        # the fit fails
+        if window is not None:
+            self.plotting['gauss_lim'] = sorted(window)
+
+        self.apply_masks()
+        with self.action('fit_gauss'):
+            try:
+                if self.use_mc_errors():
+                    flux, ew, gauss_center, wmodel, smodel = fit_gauss_mc(self.specs[0], self.plotting['gauss_lim'], \
+                                                                          nreal=self.plotting['mc_errors'])
+                else:
+                    flux, ew, gauss_center, wmodel, smodel = fit_gauss(self.specs[0], self.plotting['gauss_lim'])
+            except Exception:
+                ew = [np.nan, np.nan]
+                flux = [np.nan, np.nan]
+                gauss_center = [np.nan, np.nan]
+                wmodel = None
+                smodel = None
+
+            self.plotting['ew'] = ew
+            self.plotting['flux'] = flux
+            self.plotting['gauss_center'] = gauss_center
+            self.plotting['lines_fit'] = None
+            self.gauss_wave = wmodel
+            self.gauss_model = smodel
+            self.notify('annotations', 'measurements')
+
+        return flux, ew, gauss_center
+
+    def fit_lines(self, window=None):
+        # all line list features in [w0, w1] with tied redshift and width;
+        # returns the fit of utils.fit_lines(). A failed fit clears the
+        # results and raises.
+        if window is not None:
+            self.plotting['gauss_lim'] = sorted(window)
+
+        self.apply_masks()
+        with self.action('fit_lines'):
+            self.notify('annotations', 'measurements')
+            try:
+                result = fit_lines(self.specs[0], self.plotting['gauss_lim'], \
+                                   self.linelist['waves'], self.plotting['redshift'], \
+                                   labels=self.linelist['labels'])
+            except Exception:
+                self.gauss_wave = None
+                self.gauss_model = None
+                self.plotting['lines_fit'] = None
+                raise
+
+            self.gauss_wave = result['wave']
+            self.gauss_model = result['model']
+            self.plotting['lines_fit'] = {
+                "labels": result['labels'],
+                "redshift": list(result['redshift']),
+                "sigma_v": list(result['sigma_v']),
+                "flux": result['flux'].tolist(),
+                "ew": result['ew'].tolist()
+            }
+
+        return result
+
+    # -- redshift
+
+    def xcorr(self):
+        # cross-correlation redshift candidates of the first spectrum against
+        # the templates (or the line list); the first one is shown
+        if len(self.xcorr_templates) > 0:
+            templates = self.xcorr_templates
+        else:
+            templates = [redshift.linelist_template(self.linelist['waves'])]
+
+        self.apply_masks()
+        ws = self.specs[0]
+        peaks = redshift.xcorr_redshift(ws.wave * (1 + ws.addredshift), ws.spec_display, \
+                                        templates, err=ws.error_display, zmin=-0.01)
+        for peak in peaks:
+            peak['note'] = '{0}, significance {1:.1f}'.format(peak['template'], peak['significance'])
+        self.propose_redshifts(peaks)
+
+        return peaks
+
+    def detect_lines(self):
+        # detect lines in the first spectrum, add new ones as trim lines and
+        # propose redshifts from matching them to the line list. Returns the
+        # detected lines, the number of new trim lines and the candidates.
+        self.apply_masks()
+        ws = self.specs[0]
+        with self.action('detect_lines'):
+            wave, flux, error = ws.wave * (1 + ws.addredshift), ws.spec_display * ws.mult + ws.add, \
+                None if ws.error_display is None else ws.error_display * np.abs(ws.mult)
+            lines = linedetect.detect_lines(wave, flux, error)
+            dmin = np.median(np.abs(np.diff(ws.wave))) * (1 + ws.addredshift)
+            nnew = 0
+            for w in lines['wave']:
+                if np.all(np.abs(np.array(self.plotting['trim_lines']) - w) > dmin):
+                    self.plotting['trim_lines'].append(float(w))
+                    nnew += 1
+            self.notify('annotations')
+
+            candidates = linedetect.match_lines(lines['wave'], self.linelist['waves'], labels=self.linelist['labels'], \
+                                                snr=lines['snr'], zmin=-0.01)
+            for candidate in candidates:
+                candidate['note'] = '{0:d} lines matched, S/N sum {1:.1f}'.format(candidate['nmatch'], candidate['score'])
+            self.propose_redshifts(candidates)
+
+        return lines, nnew, candidates
+
+    def propose_redshifts(self, candidates):
+        # offer redshift candidates for confirmation: next_candidate() steps
+        # through them, accept_candidate() keeps the one shown and
+        # reject_candidate() restores the redshift
+        self.z_candidates = candidates
+        self.z_candidate_index = 0
+        self.z_previous = self.plotting['redshift']
+
+        if len(self.z_candidates) == 0:
+            logger.info("No redshift candidate found")
+        else:
+            self.show_candidate()
+
+        return
+
+    def next_candidate(self):
+        self.z_candidate_index = (self.z_candidate_index + 1) % len(self.z_candidates)
+        self.show_candidate()
+
+        return
+
+    def show_candidate(self):
+        candidate = self.z_candidates[self.z_candidate_index]
+        with self.action('show_candidate'):
+            self.plotting['redshift'] = float(candidate['z'])
+            self.plotting['blocking'] = 'x'
+            self.notify('annotations')
+        logger.info("Redshift candidate {0:d}/{1:d} z = {2:.6f} ({3}) - 'enter' to accept, 'x' for next, 'escape' to cancel".format(
+            self.z_candidate_index + 1, len(self.z_candidates), candidate['z'], candidate['note']))
+
+        return
+
+    def accept_candidate(self):
+        with self.action('accept_candidate'):
+            self.plotting['blocking'] = None
+            self.notify('annotations')
+
+        return self.plotting['redshift']
+
+    def reject_candidate(self):
+        with self.action('reject_candidate'):
+            self.plotting['redshift'] = self.z_previous
+            self.plotting['blocking'] = None
+            self.notify('annotations')
+
+        return self.plotting['redshift']
+
+    def chi2_scan(self, zmin, zmax):
+        # chi2(z) of the first spectrum against each template spectrum on a
+        # grid at the native sampling, coarsened to keep the template grid
+        # below ~256 MB. Returns the grid and a list of (chi2, npix).
+        self.apply_masks()
+        ws = self.specs[0]
+        wave = np.sort(ws.wave * (1 + ws.addredshift))
+        dlnl = np.median(np.diff(np.log(wave)))
+        dlnl = max(dlnl, (np.log1p(zmax) - np.log1p(zmin)) * len(wave) * 16 / 2**28)
+        zgrid = redshift.zgrid_loglam(zmin, zmax, dlnl)
+
+        curves = []
+        for tspec in self.template_specs:
+            chi2, amp, npix = redshift.chi2_redshift(ws.wave * (1 + ws.addredshift), ws.spec_display * ws.mult + ws.add, \
+                                                     None if ws.error_display is None else ws.error_display * np.abs(ws.mult), \
+                                                     tspec.wave, tspec.spec, zgrid)
+            curves.append((chi2, npix))
+
+        return zgrid, curves
+
+    # -- files
+
+    def save_workspace(self, fn, embed=None, version=''):
+        workspace.save_workspace(fn, self.specs, self.plotting, self.linelist, \
+                                 gauss_wave=self.gauss_wave, gauss_model=self.gauss_model, \
+                                 version=version, embed=embed)
+
+        return
+
+    def load_workspace(self, fn, search_paths=()):
+        # replace the state by a workspace; returns the source files that
+        # were not found
+        wks = workspace.load_workspace(fn, search_paths=search_paths)
+        with self.action('load_workspace'):
+            self._set_state(wks['specs'], wks['plotting'], wks['linelist'], wks['gauss_wave'], wks['gauss_model'])
+
+        return wks['missing']
+
+    def start_journal(self, directory=None):
+        # journal the session for crash recovery
+        self.journal = journal.journal(directory)
+        self.record('start')
+
+        return
+
+    def recover(self, directory, search_paths=()):
+        # replace the state by the last one of a session journal; returns
+        # the number of entries replayed and the missing source files, or
+        # None if the journal is empty
+        state, nreplay = journal.read_journal(directory)
+        if state is None:
+            return None
+        specs, plotting, linelist, gauss_wave, gauss_model, missing = \
+            journal.restore_state(state, search_paths=search_paths)
+
+        # the recovered session starts a new undo history
+        self.history = history.history()
+        with self.action('recover'):
+            self._set_state(specs, plotting, linelist, gauss_wave, gauss_model)
+            if self.plotting['box'][0] is None:
+                self.reset_view()
+
+        return nreplay, missing
+
+    def close(self):
+        # a clean exit discards the journal
+        if self.journal is not None:
+            self.journal.close(discard=True)
+            self.journal = None
+
+        return
@@ -0,0 +1,126 @@
+# panel of a 2D spectrum: a decimated image of the memory-mapped data in the
+# wavelength range of the main plot, and apertures of spatial rows selected
+# by dragging vertically. 'Extract' adds the spectrum of the aperture to the
+# session; extractions are computed when first needed and cached.
+import os
+import logging
+import numpy as np
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QComboBox, QLabel
+from PyQt5.QtCore import Qt
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+from matplotlib.image import NonUniformImage
+from matplotlib.widgets import SpanSelector
+
+from .WaveSpec import spec2d
+
+logger = logging.getLogger(__name__)
+
+
+class spec2d_view(QDialog):
+
+    def __init__(self, session, s2d, parent=None):
+        super().__init__(parent)
+
+        self.session = session
+        self.s2d = s2d
+        self.aperture = None
+
+        self.setWindowTitle('2D Spectrum: ' + os.path.basename(s2d.filename))
+        self.resize(1000, 300)
+        layout = QVBoxLayout(self)
+
+        self.figure = Figure()
+        self.canvas = FigureCanvas(self.figure)
+        self.canvas.setFocusPolicy(Qt.ClickFocus)
+        # aligned in wavelength with the main plot
+        self.ax = self.figure.add_axes([0.125, 0.15, 0.775, 0.8])
+        self.ax.set_ylabel('Spatial pixel')
+        layout.addWidget(self.canvas)
+
+        controls = QHBoxLayout()
+        self.label = QLabel('Drag vertically to select an aperture')
+        controls.addWidget(self.label, 1)
+        self.method = QComboBox()
+        self.method.addItems(list(spec2d.METHODS))
+        controls.addWidget(self.method)
+        self.extractButton = QPushButton('Extract')
+        self.extractButton.setEnabled(False)
+        self.extractButton.clicked.connect(self.extract)
+        controls.addWidget(self.extractButton)
+        layout.addLayout(controls)
+
+        self.draw_image()
+        self.selector = SpanSelector(self.ax, self.on_select, 'vertical', useblit=True, interactive=True, \
+                                     props={"facecolor": 'red', "alpha": 0.2})
+
+        self.session.subscribe(self.on_session_changed)
+        self.follow_view()
+
+        return
+
+    def draw_image(self):
+        wave, spatial, image = self.s2d.preview()
+        if wave[-1] < wave[0]:
+            wave, image = wave[::-1], image[:, ::-1]
+        finite = image[np.isfinite(image)]
+        vmin, vmax = np.percentile(finite, [1, 99]) if len(finite) > 0 else (0, 1)
+
+        im = NonUniformImage(self.ax, interpolation='nearest', cmap='gray', origin='lower')
+        im.set_data(wave, spatial, np.ma.masked_invalid(image))
+        im.set_clim(vmin, vmax)
+        self.ax.add_image(im)
+        self.ax.set_ylim(-0.5, self.s2d.nspatial - 0.5)
+
+        return
+
+    def follow_view(self):
+        # the wavelength range of the main plot
+        box = self.session.plotting['box']
+        if box[0] is not None and box[2] is not None:
+            self.ax.set_xlim(box[0], box[2])
+        else:
+            self.ax.set_xlim(np.nanmin(self.s2d.wave), np.nanmax(self.s2d.wave))
+        self.canvas.draw_idle()
+
+        return
+
+    def on_session_changed(self, events):
+        if 'view' in events:
+            self.follow_view()
+
+        return
+
+    def on_select(self, y0, y1):
+        # rows whose centers are within the span
+        lo, hi = int(np.ceil(y0 - 0.5)), int(np.floor(y1 - 0.5)) + 1
+        lo, hi = max(lo, 0), min(hi, self.s2d.nspatial)
+        if hi <= lo:
+            self.aperture = None
+            self.extractButton.setEnabled(False)
+            return
+        self.aperture = (lo, hi)
+        self.label.setText('Aperture: rows {0:d} to {1:d}'.format(lo, hi - 1))
+        self.extractButton.setEnabled(True)
+
+        return
+
+    def extract(self):
+        if self.aperture is None:
+            return
+        method = self.method.currentText()
+        try:
+            ws = self.s2d.wavespec(*self.aperture, method=method)
+            # read now so that errors are reported here
+            ws.wave
+        except Exception as e:
+            logger.error("Extraction failed: {0}".format(e))
+            return
+        self.session.add([ws], reset_view=len(self.session.specs) == 0)
+        logger.info("Extracted {0}".format(ws.label))
+
+        return
+
+    def closeEvent(self, event):
+        self.session.unsubscribe(self.on_session_changed)
+        super().closeEvent(event)
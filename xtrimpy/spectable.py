@@ -0,0 +1,159 @@
+# model/view of the loaded spectra for the Loaded Files panel. The model
+# reads the spectra of a session when the view asks for a cell, so only the
+# visible rows are touched; edits go through the session, and a change of
+# some spectra only updates their rows.
+import os
+import logging
+from PyQt5.QtWidgets import QStyledItemDelegate, QStyle, QStyleOptionButton, QApplication
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, pyqtSignal
+from PyQt5.QtGui import QColor
+
+logger = logging.getLogger(__name__)
+
+# (header, spectrum parameter) of the columns
+COLUMNS = [
+    ("Filename", None),
+    ("+Redshift", 'addredshift'),
+    ("Smooth", 'smooth_width'),
+    ("x", 'mult'),
+    ("+", 'add'),
+    ("Color", 'color'),
+    ("", None)
+]
+EDITABLE = ('addredshift', 'smooth_width', 'mult', 'add')
+COLOR_COLUMN = 5
+DELETE_COLUMN = 6
+
+# numbers for sorting the parameter columns
+SORT_ROLE = Qt.UserRole
+
+
+class spec_table_model(QAbstractTableModel):
+
+    def __init__(self, session, parent=None):
+        super().__init__(parent)
+
+        self.session = session
+        self.rows = None    # row of each spectrum by id, built when needed
+
+        return
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.session.specs)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMNS[section][0]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if COLUMNS[index.column()][1] in EDITABLE:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        ws = self.session.specs[index.row()]
+        column = index.column()
+        name = COLUMNS[column][1]
+        if role in (Qt.DisplayRole, Qt.EditRole, SORT_ROLE):
+            if column == 0:
+                return os.path.basename(ws.filename)
+            if column == COLOR_COLUMN:
+                return 'C{0:d}'.format(index.row()) if role != SORT_ROLE else index.row()
+            if column == DELETE_COLUMN:
+                return 'Delete' if role == Qt.DisplayRole else None
+            value = getattr(ws, name)
+            return value if role == SORT_ROLE else str(value)
+        if role == Qt.ToolTipRole and column == 0:
+            return ws.filename
+        if role == Qt.BackgroundRole and column == COLOR_COLUMN and ws.color is not None:
+            return QColor(ws.color)
+
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        # edits are session actions (undo, journal); the session notifies
+        # the change of this spectrum
+        name = COLUMNS[index.column()][1]
+        if role != Qt.EditRole or name not in EDITABLE:
+            return False
+        try:
+            value = int(float(value)) if name == 'smooth_width' else float(value)
+        except (TypeError, ValueError):
+            logger.info("Invalid value for {0}: {1}".format(COLUMNS[index.column()][0], value))
+            return False
+
+        self.session.set_spec_param(index.row(), name, value)
+        logger.info("Modified spec table cell ({0}, {1}): {2}".format(index.row() + 1, COLUMNS[index.column()][0], value))
+
+        return True
+
+    def reset(self):
+        # the list of spectra changed
+        self.beginResetModel()
+        self.rows = None
+        self.endResetModel()
+
+        return
+
+    def specs_changed(self, specs):
+        # update the rows of the spectra whose parameters changed, one
+        # signal per run of consecutive rows
+        if self.rows is None:
+            self.rows = {id(ws): i for i, ws in enumerate(self.session.specs)}
+        rows = sorted(self.rows[id(ws)] for ws in specs if id(ws) in self.rows)
+
+        last = len(COLUMNS) - 1
+        start = 0
+        for k in range(1, len(rows) + 1):
+            if k == len(rows) or rows[k] != rows[k - 1] + 1:
+                self.dataChanged.emit(self.index(rows[start], 0), self.index(rows[k - 1], last))
+                start = k
+
+        return
+
+
+class spec_table_delegate(QStyledItemDelegate):
+    # draws the color swatches and the delete buttons; a click on a button
+    # emits deleteClicked with the row of the spectrum in the model
+
+    deleteClicked = pyqtSignal(int)
+
+    def paint(self, painter, option, index):
+        if index.column() == DELETE_COLUMN:
+            button = QStyleOptionButton()
+            button.rect = option.rect.adjusted(2, 2, -2, -2)
+            button.text = index.data()
+            button.state = QStyle.State_Enabled
+            style = option.widget.style() if option.widget is not None else QApplication.style()
+            style.drawControl(QStyle.CE_PushButton, button, painter, option.widget)
+            return
+
+        if index.column() == COLOR_COLUMN:
+            color = index.data(Qt.BackgroundRole)
+            painter.save()
+            if color is not None:
+                painter.fillRect(option.rect.adjusted(2, 2, -2, -2), color)
+            painter.drawText(option.rect, Qt.AlignCenter, index.data())
+            painter.restore()
+            return
+
+        super().paint(painter, option, index)
+
+    def editorEvent(self, event, model, option, index):
+        if index.column() == DELETE_COLUMN and event.type() == QEvent.MouseButtonRelease and \
+            option.rect.contains(event.pos()):
+            # rows of a sorted or filtered view differ from the model rows
+            if hasattr(model, 'mapToSource'):
+                index = model.mapToSource(index)
+            self.deleteClicked.emit(index.row())
+            return True
+
+        return super().editorEvent(event, model, option, index)
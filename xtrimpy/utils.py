@@ -1,36 +1,135 @@
+import os
 import numpy as np
-from scipy import optimize
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 #import WaveSpec.wavespec
 
+C_KMS = 299792.458  # speed of light in km/s
+
+# np.trapz was renamed in numpy 2
+try:
+    trapz = np.trapezoid
+except AttributeError:
+    trapz = np.trapz
+
 def calc_ew(wavespec, cp):
     # calculate EW and flux. 
     # Note: 1) If error spec is provided, the errors are caculated straightly from
     #   integration without pixel correlation. If smoothing is applied, the 
-    #   errors are significantly underestimated. 
+    #   errors are significantly underestimated. Use calc_ew_mc() for
+    #   Monte Carlo errors that include the correlation.
     #   2) Errors are approximate for uneven sampling.
 
     wave = wavespec.wave
     spec = wavespec.spec_display
     espec = wavespec.error_display
 
-    index = (wave >= cp[0]) & (wave < cp[2])
+    # masked pixels are NaN in the displayed spectrum
+    index = (wave >= cp[0]) & (wave < cp[2]) & np.isfinite(spec)
+    if espec is not None:
+        index = index & np.isfinite(espec)
     ctm=(wave[index] - cp[0]) / (cp[2] - cp[0]) * (cp[3] - cp[1]) + cp[1]
 
-    ew = np.trapz(spec[index] / ctm - 1, wave[index])
+    ew = trapz(spec[index] / ctm - 1, wave[index])
     if espec is not None:
-        ew_sig = np.sqrt(np.trapz((espec[index] / ctm)**2)) * ((cp[2] - cp[0]) / np.sum(index))
+        ew_sig = np.sqrt(trapz((espec[index] / ctm)**2)) * ((cp[2] - cp[0]) / np.sum(index))
     else:
         ew_sig = np.nan
 
-    flux = np.trapz(spec[index] - ctm, wave[index])
+    flux = trapz(spec[index] - ctm, wave[index])
     if espec is not None:
-        flux_sig = np.sqrt(np.trapz(espec[index]**2)) * ((cp[2] - cp[0]) / np.sum(index))
+        flux_sig = np.sqrt(trapz(espec[index]**2)) * ((cp[2] - cp[0]) / np.sum(index))
     else:
         flux_sig = np.nan
 
     return [ew, ew_sig], [flux, flux_sig]
 
 
+def calc_ew_continuum(wavespec, window, cont):
+    # EW and flux within window = [w0, w1] relative to a continuum on the
+    # pixels of the spectrum, e.g. from continuum.continuum(). Wavelengths
+    # are in the displayed frame; errors as in calc_ew().
+    wave = wavespec.wave * (1 + wavespec.addredshift)
+    spec = wavespec.spec_display
+    espec = wavespec.error_display
+
+    index = (wave >= window[0]) & (wave < window[1]) & np.isfinite(spec) & np.isfinite(cont)
+    order = np.argsort(wave[index])
+    wave = wave[index][order]
+    spec = spec[index][order]
+    ctm = cont[index][order]
+
+    ew = trapz(spec / ctm - 1, wave)
+    flux = trapz(spec - ctm, wave)
+    if espec is not None:
+        espec = espec[index][order]
+        ew_sig = np.sqrt(trapz((espec / ctm)**2)) * ((window[1] - window[0]) / len(wave))
+        flux_sig = np.sqrt(trapz(espec**2)) * ((window[1] - window[0]) / len(wave))
+    else:
+        ew_sig = np.nan
+        flux_sig = np.nan
+
+    return [ew, ew_sig], [flux, flux_sig]
+
+def mc_noise(wavespec, idx, nreal, rng=None):
+    # (nreal, len(idx)) noise realizations for the pixels idx of spec_display.
+    # If the spectrum was smoothed, white noise drawn from the original error
+    # spectrum is passed through the same kernel, so that the realizations
+    # carry the pixel correlation of the displayed spectrum.
+    from scipy.ndimage import convolve1d
+
+    if wavespec.error_display is None:
+        raise ValueError("Monte Carlo errors need an error spectrum.")
+    if rng is None:
+        rng = np.random.default_rng()
+    idx = np.asarray(idx)
+
+    kernel = wavespec.noise_kernel()
+    if kernel is None:
+        sigma = np.nan_to_num(wavespec.error_display[idx])
+        return rng.standard_normal((nreal, len(idx))) * sigma
+
+    # draw over the span of idx plus the kernel half width and convolve
+    half = len(kernel) // 2
+    i0 = max(idx.min() - half, 0)
+    i1 = min(idx.max() + half + 1, len(wavespec.error))
+    sigma = np.nan_to_num(np.asarray(wavespec.error[i0:i1], dtype=float))
+    noise = rng.standard_normal((nreal, i1 - i0)) * sigma
+    noise = convolve1d(noise, kernel, axis=1, mode='constant')
+
+    return noise[:, idx - i0]
+
+def _mc_chunks(nreal, nbytes_per_real, max_bytes):
+    # split nreal realizations into chunks that respect the memory cap
+    nchunk = int(max(1, max_bytes // max(nbytes_per_real, 1)))
+    for start in range(0, nreal, nchunk):
+        yield min(nchunk, nreal - start)
+
+def calc_ew_mc(wavespec, cp, nreal=1000, max_bytes=64*2**20, rng=None):
+    # calc_ew() with Monte Carlo errors. The perturbed spectra are measured
+    # as 2D batches of realizations, chunked to stay below max_bytes.
+    ew, flux = calc_ew(wavespec, cp)
+
+    wave = wavespec.wave
+    idx = np.flatnonzero((wave >= cp[0]) & (wave < cp[2]) & np.isfinite(wavespec.spec_display) & \
+                         np.isfinite(wavespec.error_display))
+    wave_win = wave[idx]
+    spec_win = wavespec.spec_display[idx]
+    ctm = (wave_win - cp[0]) / (cp[2] - cp[0]) * (cp[3] - cp[1]) + cp[1]
+
+    # a few arrays of the size of the window (plus kernel) per realization
+    nbytes = 8 * 4 * (len(idx) + 2 * wavespec.smooth_width + 1)
+    ews = []
+    fluxes = []
+    for n in _mc_chunks(nreal, nbytes, max_bytes):
+        spec_mc = spec_win + mc_noise(wavespec, idx, n, rng=rng)
+        ews.append(trapz(spec_mc / ctm - 1, wave_win, axis=1))
+        fluxes.append(trapz(spec_mc - ctm, wave_win, axis=1))
+
+    ew[1] = np.nanstd(np.concatenate(ews))
+    flux[1] = np.nanstd(np.concatenate(fluxes))
+
+    return ew, flux
+
 def gauss(x, area, center, sigma, lin0, lin1):
     # define Gaussian function on linear continuum
 
@@ -39,43 +138,465 @@ def gauss(x, area, center, sigma, lin0, lin1):
 
     return y
 
-def fit_gauss(wavespec, gl):
-    # fit Gaussian profile and measure flux
+def gauss_jac(x, area, center, sigma, lin0, lin1):
+    # analytic Jacobian of gauss() with respect to its five parameters
+
+    u = (x - center) / sigma
+    profile = np.exp(-.5 * u**2) / np.sqrt(2*np.pi * sigma**2)
+    g = area * profile
+
+    jac = np.empty((len(x), 5))
+    jac[:, 0] = profile
+    jac[:, 1] = g * u / sigma - lin1
+    jac[:, 2] = g * (u**2 - 1) / sigma
+    jac[:, 3] = 1.
+    jac[:, 4] = x - center
+
+    return jac
+
+def gauss_index(wavespec, gl):
+    # indices of the finite pixels of the displayed spectrum within the
+    # fitting limits, sorted in (redshifted) wavelength
     wave = wavespec.wave * (wavespec.addredshift + 1)
-    spec = wavespec.spec_display * wavespec.mult + wavespec.add
+    spec = wavespec.spec_display
     espec = wavespec.error_display
-    if espec is not None:
-        espec = wavespec.error_display * wavespec.mult + wavespec.add
 
-    index = (wave >= gl[0]) & (wave < gl[1]) * np.isfinite(spec)
+    index = (wave >= gl[0]) & (wave < gl[1]) & np.isfinite(spec)
     if espec is not None:
-        index = index * np.isfinite(espec)
-    spec_fit = spec[index]
-    if espec is not None:
-        espec_fit = espec[index]
-    wave_fit = wave[index]
-    index = np.argsort(wave_fit)
-    wave_fit = wave_fit[index]
-    spec_fit = spec_fit[index]
-    if espec is not None:
-        espec_fit = espec_fit[index]
+        index = index & np.isfinite(espec) & (espec > 0)
+
+    idx = np.flatnonzero(index)
+    return idx[np.argsort(wave[idx], kind='stable')]
+
+def gauss_window(wavespec, gl):
+    # the displayed spectrum within the fitting limits, sorted in wavelength
+    idx = gauss_index(wavespec, gl)
 
-    # calculate initial guess
-    guess = (np.max(spec_fit) - np.min(spec_fit), np.median(wave_fit), (wave_fit[-1] - wave_fit[1])/2, np.median(spec_fit), 0)
-    if espec is None:
-        popt, pcov = optimize.curve_fit(gauss, wave_fit, spec_fit, p0=guess)
+    wave_fit = wavespec.wave[idx] * (wavespec.addredshift + 1)
+    spec_fit = wavespec.spec_display[idx] * wavespec.mult + wavespec.add
+    if wavespec.error_display is not None:
+        espec_fit = wavespec.error_display[idx] * np.abs(wavespec.mult)
     else:
-        popt, pcov = optimize.curve_fit(gauss, wave_fit, spec_fit, p0=guess, \
+        espec_fit = None
+
+    return wave_fit, spec_fit, espec_fit
+
+def gauss_guess(wave, spec):
+    # vectorized initial guesses for gauss(). wave and spec are (nitem, npix)
+    # arrays with valid pixels packed to the left and padded with NaN, so that
+    # many fitting windows are handled at once. Returns (nitem, 5).
+    wave = np.atleast_2d(np.asarray(wave, dtype=float))
+    spec = np.atleast_2d(np.asarray(spec, dtype=float))
+    nitem, npix = wave.shape
+
+    valid = np.isfinite(wave) & np.isfinite(spec)
+    npt = valid.sum(axis=1)
+    col = np.arange(npix)[None, :]
+
+    # continuum through the medians of the outer fifths of the window
+    nedge = np.maximum(npt // 5, 1)[:, None]
+    left = valid & (col < nedge)
+    right = valid & (col >= npt[:, None] - nedge)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w_left = np.nanmedian(np.where(left, wave, np.nan), axis=1)
+        w_right = np.nanmedian(np.where(right, wave, np.nan), axis=1)
+        c_left = np.nanmedian(np.where(left, spec, np.nan), axis=1)
+        c_right = np.nanmedian(np.where(right, spec, np.nan), axis=1)
+        slope = np.where(w_right > w_left, (c_right - c_left) / (w_right - w_left), 0.)
+    slope = np.nan_to_num(slope)
+    cont = c_left[:, None] + slope[:, None] * (wave - w_left[:, None])
+    resid = np.where(valid, spec - cont, 0.)
+
+    # emission or absorption, whichever deviates the most
+    sign = np.where(np.max(resid, axis=1) >= -np.min(resid, axis=1), 1., -1.)
+    ipeak = np.argmax(sign[:, None] * resid, axis=1)
+    rows = np.arange(nitem)
+    center = wave[rows, ipeak]
+    peak = resid[rows, ipeak]
+
+    # integrated residual over the window
+    pair = valid[:, 1:] & valid[:, :-1]
+    dw = np.where(pair, np.diff(np.where(valid, wave, 0.), axis=1), 0.)
+    area = np.sum(0.5 * (resid[:, 1:] + resid[:, :-1]) * dw, axis=1)
+
+    # width from area / peak, limited to [median pixel, half window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dpix = np.nanmedian(np.where(pair, dw, np.nan), axis=1)
+        wspan = np.nanmax(np.where(valid, wave, np.nan), axis=1) - \
+            np.nanmin(np.where(valid, wave, np.nan), axis=1)
+        sigma = np.abs(area) / (np.sqrt(2*np.pi) * np.abs(peak))
+    dpix = np.where(np.isfinite(dpix) & (dpix > 0), dpix, 1.)
+    wspan = np.where(np.isfinite(wspan) & (wspan > 0), wspan, 2 * dpix)
+    sigma = np.where(np.isfinite(sigma), sigma, wspan / 4)
+    sigma = np.clip(sigma, dpix, np.maximum(wspan / 2, dpix))
+
+    # fall back to the peak height if the integral has the wrong sign
+    bad_area = ~np.isfinite(area) | (area * sign <= 0)
+    area = np.where(bad_area, peak * np.sqrt(2*np.pi) * sigma, area)
+
+    lin0 = c_left + slope * (center - w_left)
+
+    return np.column_stack([area, center, sigma, lin0, slope])
+
+def fit_gauss_arrays(wave_fit, spec_fit, espec_fit=None, guess=None):
+    # fit gauss() to prepared arrays with the analytic Jacobian
+    from scipy import optimize
+
+    if guess is None:
+        guess = gauss_guess(wave_fit, spec_fit)[0]
+
+    if espec_fit is None:
+        popt, pcov = optimize.curve_fit(gauss, wave_fit, spec_fit, p0=guess, jac=gauss_jac)
+    else:
+        popt, pcov = optimize.curve_fit(gauss, wave_fit, spec_fit, p0=guess, jac=gauss_jac, \
                                         sigma=espec_fit, absolute_sigma=True)
 
-    specmodel = gauss(wave_fit, *popt)
+    return popt, pcov
 
+def gauss_values(popt, pcov):
+    # flux, EW and line center with errors from the fitted parameters
     flux = [popt[0], np.sqrt(pcov[0, 0])]
     ew = [popt[0] / popt[3], np.sqrt(pcov[0, 0] / popt[3]**2 + popt[0]**2 * pcov[3, 3] / popt[3]**4)]
     center = [popt[1], np.sqrt(pcov[1, 1])]
 
+    return flux, ew, center
+
+def fit_gauss(wavespec, gl):
+    # fit Gaussian profile and measure flux
+    wave_fit, spec_fit, espec_fit = gauss_window(wavespec, gl)
+
+    popt, pcov = fit_gauss_arrays(wave_fit, spec_fit, espec_fit)
+    specmodel = gauss(wave_fit, *popt)
+
+    flux, ew, center = gauss_values(popt, pcov)
+
+    return flux, ew, center, wave_fit, specmodel
+
+def fit_gauss_mc(wavespec, gl, nreal=1000, max_bytes=64*2**20, rng=None, niter=10):
+    # fit_gauss() with Monte Carlo errors. Every realization is refitted
+    # starting from the best fit with damped Gauss-Newton steps that are
+    # solved for the whole batch of realizations at once.
+    idx = gauss_index(wavespec, gl)
+    wave_fit, spec_fit, espec_fit = gauss_window(wavespec, gl)
+    if espec_fit is None:
+        raise ValueError("Monte Carlo errors need an error spectrum.")
+
+    popt, pcov = fit_gauss_arrays(wave_fit, spec_fit, espec_fit)
+    specmodel = gauss(wave_fit, *popt)
+    flux, ew, center = gauss_values(popt, pcov)
+
+    weight = 1. / espec_fit**2
+    x = wave_fit[None, :]
+
+    # model, residual and a (npix, 5) Jacobian per realization
+    nbytes = 8 * 10 * (len(idx) + 2 * wavespec.smooth_width + 1)
+    params = []
+    for n in _mc_chunks(nreal, nbytes, max_bytes):
+        spec_mc = spec_fit + mc_noise(wavespec, idx, n, rng=rng) * np.abs(wavespec.mult)
+        p = np.tile(popt, (n, 1))
+        for _ in range(niter):
+            area, cen, sig, lin0, lin1 = [p[:, i:i+1] for i in range(5)]
+            u = (x - cen) / sig
+            profile = np.exp(-.5 * u**2) / np.sqrt(2*np.pi * sig**2)
+            g = area * profile
+            resid = spec_mc - (g + lin0 + lin1 * (x - cen))
+            jac = np.stack([profile, g * u / sig - lin1, g * (u**2 - 1) / sig, \
+                            np.ones_like(u), np.broadcast_to(x - cen, u.shape)], axis=2)
+            jtw = jac.transpose(0, 2, 1) * weight
+            alpha = jtw @ jac
+            alpha = alpha + 1e-3 * np.diagonal(alpha, axis1=1, axis2=2)[:, :, None] * np.eye(5)
+            beta = np.einsum('rkp,rp->rk', jtw, resid)
+            with np.errstate(invalid='ignore'):
+                p = p + np.linalg.solve(alpha, beta[:, :, None])[:, :, 0]
+        params.append(p)
+    params = np.concatenate(params)
+    params = params[np.all(np.isfinite(params), axis=1)]
+
+    flux[1] = np.std(params[:, 0])
+    ew[1] = np.std(params[:, 0] / params[:, 3])
+    center[1] = np.std(params[:, 1])
+
     return flux, ew, center, wave_fit, specmodel
 
+def _line_ranges(wave, centers, sigmas, ncut=8.):
+    # pixel index ranges within ncut sigma of each line on a sorted grid
+    i0 = np.searchsorted(wave, centers - ncut * sigmas, side='left')
+    i1 = np.searchsorted(wave, centers + ncut * sigmas, side='right')
+    return i0, i1
+
+def multigauss(x, params, rest_waves, xref):
+    # Gaussian lines with a common redshift and velocity dispersion on a
+    # linear continuum. params = [z, sigma_v (km/s), lin0, lin1, area_1, ...]
+    # with the continuum evaluated relative to xref. x must be sorted.
+    z, sigv, lin0, lin1 = params[:4]
+    areas = params[4:]
+
+    centers = np.asarray(rest_waves) * (1 + z)
+    sigmas = centers * sigv / C_KMS
+    y = lin0 + lin1 * (x - xref)
+
+    i0, i1 = _line_ranges(x, centers, sigmas)
+    for k in range(len(areas)):
+        xs = x[i0[k]:i1[k]]
+        y[i0[k]:i1[k]] += areas[k] / np.sqrt(2*np.pi * sigmas[k]**2) * \
+            np.exp(-.5*((xs - centers[k]) / sigmas[k])**2)
+
+    return y
+
+def multigauss_jac(x, params, rest_waves, xref):
+    # sparse analytic Jacobian of multigauss(). Each line only touches the
+    # pixels within a few sigma of its center, so the area columns are
+    # banded and the redshift/width columns are sums over those bands.
+    from scipy import sparse
+
+    z, sigv = params[:2]
+    areas = params[4:]
+    npix = len(x)
+    nline = len(areas)
+
+    centers = np.asarray(rest_waves) * (1 + z)
+    sigmas = centers * sigv / C_KMS
+    i0, i1 = _line_ranges(x, centers, sigmas)
+
+    dz = np.zeros(npix)
+    dv = np.zeros(npix)
+    rows = [np.arange(npix), np.arange(npix)]
+    cols = [np.full(npix, 2), np.full(npix, 3)]
+    vals = [np.ones(npix), x - xref]
+    for k in range(nline):
+        xs = x[i0[k]:i1[k]]
+        u = (xs - centers[k]) / sigmas[k]
+        profile = np.exp(-.5 * u**2) / np.sqrt(2*np.pi * sigmas[k]**2)
+        g = areas[k] * profile
+        dz[i0[k]:i1[k]] += g / (1 + z) * (u * C_KMS / sigv + u**2 - 1)
+        dv[i0[k]:i1[k]] += g * (u**2 - 1) / sigv
+
+        rows.append(np.arange(i0[k], i1[k]))
+        cols.append(np.full(i1[k] - i0[k], 4 + k))
+        vals.append(profile)
+
+    rows += [np.arange(npix), np.arange(npix)]
+    cols += [np.zeros(npix, dtype=int), np.ones(npix, dtype=int)]
+    vals += [dz, dv]
+
+    return sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), \
+                             shape=(npix, 4 + nline))
+
+def fit_lines(wavespec, gl, line_waves, redshift, labels=None):
+    # simultaneous fit of all the lines with rest wavelengths in line_waves
+    # that fall within the limits gl at the given redshift. The lines share
+    # one redshift and one velocity dispersion on a linear continuum.
+    from scipy.optimize import least_squares
+
+    wave_fit, spec_fit, espec_fit = gauss_window(wavespec, gl)
+    if len(wave_fit) < 5:
+        raise ValueError("Too few valid pixels in the fitting window.")
+
+    line_waves = np.asarray(line_waves, dtype=float)
+    if labels is None:
+        labels = ['{0:.2f}'.format(w) for w in line_waves]
+    inwin = (line_waves * (1 + redshift) >= wave_fit[0]) & (line_waves * (1 + redshift) <= wave_fit[-1])
+    rest_waves = line_waves[inwin]
+    labels = [label for label, keep in zip(labels, inwin) if keep]
+    nline = len(rest_waves)
+    if nline == 0:
+        raise ValueError("No line list entries within the fitting window.")
+
+    # initial guesses: continuum from the window edges, a width of ~2 pixels
+    # and the continuum-subtracted flux at each line center
+    xref = 0.5 * (wave_fit[0] + wave_fit[-1])
+    single = gauss_guess(wave_fit, spec_fit)[0]
+    lin1 = single[4]
+    lin0 = single[3] + lin1 * (xref - single[1])
+    dpix = np.median(np.diff(wave_fit))
+    sigv = max(C_KMS * 2 * dpix / xref, 1.)
+    centers = rest_waves * (1 + redshift)
+    resid = np.interp(centers, wave_fit, spec_fit) - (lin0 + lin1 * (centers - xref))
+    areas = resid * np.sqrt(2*np.pi) * centers * sigv / C_KMS
+    p0 = np.concatenate([[redshift, sigv, lin0, lin1], areas])
+
+    dz = 0.01 * (1 + redshift)
+    lower = np.full(len(p0), -np.inf)
+    upper = np.full(len(p0), np.inf)
+    lower[:2] = redshift - dz, 1e-3
+    upper[:2] = redshift + dz, C_KMS / 10
+
+    weight = 1. / espec_fit if espec_fit is not None else np.ones(len(wave_fit))
+    def resid_func(p):
+        return (multigauss(wave_fit, p, rest_waves, xref) - spec_fit) * weight
+    def jac_func(p):
+        return multigauss_jac(wave_fit, p, rest_waves, xref).multiply(weight[:, None]).tocsr()
+
+    res = least_squares(resid_func, p0, jac=jac_func, bounds=(lower, upper), \
+                        method='trf', tr_solver='lsmr', x_scale='jac')
+    popt = res.x
+
+    # covariance from the (small, dense) normal matrix
+    jac = res.jac
+    jtj = (jac.T @ jac).toarray() if hasattr(jac, 'toarray') else jac.T @ jac
+    pcov = np.linalg.pinv(jtj)
+    if espec_fit is None:
+        dof = max(len(wave_fit) - len(popt), 1)
+        pcov = pcov * np.sum(res.fun**2) / dof
+
+    # per-line quantities
+    z = popt[0]
+    centers = rest_waves * (1 + z)
+    cont = popt[2] + popt[3] * (centers - xref)
+    flux = np.column_stack([popt[4:], np.sqrt(np.diag(pcov)[4:])])
+    ew = np.zeros((nline, 2))
+    for k in range(nline):
+        grad = np.zeros(len(popt))
+        grad[4 + k] = 1 / cont[k]
+        grad[2] = -popt[4 + k] / cont[k]**2
+        grad[3] = -popt[4 + k] * (centers[k] - xref) / cont[k]**2
+        grad[0] = -popt[4 + k] * popt[3] * rest_waves[k] / cont[k]**2
+        ew[k] = popt[4 + k] / cont[k], np.sqrt(grad @ pcov @ grad)
+    center = np.column_stack([centers, rest_waves * np.sqrt(pcov[0, 0])])
+
+    return {
+        "labels": labels,
+        "rest_waves": rest_waves,
+        "redshift": [z, np.sqrt(pcov[0, 0])],
+        "sigma_v": [popt[1], np.sqrt(pcov[1, 1])],
+        "flux": flux,
+        "ew": ew,
+        "center": center,
+        "popt": popt,
+        "pcov": pcov,
+        "wave": wave_fit,
+        "model": multigauss(wave_fit, popt, rest_waves, xref)
+    }
+
+def pool_map(func, items, nproc=None, chunksize=None, initializer=None, initargs=()):
+    # map func over items in a process pool, preserving the order.
+    # func must be a module-level function so that it can be pickled.
+    # nproc=1 runs everything serially in this process.
+    items = list(items)
+    if nproc is None:
+        nproc = os.cpu_count() or 1
+    nproc = min(nproc, len(items))
+
+    if nproc <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [func(item) for item in items]
+
+    if chunksize is None:
+        chunksize = max(1, len(items) // (4 * nproc))
+    with ProcessPoolExecutor(max_workers=nproc, initializer=initializer, initargs=initargs) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+def pool_imap(func, items, nproc=None, initializer=None, initargs=(), max_pending=None, ordered=False):
+    # like pool_map(), but yields (index, result) as the items finish, with
+    # at most max_pending items submitted at a time so that results can be
+    # written out while long lists are still running. With ordered=True the
+    # results are yielded in the order of the items, and the results held
+    # back for that count as pending, so that they stay bounded as well.
+    if nproc is None:
+        nproc = os.cpu_count() or 1
+
+    if nproc <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for i, item in enumerate(items):
+            yield i, func(item)
+        return
+
+    if max_pending is None:
+        max_pending = 4 * nproc
+    items = enumerate(items)
+    with ProcessPoolExecutor(max_workers=nproc, initializer=initializer, initargs=initargs) as executor:
+        pending = {}
+        finished = {}
+        next_index = 0
+        while True:
+            if len(pending) + len(finished) < max_pending:
+                for i, item in items:
+                    pending[executor.submit(func, item)] = i
+                    if len(pending) + len(finished) >= max_pending:
+                        break
+            if len(pending) == 0:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if ordered:
+                    finished[pending.pop(future)] = future.result()
+                else:
+                    yield pending.pop(future), future.result()
+            while next_index in finished:
+                yield next_index, finished.pop(next_index)
+                next_index += 1
+
+def _fit_gauss_item(item):
+    # worker for fit_gauss_batch(); never raises
+    wave_fit, spec_fit, espec_fit, guess = item
+    try:
+        popt, pcov = fit_gauss_arrays(wave_fit, spec_fit, espec_fit, guess)
+        if not np.all(np.isfinite(pcov)):
+            return popt, pcov, 'covariance could not be estimated'
+        return popt, pcov, ''
+    except Exception as e:
+        return None, None, '{0}: {1}'.format(type(e).__name__, e)
+
+def fit_gauss_batch(wavespecs, windows, nproc=None):
+    # fit gauss() to many spectrum/window pairs in a process pool.
+    # windows is either a single [w0, w1] pair applied to every spectrum or
+    # one pair per spectrum. Failed fits are reported per item in 'success'
+    # and 'message' instead of raising; their values are NaN.
+
+    nitem = len(wavespecs)
+    windows = np.asarray(windows, dtype=float)
+    if windows.ndim == 1:
+        windows = np.tile(windows, (nitem, 1))
+    if len(windows) != nitem:
+        raise ValueError("Need one fitting window per spectrum.")
+
+    result = {
+        "flux": np.full((nitem, 2), np.nan),
+        "ew": np.full((nitem, 2), np.nan),
+        "center": np.full((nitem, 2), np.nan),
+        "popt": np.full((nitem, 5), np.nan),
+        "pcov": np.full((nitem, 5, 5), np.nan),
+        "success": np.zeros(nitem, dtype=bool),
+        "message": [''] * nitem
+    }
+
+    # cut the windows and pack them for the vectorized initial guesses
+    cuts = [gauss_window(ws, gl) for ws, gl in zip(wavespecs, windows)]
+    good = []
+    for i, cut in enumerate(cuts):
+        if len(cut[0]) < 5:
+            result['message'][i] = 'fewer than 5 valid pixels in window'
+        else:
+            good.append(i)
+    if len(good) == 0:
+        return result
+
+    npix = max(len(cuts[i][0]) for i in good)
+    wave_pack = np.full((len(good), npix), np.nan)
+    spec_pack = np.full((len(good), npix), np.nan)
+    for j, i in enumerate(good):
+        wave_pack[j, :len(cuts[i][0])] = cuts[i][0]
+        spec_pack[j, :len(cuts[i][1])] = cuts[i][1]
+    guesses = gauss_guess(wave_pack, spec_pack)
+
+    fits = pool_map(_fit_gauss_item, [(*cuts[i], guesses[j]) for j, i in enumerate(good)], nproc=nproc)
+
+    for i, (popt, pcov, message) in zip(good, fits):
+        result['message'][i] = message
+        if popt is None:
+            continue
+        result['popt'][i] = popt
+        result['pcov'][i] = pcov
+        flux, ew, center = gauss_values(popt, pcov)
+        result['flux'][i] = flux
+        result['ew'][i] = ew
+        result['center'][i] = center
+        result['success'][i] = message == ''
+
+    return result
+
 def parse_line_list(line):
     # Split the line by whitespace
     parts = line.strip().split()
@@ -0,0 +1,236 @@
+# opt-in reload of spectra whose files change on disk, e.g. while a reduction
+# pipeline rewrites them. Files are watched with QFileSystemWatcher (inotify
+# on Linux) where possible, and polled for changes of their modification
+# time and size otherwise, or always in the 'poll' mode (e.g. on network file
+# systems). A change is acted upon once the file has been quiet for
+# DEBOUNCE_MS; it is then read again in a worker thread with the loader of
+# each of its spectra (or their extraction), and the session replaces the
+# data, keeping the display parameters. The data of watched spectra are kept
+# in memory rather than memory-mapped: a file rewritten in place would take
+# the pages of the mapping away (SIGBUS).
+import os
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QObject, QTimer, QFileSystemWatcher, pyqtSignal
+
+from . import workspace
+
+logger = logging.getLogger(__name__)
+
+MODES = ('auto', 'poll')
+# quiet time after the last change of a file before it is read, polling
+# interval, and files read at the same time
+DEBOUNCE_MS = 500
+POLL_MS = 1000
+READERS = 2
+
+
+def signature(path):
+    # (modification time, size) of a file, None if it does not exist
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return st.st_mtime_ns, st.st_size
+
+
+def _in_memory(data):
+    return tuple(None if a is None else np.array(a) for a in data)
+
+
+def detach(ws):
+    # data of a spectrum copied into memory, now or when it is read
+    if '_source' in ws.__dict__:
+        source = ws.__dict__['_source']
+        ws._source = lambda: _in_memory(source())
+        if hasattr(source, 'workspace'):
+            ws._source.workspace = source.workspace
+    else:
+        ws.wave, ws.spec, ws.error = _in_memory((ws.wave, ws.spec, ws.error))
+
+    return
+
+
+def read_specs(specs):
+    # worker: [(ws, (wave, spec, error) or the exception)] of spectra of the
+    # same file, read again; never raises
+    from .WaveSpec import spec2d, cube
+
+    results = []
+    cleared = False
+    for ws in specs:
+        try:
+            # spectra of old pickled workspaces have no extraction
+            extraction = getattr(ws, 'extraction', None)
+            if extraction is not None:
+                if not cleared:
+                    # the open 2D spectra and cubes map the old contents
+                    spec2d.open_spec2d.cache_clear()
+                    cube.open_cube.cache_clear()
+                    cleared = True
+                data = workspace._extraction_source(ws.filename, extraction)()
+            else:
+                data = ws.loader(ws.filename)
+            results.append((ws, _in_memory(data)))
+        except Exception as e:
+            results.append((ws, e))
+
+    return results
+
+
+class spec_watcher(QObject):
+
+    # path, its signature before reading, results of read_specs(); emitted
+    # by the worker threads and received in the GUI thread
+    loaded = pyqtSignal(str, object, object)
+
+    def __init__(self, session, mode='auto', parent=None):
+        super().__init__(parent)
+
+        if mode not in MODES:
+            raise ValueError("Unknown watch mode: {0}".format(mode))
+        self.session = session
+        self.mode = mode
+        self.shown = {}     # watched path: signature of the data shown
+        self.seen = {}      # watched path: signature at the last change
+        self.timers = {}    # path: debounce timer
+        self.reading = set()
+        self.dirty = set()  # paths changed again while being read
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=READERS)
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.on_changed)
+        self.loaded.connect(self.on_loaded)
+        # polls the paths that QFileSystemWatcher does not watch, e.g. files
+        # that were replaced rather than rewritten
+        self.poller = QTimer(self)
+        self.poller.timeout.connect(self.poll)
+        self.poller.start(POLL_MS)
+
+        self.session.subscribe(self.on_session_changed)
+        self.sync()
+
+        return
+
+    def specs_of(self, path):
+        return [ws for ws in self.session.specs if os.path.abspath(ws.filename) == path]
+
+    def sync(self):
+        # watch the files of the spectra of the session
+        paths = {os.path.abspath(ws.filename) for ws in self.session.specs if os.path.isfile(ws.filename)}
+        for path in set(self.shown) - paths:
+            del self.shown[path]
+            del self.seen[path]
+            if path in self.watcher.files():
+                self.watcher.removePath(path)
+            timer = self.timers.pop(path, None)
+            if timer is not None:
+                timer.stop()
+                timer.deleteLater()
+        for path in paths - set(self.shown):
+            self.shown[path] = self.seen[path] = signature(path)
+            for ws in self.specs_of(path):
+                detach(ws)
+            self.watch(path)
+
+        return
+
+    def watch(self, path):
+        if self.mode == 'auto' and path not in self.watcher.files() and os.path.isfile(path):
+            # polled if this fails
+            self.watcher.addPath(path)
+
+        return
+
+    def poll(self):
+        watched = set(self.watcher.files())
+        for path in self.shown:
+            if path in watched:
+                continue
+            sig = signature(path)
+            if sig != self.seen[path]:
+                self.seen[path] = sig
+                self.on_changed(path)
+
+        return
+
+    def on_changed(self, path):
+        # (re)start the debounce timer of the path
+        if path not in self.shown:
+            return
+        if path not in self.timers:
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.timeout.connect(lambda path=path: self.settle(path))
+            self.timers[path] = timer
+        self.timers[path].start(DEBOUNCE_MS)
+
+        return
+
+    def settle(self, path):
+        # the file has been quiet: read it again if it changed
+        if self.closed or path not in self.shown:
+            return
+        sig = signature(path)
+        self.seen[path] = sig
+        # removed or replaced files drop out of QFileSystemWatcher
+        self.watch(path)
+        if sig is None or sig == self.shown[path]:
+            return
+        if path in self.reading:
+            self.dirty.add(path)
+            return
+
+        specs = self.specs_of(path)
+        if len(specs) == 0:
+            return
+        self.reading.add(path)
+        future = self.executor.submit(read_specs, specs)
+        future.add_done_callback(lambda future, path=path, sig=sig: self.loaded.emit(path, sig, future.result()))
+
+        return
+
+    def on_loaded(self, path, sig, results):
+        self.reading.discard(path)
+        if self.closed or path not in self.shown:
+            return
+
+        ok = False
+        for ws, data in results:
+            # unless removed from the session meanwhile
+            if not any(ws is spec for spec in self.session.specs):
+                continue
+            if isinstance(data, Exception):
+                logger.warning("Could not reload {0}: {1}: {2}".format(path, type(data).__name__, data))
+                continue
+            self.session.reload(ws, data)
+            ok = True
+        if ok:
+            self.shown[path] = sig
+            logger.info("Reloaded {0}".format(path))
+        if path in self.dirty:
+            self.dirty.discard(path)
+            self.on_changed(path)
+
+        return
+
+    def on_session_changed(self, events):
+        if 'specs' in events:
+            self.sync()
+
+        return
+
+    def close(self):
+        self.closed = True
+        self.session.unsubscribe(self.on_session_changed)
+        self.poller.stop()
+        for timer in self.timers.values():
+            timer.stop()
+        if len(self.watcher.files()) > 0:
+            self.watcher.removePaths(self.watcher.files())
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        return
@@ -0,0 +1,317 @@
+# versioned workspace files. A workspace is a zip archive with a JSON
+# manifest that refers to the spectra by file name and loader, keeps the
+# per-spectrum display parameters and the measurement state, and may embed
+# the spectrum arrays as .npy members (compressed in chunks, or stored
+# uncompressed so that they can be memory-mapped).
+import os
+import json
+import struct
+import functools
+import pickle
+import zipfile
+import numpy as np
+
+from .WaveSpec import wavespec, sloader
+
+FORMAT = 'xtrimpy-workspace'
+VERSION = 1
+MANIFEST = 'workspace.json'
+CHUNK = 2**20   # elements per member of a compressed embedded array
+
+# plotting keys describing an operation in progress, not saved
+TRANSIENT = ('blocking',)
+
+
+def jsonable(obj):
+    # json.dump() fallback for numpy types
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError("Object of type {0} is not JSON serializable".format(type(obj).__name__))
+
+
+def _add_array(zf, name, arr, embed):
+    # add an array to the archive as one or more .npy members; returns the
+    # list of members
+    arr = np.ascontiguousarray(arr)
+    if embed == 'mmap':
+        chunks = [arr]
+        compression = zipfile.ZIP_STORED
+    else:
+        chunks = np.array_split(arr, max(1, int(np.ceil(arr.size / CHUNK))))
+        compression = zipfile.ZIP_DEFLATED
+
+    members = []
+    for k, chunk in enumerate(chunks):
+        member = 'arrays/{0}/{1}.npy'.format(name, k)
+        info = zipfile.ZipInfo(member)
+        info.compress_type = compression
+        with zf.open(info, 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, chunk, allow_pickle=False)
+        members.append(member)
+
+    return members
+
+
+def _member_offset(fn, info):
+    # file offset of the data of an uncompressed member
+    with open(fn, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(30)
+        nname, nextra = struct.unpack('<HH', header[26:30])
+        return info.header_offset + 30 + nname + nextra
+
+
+def _read_array(fn, members, mmap=True):
+    # read an embedded array; a single uncompressed member is memory-mapped
+    with zipfile.ZipFile(fn) as zf:
+        infos = [zf.getinfo(m) for m in members]
+        if mmap and len(infos) == 1 and infos[0].compress_type == zipfile.ZIP_STORED:
+            offset = _member_offset(fn, infos[0])
+            with open(fn, 'rb') as f:
+                f.seek(offset)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+                offset = f.tell()
+            return np.memmap(fn, dtype=dtype, mode='r', offset=offset, shape=shape, \
+                             order='F' if fortran else 'C')
+
+        chunks = []
+        for info in infos:
+            with zf.open(info) as f:
+                chunks.append(np.lib.format.read_array(f, allow_pickle=False))
+
+    return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+
+@functools.lru_cache(maxsize=65536)
+def _paths(filename, wksdir):
+    # absolute and relative path of a spectrum file; the journal asks for
+    # every spectrum at every action
+    path = os.path.abspath(filename)
+    return path, os.path.relpath(path, wksdir)
+
+
+@functools.lru_cache(maxsize=1024)
+def _hex(color):
+    from matplotlib.colors import to_hex
+
+    return to_hex(color)
+
+
+def spec_entry(ws, wksdir):
+    # manifest entry of a spectrum: file reference and display parameters
+    path, relpath = _paths(ws.filename, wksdir)
+    color = ws.color
+    if isinstance(color, list):
+        color = tuple(color)
+    return {
+        "filename": path,
+        "relpath": relpath,
+        "loader": ws.loader.__name__,
+        "label": ws.label,
+        "addredshift": float(ws.addredshift),
+        "mult": float(ws.mult),
+        "add": float(ws.add),
+        "smooth_width": int(ws.smooth_width),
+        "color": None if color is None else _hex(color),
+        "extraction": getattr(ws, 'extraction', None),
+        "arrays": None
+    }
+
+
+def save_workspace(fn, specs, plotting, linelist, gauss_wave=None, gauss_model=None, \
+                   version='', embed=None):
+    # write a workspace file. embed is None (references only), 'compressed'
+    # or 'mmap' (uncompressed, memory-mappable).
+    if embed not in (None, 'compressed', 'mmap'):
+        raise ValueError("Unknown embedding: {0}".format(embed))
+    wksdir = os.path.dirname(os.path.abspath(fn))
+
+    # spectra not read yet from the arrays embedded in the file being
+    # replaced are read now; other lazily loaded spectra stay unread
+    if os.path.exists(fn):
+        path = os.path.abspath(fn)
+        for ws in specs:
+            if getattr(ws.__dict__.get('_source'), 'workspace', None) == path:
+                ws.wave
+
+    # write to a temporary file so that a failure keeps the old workspace
+    tmpfn = fn + '.tmp'
+    try:
+        with zipfile.ZipFile(tmpfn, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            entries = []
+            for i, ws in enumerate(specs):
+                entry = spec_entry(ws, wksdir)
+                if embed is not None:
+                    entry['arrays'] = {}
+                    for name in ('wave', 'spec', 'error'):
+                        arr = getattr(ws, name)
+                        if arr is not None:
+                            entry['arrays'][name] = _add_array(zf, 'spec{0}/{1}'.format(i, name), np.asarray(arr), embed)
+                entries.append(entry)
+
+            gauss = None
+            if gauss_wave is not None and gauss_model is not None:
+                gauss = {
+                    "wave": _add_array(zf, 'gauss/wave', np.asarray(gauss_wave), 'compressed'),
+                    "model": _add_array(zf, 'gauss/model', np.asarray(gauss_model), 'compressed')
+                }
+
+            manifest = {
+                "format": FORMAT,
+                "version": VERSION,
+                "xtrimpy_version": version,
+                "specs": entries,
+                "plotting": {k: v for k, v in plotting.items() if k not in TRANSIENT},
+                "linelist": linelist,
+                "gauss": gauss
+            }
+            zf.writestr(MANIFEST, json.dumps(manifest, indent=1, default=jsonable))
+
+        os.replace(tmpfn, fn)
+    finally:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+
+    return
+
+
+def locate(entry, wksdir, search_paths=()):
+    # find a spectrum file that may have moved: the saved path, the path
+    # relative to the workspace, then the file name in the workspace
+    # directory and the search paths. Returns None if not found.
+    candidates = [entry['filename'], os.path.join(wksdir, entry['relpath'])]
+    basename = os.path.basename(entry['filename'])
+    for path in (wksdir,) + tuple(search_paths):
+        candidates.append(os.path.join(path, basename))
+
+    for path in candidates:
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+
+    return None
+
+
+def _embedded_source(fn, arrays):
+    # reader of the arrays embedded in a workspace
+    def source():
+        wave = _read_array(fn, arrays['wave'])
+        spec = _read_array(fn, arrays['spec'])
+        error = _read_array(fn, arrays['error']) if 'error' in arrays else None
+        return wave, spec, error
+    # the workspace file read, see save_workspace()
+    source.workspace = fn
+    return source
+
+
+def _file_source(path, loader):
+    def source():
+        return loader(path)
+    return source
+
+
+def _extraction_source(path, extraction):
+    # spaxels of a data cube, or an aperture of a 2D spectrum
+    def source():
+        from .WaveSpec import spec2d, cube
+        if 'spaxel' in extraction:
+            return cube.extract_file(path, **extraction)
+        return spec2d.extract_file(path, **extraction)
+    return source
+
+
+def restore_spec(entry, wksdir, search_paths=(), wksfn=None):
+    # lazily loaded spectrum of a manifest entry, from the arrays embedded
+    # in the workspace wksfn if any; None if the file cannot be found
+    loader = getattr(sloader, entry['loader'], None)
+    if loader is None:
+        loader = sloader.default
+
+    if entry.get('arrays') and wksfn is not None:
+        path = entry['filename']
+        source = _embedded_source(wksfn, entry['arrays'])
+    else:
+        path = locate(entry, wksdir, search_paths)
+        if path is None:
+            return None
+        if entry.get('extraction'):
+            source = _extraction_source(path, entry['extraction'])
+        else:
+            source = _file_source(path, loader)
+
+    ws = wavespec.wavespec_obj(path, loader=loader, source=source)
+    ws.extraction = entry.get('extraction')
+    ws.label = entry['label']
+    ws.addredshift = entry['addredshift']
+    ws.mult = entry['mult']
+    ws.add = entry['add']
+    ws.smooth_width = entry['smooth_width']
+    ws.color = entry['color']
+
+    return ws
+
+
+def _load_legacy(fn):
+    # pickled (version, specs, plotting, gauss_wave, gauss_model, linelist)
+    with open(fn, 'rb') as f:
+        version, specs, plotting, gauss_wave, gauss_model, linelist = pickle.load(f)
+
+    return {
+        "version": version,
+        "specs": specs,
+        "plotting": plotting,
+        "linelist": linelist,
+        "gauss_wave": gauss_wave,
+        "gauss_model": gauss_model,
+        "missing": []
+    }
+
+
+def load_workspace(fn, search_paths=()):
+    # read a workspace file. Spectra are read on first use of their data,
+    # from the embedded arrays if any and otherwise from the source file.
+    # Returns a dict with the version, specs, plotting, linelist,
+    # gauss_wave, gauss_model and the missing source files.
+    if not zipfile.is_zipfile(fn):
+        return _load_legacy(fn)
+
+    fn = os.path.abspath(fn)
+    wksdir = os.path.dirname(fn)
+    with zipfile.ZipFile(fn) as zf:
+        manifest = json.loads(zf.read(MANIFEST))
+    if manifest.get('format') != FORMAT:
+        raise ValueError("Not a workspace file: {0}".format(fn))
+    if manifest['version'] > VERSION:
+        raise ValueError("Workspace format version {0} is newer than supported ({1}).".format( \
+            manifest['version'], VERSION))
+
+    specs = []
+    missing = []
+    for entry in manifest['specs']:
+        ws = restore_spec(entry, wksdir, search_paths=search_paths, wksfn=fn)
+        if ws is None:
+            missing.append(entry['filename'])
+        else:
+            specs.append(ws)
+
+    gauss_wave, gauss_model = None, None
+    if manifest.get('gauss') is not None:
+        gauss_wave = _read_array(fn, manifest['gauss']['wave'], mmap=False)
+        gauss_model = _read_array(fn, manifest['gauss']['model'], mmap=False)
+
+    return {
+        "version": manifest.get('xtrimpy_version', ''),
+        "specs": specs,
+        "plotting": manifest['plotting'],
+        "linelist": manifest['linelist'],
+        "gauss_wave": gauss_wave,
+        "gauss_model": gauss_model,
+        "missing": missing
+    }
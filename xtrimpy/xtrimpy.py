@@ -1,59 +1,141 @@
 import sys
 import os
-import argparse
+import functools
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, \
     QMenuBar, QAction, QStatusBar, QFileDialog, QTableWidget, QTableWidgetItem, \
-    QDialog, QTextEdit, QSizePolicy, QTextBrowser, QMessageBox, QPushButton, QMenu
-from PyQt5.QtGui import QColor, QIcon, QPixmap
-from PyQt5.QtCore import Qt, QEvent, pyqtSignal, QObject
+    QDialog, QSizePolicy, QTextBrowser, QMessageBox, QPushButton, QMenu, \
+    QInputDialog, QTableView, QLineEdit, QListView
+from PyQt5.QtGui import QIcon, QPixmap, QKeySequence
+from PyQt5.QtCore import Qt, QEvent, pyqtSignal, QObject, QSortFilterProxyModel, QTimer, \
+    QAbstractListModel, QModelIndex
 import logging
+import matplotlib
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
+from matplotlib.colors import to_hex
 import numpy as np
-import pkg_resources
-import pickle
+import shutil
 import inspect
 
 
 from .WaveSpec import wavespec, sloader
-from .utils import *
-
-def parser_init():
-    """Create command-line argument parser for this script."""
-    parser = argparse.ArgumentParser(description="Xtrim GUI")
-    parser.add_argument(
-        'filenames',
-        type=str,
-        help='Spectrum to be displayed',
-        default=None,
-        nargs='*'
-        )
-    return parser
+from . import journal, session, spectable, logbuffer, instance, navigator, render
+from .cli import parser_init
+
+ICON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib', 'xtrim_icon.png')
+
+
+def journaled(method):
+    # make a GUI action one session action: one undo step, one journal
+    # entry and one redraw
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        action = method.__name__
+        if len(args) > 0 and hasattr(args[0], 'key'):
+            action += ' ' + str(args[0].key)
+        with self.session.action(action):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def session_property(name):
+    # attribute of the session, kept on the GUI for the existing code
+    return property(lambda self: getattr(self.session, name), \
+                    lambda self, value: setattr(self.session, name, value))
 
 class StatusBarHandler(logging.Handler, QObject):
-    newLogRecord = pyqtSignal(str)
+    # keeps the records in a bounded log buffer and shows the last one in
+    # the status bar at most every interval ms; newLogRecords is emitted then
+    newLogRecords = pyqtSignal()
+    _logged = pyqtSignal()
 
-    def __init__(self, statusBar):
+    def __init__(self, statusBar, maxlen=logbuffer.MAXLEN, spill=True, interval=100):
         super().__init__()
         QObject.__init__(self)
-        self.log_records = []
+        self.buffer = logbuffer.log_buffer(maxlen, spill=spill)
         self.statusBar = statusBar
 
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.show_last)
+        # records of other threads start the timer in the GUI thread
+        self._logged.connect(self.schedule)
+
     def emit(self, record):
-        log_entry = self.format(record)
-        self.log_records.append(log_entry)
-        self.statusBar.showMessage(log_entry)
-        self.newLogRecord.emit(log_entry)  # Emit the new log record
+        try:
+            self.buffer.append(logbuffer.entry(record))
+        except Exception:
+            self.handleError(record)
+            return
+        self._logged.emit()
+
+    def schedule(self):
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def show_last(self):
+        if len(self.buffer) > 0:
+            self.statusBar.showMessage(logbuffer.format_entry(self.buffer.entries[-1]))
+        self.newLogRecords.emit()
+
+    def close(self):
+        self.buffer.close()
+        super().close()
+
+
+class LogModel(QAbstractListModel):
+    # rows of the records in the log buffer, formatted when they are shown;
+    # sync() follows the records added and evicted since the last call
+
+    def __init__(self, buffer, parent=None):
+        super().__init__(parent)
+        self.buffer = buffer
+        self.first = buffer.first
+        self.count = len(buffer)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        # the buffer may have evicted rows not yet removed
+        i = self.first + index.row() - self.buffer.first
+        if i < 0 or i >= len(self.buffer):
+            return None
+        return logbuffer.format_entry(self.buffer.entries[i])
+
+    def sync(self):
+        nremove = min(self.buffer.first - self.first, self.count)
+        if nremove > 0:
+            self.beginRemoveRows(QModelIndex(), 0, nremove - 1)
+            self.count -= nremove
+            self.endRemoveRows()
+        self.first = max(self.first, self.buffer.first)
+
+        nadd = self.buffer.total - self.first - self.count
+        if nadd > 0:
+            self.beginInsertRows(QModelIndex(), self.count, self.count + nadd - 1)
+            self.count += nadd
+            self.endInsertRows()
 
 
 class XtrimGUI(QWidget):
-    def __init__(self, filenames=None):
+
+    specs = session_property('specs')
+    plotting = session_property('plotting')
+    linelist = session_property('linelist')
+    gauss_wave = session_property('gauss_wave')
+    gauss_model = session_property('gauss_model')
+    masks = session_property('masks')
+    template_specs = session_property('template_specs')
+
+    def __init__(self, filenames=None, loader='default', single_instance=False, renderer='raster', watch=None):
         super().__init__()
 
         self.__version__ = '0.1.0'
 
-        self.specs = []
         self.last_x, self.last_y = np.nan, np.nan
 
         self.input_mode = False
@@ -62,45 +144,132 @@ class XtrimGUI(QWidget):
         # statusbar message
         self.default_message = "Ready - 'a': zoom box; 'b': reset y=0; 'c': reset plot"
 
-        # plotting keywords
-        self.plotting = {
-            "box": [None, None, None, None],
-            #"initial_box": [None, None, None, None], 
-            "redshift": 0.,
-            "ew_cont": [None, None, None, None],
-            "ew": [np.nan, np.nan],
-            "flux": [np.nan, np.nan],
-            "gauss_lim": [None, None],
-            "gauss_center": [np.nan, np.nan],
-            "trim_lines": [],
-            "redshift_line": np.nan,
-            "blocking": None    # operation in progress, blocking other key events
-        }
-
-        # gauss model
-        self.gauss_wave = None
-        self.gauss_model = None
+        # spectra, plotting keywords, line list, masks and measurements
+        self.session = session.session()
+        self.update_color()
 
-        # line list
-        self.linelist = {
-            "waves": [],
-            "labels": [], 
-            "kwargs": []
-        }
         self.lldefaults = {
             "ls": '--',
             "color": 'lightblue'
         }
 
-        self.initUI(filenames)
+        # draws the spectra in plotspec(); saved figures use matplotlib
+        self.renderer = render.renderer(renderer)
+
+        # reloads spectra whose files change on disk, if switched on
+        self.watcher = None
+        self.watch_mode = 'auto' if watch is None else watch
+
+        self.initUI()
         self.setupLogging()
         QApplication.instance().installEventFilter(self)
+        if watch is not None:
+            self.watchAction.setChecked(True)
+
+        # the spectra are loaded once the first frame is drawn, or after a
+        # second if the window is not drawn
+        self.started = False
+        self.pending_files = filenames
+        self.pending_loader = loader
+        self.server = None
+        self.single_instance = instance.enabled(single_instance)
+        QTimer.singleShot(1000, self.startup)
 
         return
 
-    def initUI(self, filenames):
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.started:
+            QTimer.singleShot(0, self.startup)
+
+    def startup(self):
+        # load the spectra of the command line, then offer to recover a
+        # crashed session and start the journal
+        if self.started:
+            return
+        self.started = True
+        if self.single_instance:
+            self.start_server()
+        if self.pending_files:
+            self.open_files(self.pending_files, self.pending_loader)
+        self.pending_files = None
+        self.start_journal()
+
+        return
+
+    def start_server(self):
+        # single-instance mode: later `xtrimpy --single-instance` calls
+        # send their files over a per-user local socket
+        from PyQt5.QtNetwork import QLocalServer
+
+        path = instance.address()
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        if not self.server.listen(path):
+            if instance.running(path):
+                self.logger.warning("Single-instance mode: another xtrimpy is listening on " + path)
+                self.server = None
+                return
+            # socket left by an instance that crashed
+            QLocalServer.removeServer(path)
+            if not self.server.listen(path):
+                self.logger.warning("Single-instance mode disabled: " + self.server.errorString())
+                self.server = None
+                return
+        self.server.newConnection.connect(self.acceptConnection)
+
+        return
+
+    def acceptConnection(self):
+        while self.server.hasPendingConnections():
+            conn = self.server.nextPendingConnection()
+            conn.readyRead.connect(lambda conn=conn: self.readRequest(conn))
+            conn.disconnected.connect(conn.deleteLater)
+
+        return
+
+    def readRequest(self, conn):
+        # one request per connection; the reply is sent before the files
+        # are loaded, so that the calling process exits at once
+        if not conn.canReadLine():
+            return
+        try:
+            filenames, loader = instance.parse_request(bytes(conn.readLine()).decode())
+            if loader not in dict(zip(*self.get_all_loadspec_methods())):
+                raise ValueError("Unknown loader: " + loader)
+        except ValueError as e:
+            conn.write((str(e) + '\n').encode())
+            conn.disconnectFromServer()
+            return
+        conn.write(b'ok\n')
+        conn.disconnectFromServer()
+
+        QTimer.singleShot(0, lambda: self.open_files(filenames, loader))
+
+        return
+
+    def open_files(self, filenames, loader='default'):
+        # files of the command line or of another xtrimpy call
+        self.raise_()
+        self.activateWindow()
+        if len(filenames) == 0:
+            return
+        funcs = dict(zip(*self.get_all_loadspec_methods()))
+        if loader not in funcs:
+            self.logger.error("Unknown loader: " + loader)
+            return
+        try:
+            self.session.load(filenames, loader=funcs[loader])
+        except Exception as e:
+            self.logger.error("Error loading files {0}: {1}".format(filenames, e))
+            return
+        self.logger.info("Loaded files: " + str(filenames))
+
+        return
+
+    def initUI(self):
         # logging box init
-        self.logtext = None
+        self.logview = None
 
         # Main layout
         main_layout = QVBoxLayout()
@@ -108,8 +277,7 @@ class XtrimGUI(QWidget):
         self.setWindowTitle('XTRIM')
         self.setGeometry(100, 100, 1000, 710)
 
-        path_to_icon = pkg_resources.resource_filename(__name__, 'lib/xtrim_icon.png')
-        self.setWindowIcon(QIcon(path_to_icon))
+        self.setWindowIcon(QIcon(ICON))
 
         # Base 1
         base_1 = QVBoxLayout()
@@ -134,6 +302,13 @@ class XtrimGUI(QWidget):
             openwithAction.triggered.connect(lambda _, f=func: self.openFileNameDialog(loader=f))
             openwithMenu.addAction(openwithAction)
 
+        openspec2dAction = QAction('Open 2D Spectrum', self)
+        openspec2dAction.triggered.connect(self.openspec2dDialog)
+        fileMenu.addAction(openspec2dAction)
+        opencubeAction = QAction('Open Data Cube', self)
+        opencubeAction.triggered.connect(self.opencubeDialog)
+        fileMenu.addAction(opencubeAction)
+
         loadworkspaceAction = QAction('Load Workspace', self)
         loadworkspaceAction.triggered.connect(self.loadworkspaceDialog)
         fileMenu.addAction(loadworkspaceAction)
@@ -143,12 +318,56 @@ class XtrimGUI(QWidget):
         savefigureAction = QAction('Save Figure', self)
         savefigureAction.triggered.connect(self.savefigureDialog)
         fileMenu.addAction(savefigureAction)
+        exportsheetsAction = QAction('Export QA Sheets', self)
+        exportsheetsAction.triggered.connect(self.exportsheetsDialog)
+        fileMenu.addAction(exportsheetsAction)
+        self.watchAction = QAction('Reload Changed Files', self)
+        self.watchAction.setCheckable(True)
+        self.watchAction.toggled.connect(self.set_watch)
+        fileMenu.addAction(self.watchAction)
+
+        editMenu = menuBar.addMenu('Edit')
+        undoAction = QAction('Undo', self)
+        undoAction.setShortcut(QKeySequence.Undo)
+        undoAction.triggered.connect(self.undo)
+        editMenu.addAction(undoAction)
+        redoAction = QAction('Redo', self)
+        redoAction.setShortcuts([QKeySequence.Redo, QKeySequence('Ctrl+Y')])
+        redoAction.triggered.connect(self.redo)
+        editMenu.addAction(redoAction)
 
         linelistMenu = menuBar.addMenu('Line List')
         openlinelistAction = QAction('Open Line List', self)
         openlinelistAction.triggered.connect(self.openlinelistDialog)
         linelistMenu.addAction(openlinelistAction)
 
+        maskMenu = menuBar.addMenu('Masks')
+        openmaskAction = QAction('Open Mask List', self)
+        openmaskAction.triggered.connect(self.openmaskDialog)
+        maskMenu.addAction(openmaskAction)
+        clearmaskAction = QAction('Clear Masks', self)
+        clearmaskAction.triggered.connect(self.clearmasks)
+        maskMenu.addAction(clearmaskAction)
+
+        measureMenu = menuBar.addMenu('Measure')
+        self.mcerrorsAction = QAction('Monte Carlo Errors', self)
+        self.mcerrorsAction.setCheckable(True)
+        self.mcerrorsAction.triggered.connect(self.mcerrorsDialog)
+        measureMenu.addAction(self.mcerrorsAction)
+
+        templateMenu = QMenu('Redshift Templates', self)
+        measureMenu.addMenu(templateMenu)
+        for func_name, func in zip(sloader_names, sloader_funcs):
+            templateAction = QAction('Open with ' + func_name, self)
+            templateAction.triggered.connect(lambda _, f=func: self.opentemplateDialog(loader=f))
+            templateMenu.addAction(templateAction)
+        cleartemplateAction = QAction('Use Line List', self)
+        cleartemplateAction.triggered.connect(self.cleartemplates)
+        templateMenu.addAction(cleartemplateAction)
+        chi2scanAction = QAction('Chi-square Redshift Scan', self)
+        chi2scanAction.triggered.connect(self.chi2scanDialog)
+        measureMenu.addAction(chi2scanAction)
+
         # help menu
         logMenu = menuBar.addMenu('Log')
         viewlogsAction = QAction('View Logs', self)
@@ -164,8 +383,6 @@ class XtrimGUI(QWidget):
         helpAction = QAction('Help', self)
         helpAction.triggered.connect(self.showHelpDialog)
         helpMenu.addAction(helpAction)
-        #redoAction = QAction('Redo', self)
-        #editMenu.addAction(redoAction)
 
         # Title label
         #label_title = QLabel('File name')
@@ -184,6 +401,10 @@ class XtrimGUI(QWidget):
         self.ax = self.figure.add_subplot(111)
         base_1.addWidget(self.canvas)
 
+        # overview of the full spectra with the plotting range
+        self.navigator = navigator.navigator(self)
+        base_1.addWidget(self.navigator.canvas)
+
         # x, y monitor
         self.label_xy = QLabel('(x, y) = {0:.4f}, {1:.4f}'.format(self.last_x, self.last_y))
         base_1.addWidget(self.label_xy)
@@ -225,39 +446,43 @@ class XtrimGUI(QWidget):
         # Reference list in Base 2
         base_22 = QVBoxLayout()
         label_files = QLabel('Loaded Files:')
-        self.tableWidget = QTableWidget()
-        self.tableWidget.setRowCount(0)  # Set number of rows
-        self.tableWidget.setColumnCount(7)  # Set number of columns
-        # Column headers (optional)
-        self.tableWidget.setHorizontalHeaderLabels(["Filename", "+Redshift", "Smooth", "x", "+", "Color"])
-        self.tableWidget.setColumnWidth(0, 200)
-        self.tableWidget.setColumnWidth(1, 100)
-        self.tableWidget.setColumnWidth(2, 70)
-        self.tableWidget.setColumnWidth(3, 70)
-        self.tableWidget.setColumnWidth(4, 70)
-        self.tableWidget.setColumnWidth(5, 70)
-        self.tableWidget.setColumnWidth(6, 70)
-        self.tableWidget.itemChanged.connect(self.TableItemChanged)
+        self.specFilter = QLineEdit()
+        self.specFilter.setPlaceholderText('Filter file names')
+        self.specModel = spectable.spec_table_model(self.session, self)
+        self.specProxy = QSortFilterProxyModel(self)
+        self.specProxy.setSourceModel(self.specModel)
+        self.specProxy.setFilterKeyColumn(0)
+        self.specProxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.specProxy.setSortRole(spectable.SORT_ROLE)
+        self.specFilter.textChanged.connect(self.specProxy.setFilterFixedString)
+        self.tableView = QTableView()
+        self.tableView.setModel(self.specProxy)
+        # loading order until a column header is clicked
+        self.tableView.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.tableView.setSortingEnabled(True)
+        self.specDelegate = spectable.spec_table_delegate(self.tableView)
+        self.specDelegate.deleteClicked.connect(self.deleteRow)
+        self.tableView.setItemDelegate(self.specDelegate)
+        self.tableView.setColumnWidth(0, 200)
+        self.tableView.setColumnWidth(1, 100)
+        self.tableView.setColumnWidth(2, 70)
+        self.tableView.setColumnWidth(3, 70)
+        self.tableView.setColumnWidth(4, 70)
+        self.tableView.setColumnWidth(5, 70)
+        self.tableView.setColumnWidth(6, 70)
     
         
         base_22.addWidget(label_files)
-        base_22.addWidget(self.tableWidget)
+        base_22.addWidget(self.specFilter)
+        base_22.addWidget(self.tableView)
         base_2.addLayout(base_22, 2)
 
         self.statusBar = QStatusBar()
         main_layout.addWidget(self.statusBar)
         self.statusBar.showMessage(self.default_message)
 
-        # load default line list
-        path_to_linelist = pkg_resources.resource_filename(__name__, 'lib/line_list.dat')
-        self.loadlinelist(path_to_linelist)
-
-        # parse file names from command line
-        if filenames is not None:
-            self.loadspec(filenames)
-            self.update_color()
-            self.plotspec(reset_lim=True)
-            self.refresh_file_table()
+        # redraw on changes of the session
+        self.session.subscribe(self.on_session_changed)
 
         # Connect the hover event
         self.canvas.mpl_connect('motion_notify_event', self.on_hover)
@@ -267,20 +492,24 @@ class XtrimGUI(QWidget):
         self.show()
 
     def setupLogging(self):
-        # Configure logger
+        # Configure logger; the handler is on the package logger to show the
+        # messages of the session as well
         logger = logging.getLogger(__name__)
         logger.setLevel(logging.INFO)
+        package_logger = logging.getLogger(__package__)
+        package_logger.setLevel(logging.INFO)
 
-        # Create custom handler
+        # Create custom handler; records are formatted by logbuffer when
+        # shown, and those beyond the buffer spill to a temporary file
         self.handler = StatusBarHandler(self.statusBar)
         self.handler.setLevel(logging.INFO)
-
-        # Create formatter and add it to the handler
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        self.handler.setFormatter(formatter)
+        self.logModel = LogModel(self.handler.buffer, self)
+        self.handler.newLogRecords.connect(self.logModel.sync)
+        # the log viewer follows new records while scrolled to the end
+        self.logModel.rowsAboutToBeInserted.connect(self.followLogs)
 
         # Add the handler to the logger
-        logger.addHandler(self.handler)
+        package_logger.addHandler(self.handler)
 
         # Assign the logger to the class
         self.logger = logger
@@ -296,11 +525,17 @@ class XtrimGUI(QWidget):
             self.dialog.resize(600, 400)
             layout = QVBoxLayout()
 
-            # Text area for logs
-            self.logtext = QTextEdit(self.dialog)
-            self.logtext.setReadOnly(True)
-            self.logtext.setText("\n".join(self.handler.log_records))  # Join log records and set as text
-            layout.addWidget(self.logtext)
+            # List of the records in memory; only the visible rows are
+            # formatted
+            self.logModel.sync()
+            self.logview = QListView(self.dialog)
+            self.logview.setUniformItemSizes(True)
+            self.logview.setModel(self.logModel)
+            self.logview.scrollToBottom()
+            layout.addWidget(self.logview)
+            if self.handler.buffer.first > 0:
+                layout.addWidget(QLabel("{0:d} earlier records are only in the saved logs.".format( \
+                    self.handler.buffer.first), self.dialog))
 
             savelogbutton = QPushButton('Save Logs')
             savelogbutton.clicked.connect(self.saveLogDialog)
@@ -308,17 +543,18 @@ class XtrimGUI(QWidget):
 
             self.dialog.setLayout(layout)
             #self.dialog.setWindowModality(Qt.WindowModal)
-            
-            # Connect the newLogRecord signal to update the log text edit
-            self.handler.newLogRecord.connect(self.updateLogText)
         
             self.dialog.show()  # Show the dialog
 
         return
 
-    def updateLogText(self, message):
-        # Append the new message to the log text edit
-        self.logtext.append(message)
+    def followLogs(self):
+        # keep the newest record in view if it is
+        if self.logview is None or not self.logview.isVisible():
+            return
+        scrollbar = self.logview.verticalScrollBar()
+        if scrollbar.value() == scrollbar.maximum():
+            QTimer.singleShot(0, self.logview.scrollToBottom)
 
         return
     
@@ -328,8 +564,7 @@ class XtrimGUI(QWidget):
                                                   "All Files (*);;Text Files (*.log)", options=options)
         if fileName:
             try:
-                with open(fileName, 'w') as file:
-                    file.write("\n".join(self.handler.log_records))
+                self.handler.buffer.save(fileName)
                 self.logger.info(f"Saved log file: " + str(fileName))
             except PermissionError:
                 self.showErrorDialog("Permission denied", "You do not have permission to save to this location.")
@@ -356,8 +591,10 @@ class XtrimGUI(QWidget):
         else:
             self.last_x, self.last_y = np.nan, np.nan # Reset if not hovering over plot
 
+    @journaled
     def keyPressEvent(self, event):
-        # all key press events
+        # all key press events; the changes are made through the session,
+        # which redraws through on_session_changed()
 
         if not self.input_mode:
 
@@ -375,48 +612,25 @@ class XtrimGUI(QWidget):
                     self.plotting['blocking'] = 'a'
 
                 elif self.plotting['box'][2] is None:
-                    self.plotting['box'][2] = self.last_x
-                    self.plotting['box'][3] = self.last_y
-
-                    # rearrange
-                    if self.plotting['box'][0] > self.plotting['box'][2]:
-                        self.plotting['box'][0], self.plotting['box'][2] = self.plotting['box'][2], self.plotting['box'][0]
-                    if self.plotting['box'][1] > self.plotting['box'][3]:
-                        self.plotting['box'][1], self.plotting['box'][3] = self.plotting['box'][3], self.plotting['box'][1]
-                    
-                    # set plot lim
-                    self.plotspec()
-                    self.canvas.draw()
+                    self.session.set_box(self.plotting['box'][0], self.plotting['box'][1], self.last_x, self.last_y)
 
                     self.logger.info("'a': zoom box marked as (x0, y0, x1, y1) = {0:.2f}, {1:.2f}, {2:.2f}, {3:.2f}".format(*self.plotting['box']))
                     self.plotting['blocking'] = None
 
             elif event.key == 'b' and self.checkblocking('b'):
                 # set y=0 baseline
-                if self.plotting['box'][3] > 0:
-                    self.plotting['box'][1] = 0
-                else:
-                    self.plotting['box'][3] = 0
-                
-                self.ax.set_ylim(self.plotting['box'][1], self.plotting['box'][3])
-                self.canvas.draw()
+                self.session.baseline()
 
                 self.logger.info("'b': set (y0, y1) = {1:.2f}, {3:.2f}".format(*self.plotting['box']))
                 self.plotting['blocking'] = None
-            
-            elif event.key == 'c':
 
-                # clear unfinished process
-                if self.plotting['ew_cont'][2] is None:
-                    self.plotting['ew_cont'] = [None, None, None, None]
-                if self.plotting['gauss_lim'][1] is None:
-                    self.plotting['gauss_lim'] = [None, None]
+            elif event.key == 'c':
 
-                # reset plotting range
-                self.plotspec(reset_lim=True)
+                # clear unfinished process, reset plotting range
+                self.session.clear_pending()
+                self.session.reset_view()
 
                 self.logger.info("'c': reset (x0, y0, x1, y1) to {0:.2f}, {1:.2f}, {2:.2f}, {3:.2f}".format(*self.plotting['box']))
-                self.plotting['blocking'] = None
 
             elif event.key == 'e' and np.isfinite(self.last_x) and np.isfinite(self.last_y) and \
                 self.checkblocking('e'):
@@ -431,29 +645,32 @@ class XtrimGUI(QWidget):
                     self.logger.info("'e': mark the other point for continuum level")
                     self.plotting['blocking'] = 'e'
                 elif self.plotting['ew_cont'][2] is None:
-                    self.plotting['ew_cont'][2] = self.last_x
-                    self.plotting['ew_cont'][3] = self.last_y
-
-                    # rearrange
-                    if self.plotting['ew_cont'][2] < self.plotting['ew_cont'][0]:
-                        self.plotting['ew_cont'][0], self.plotting['ew_cont'][2] = \
-                            self.plotting['ew_cont'][2], self.plotting['ew_cont'][0]
-                        self.plotting['ew_cont'][1], self.plotting['ew_cont'][3] = \
-                            self.plotting['ew_cont'][3], self.plotting['ew_cont'][1]
-
-                    # calculate EW
-                    ew, flux = calc_ew(self.specs[0], self.plotting['ew_cont'])
-                    self.plotting['ew'] = ew
-                    self.plotting['flux'] = flux
-
-                    # display
-                    self.plotspec()
-                    self.refresh_value_table()
-
-                    # 
+                    ew, flux = self.session.measure_ew(self.plotting['ew_cont'][:2] + [self.last_x, self.last_y])
+
                     self.logger.info("'e': EW = {0:.6f} +- {1:.6f}; Flux = {2:.6f} +- {3:.6f}".format(*ew, *flux))
                     self.plotting['blocking'] = None
-                
+
+            elif event.key == 'E' and len(self.specs) > 0 and np.isfinite(self.last_x) and np.isfinite(self.last_y) and \
+                self.checkblocking('E'):
+                # EW within a window on the automatic continuum
+
+                if self.plotting['ew_window'][1] is not None or self.plotting['ew_window'][0] is None:
+                    self.plotting['ew_window'] = [self.last_x, None]
+
+                    self.logger.info("'E': mark the other limit of the EW window")
+                    self.plotting['blocking'] = 'E'
+
+                elif self.plotting['ew_window'][1] is None:
+                    ew, flux = self.session.measure_ew_auto([self.plotting['ew_window'][0], self.last_x])
+
+                    self.logger.info("'E': EW = {0:.6f} +- {1:.6f}; Flux = {2:.6f} +- {3:.6f}".format(*ew, *flux))
+                    self.plotting['blocking'] = None
+
+            elif event.key == 'n' and self.checkblocking('n'):
+                # toggle continuum normalization
+                self.session.set_normalize(not self.plotting.get('normalize', False))
+                self.logger.info("'n': continuum normalization {0}".format('on' if self.plotting['normalize'] else 'off'))
+
             elif event.key == 'k' and np.isfinite(self.last_x) and np.isfinite(self.last_y) and \
                 self.checkblocking('k'):
                 # quick Gaussian fitting
@@ -466,167 +683,139 @@ class XtrimGUI(QWidget):
                     self.plotting['blocking'] = 'k'
 
                 elif self.plotting['gauss_lim'][1] is None:
-                    self.plotting['gauss_lim'][1] = self.last_x
-                    
-                    # rearrange
-                    if self.plotting['gauss_lim'][1] < self.plotting['gauss_lim'][0]:
-                        self.plotting['gauss_lim'][0], self.plotting['gauss_lim'][1] = \
-                            self.plotting['gauss_lim'][1], self.plotting['gauss_lim'][0]
-                        
-                    # fit gauss
-                    try:
-                        flux, ew, gauss_center, wmodel, smodel = fit_gauss(self.specs[0], self.plotting['gauss_lim'])
-                    except:
-                        ew = [np.nan, np.nan]
-                        flux = [np.nan, np.nan]
-                        gauss_center = [np.nan, np.nan]
-                        wmodel = None
-                        smodel = None
-
-                    self.plotting['ew'] = ew
-                    self.plotting['flux'] = flux
-                    self.plotting['gauss_center'] = gauss_center
-                    self.gauss_wave = wmodel
-                    self.gauss_model = smodel
-
-                    # display
-                    self.plotspec()
-                    self.refresh_value_table()
-
-                    # 
+                    flux, ew, gauss_center = self.session.fit_gauss([self.plotting['gauss_lim'][0], self.last_x])
+
                     self.logger.info("'k': EW = {0:.6f} +- {1:.6f}; Flux = {2:.6f} +- {3:.6f}; w0 = {4:.6f} +- {5:.6f}".format(*ew, *flux, *gauss_center))
                     self.plotting['blocking'] = None
 
-            elif event.key == 'z':
-                self.plotspec(reset_lim=True)
+            elif event.key == 'K' and np.isfinite(self.last_x) and np.isfinite(self.last_y) and \
+                self.checkblocking('K'):
+                # simultaneous fit of all line list features in a region
+
+                if self.plotting['gauss_lim'][1] is not None or self.plotting['gauss_lim'][0] is None:
+                    self.plotting['gauss_lim'][0] = self.last_x
+                    self.plotting['gauss_lim'][1] = None
+
+                    self.logger.info("'K': mark the other limit for multi-line fitting")
+                    self.plotting['blocking'] = 'K'
+
+                elif self.plotting['gauss_lim'][1] is None:
+                    # fit all lines with tied redshift and width
+                    try:
+                        lines_fit = self.session.fit_lines([self.plotting['gauss_lim'][0], self.last_x])
+                        self.logger.info("'K': {0:d} lines fitted; z = {1:.6f} +- {2:.6f}; sigma_v = {3:.1f} +- {4:.1f} km/s".format(
+                            len(lines_fit['labels']), *lines_fit['redshift'], *lines_fit['sigma_v']))
+                        for label, flux, ew in zip(lines_fit['labels'], lines_fit['flux'], lines_fit['ew']):
+                            self.logger.info("'K': {0}: Flux = {1:.6f} +- {2:.6f}; EW = {3:.6f} +- {4:.6f}".format(label, *flux, *ew))
+                    except Exception as e:
+                        self.logger.info("'K': fit failed - {0}".format(e))
+
+                    self.plotting['blocking'] = None
 
-                allfluxes = []
-                for i, wavespec in enumerate(self.specs):
-                    allfluxes.append(wavespec.spec_display * wavespec.mult)
+            elif self.plotting['blocking'] == 'x' and event.key in ['enter', 'escape']:
+                # accept or reject the cross-correlation redshift
+                if event.key == 'escape':
+                    self.session.reject_candidate()
+                    self.logger.info("'x': redshift restored to {0:.6f}".format(self.plotting['redshift']))
+                else:
+                    self.session.accept_candidate()
+                    self.logger.info("'x': redshift set to {0:.6f}".format(self.plotting['redshift']))
+
+            elif event.key == 'x' and len(self.specs) > 0 and self.checkblocking('x'):
+                # cross-correlation redshift; 'x' again for the next candidate
+
+                if self.plotting['blocking'] is None:
+                    self.session.xcorr()
+                else:
+                    self.session.next_candidate()
 
-                ymin, ymax = np.percentile(np.nan_to_num(allfluxes), [1, 99])
-                self.plotting['box'][1] = ymin
-                self.plotting['box'][3] = ymax
+            elif event.key == 'l' and len(self.specs) > 0 and self.checkblocking('l'):
+                # detect lines, mark them as trim lines and propose redshifts
+                lines, nnew, candidates = self.session.detect_lines()
+                self.logger.info("'l': {0:d} lines detected, {1:d} new trim lines".format(len(lines['wave']), nnew))
+
+            elif event.key == 'z':
+                # 1-99% of the displayed values in the visible wavelength range
+                if len(self.specs) == 0:
+                    return
+                if self.session.autoscale([1, 99]) is None:
+                    self.logger.info("'z': no data in the visible range.")
+                    return
 
                 self.logger.info("'z': 99% scale in y-axis, (y0, y1) to ({1:.2f}, {3:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == 'o':
                 # zoom out wavelength
-
-                xwidth = self.plotting['box'][2] - self.plotting['box'][0]
-                self.plotting['box'][0] -= 0.1 * xwidth
-                self.plotting['box'][2] += 0.1 * xwidth
-                
+                self.session.zoom('x', 1.2)
                 self.logger.info("'o': zoom out (x0, x1) to ({0:.2f}, {2:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == 'i':
                 # zoom in wavelength
-
-                xwidth = self.plotting['box'][2] - self.plotting['box'][0]
-                self.plotting['box'][0] += xwidth / 12
-                self.plotting['box'][2] -= xwidth / 12
-                
+                self.session.zoom('x', 5 / 6)
                 self.logger.info("'i': zoom in (x0, x1) to ({0:.2f}, {2:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == '+' or event.key == '=':
                 # move right
-                xwidth = self.plotting['box'][2] - self.plotting['box'][0]
-                self.plotting['box'][0] += xwidth / 10
-                self.plotting['box'][2] += xwidth / 10
+                self.session.pan('x', 0.1)
                 self.logger.info("'+': moving right (x0, x1) to ({0:.2f}, {2:.2f})".format(*self.plotting['box']))
-                self.plotspec()                
 
             elif event.key == '-':
                 # move left
-                xwidth = self.plotting['box'][2] - self.plotting['box'][0]
-                self.plotting['box'][0] -= xwidth / 10
-                self.plotting['box'][2] -= xwidth / 10
+                self.session.pan('x', -0.1)
                 self.logger.info("'-': moving left (x0, x1) to ({0:.2f}, {2:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == 'O':
                 # zoom out flux
-
-                ywidth = self.plotting['box'][3] - self.plotting['box'][1]
-                self.plotting['box'][1] -= 0.1 * ywidth
-                self.plotting['box'][3] += 0.1 * ywidth
-                
+                self.session.zoom('y', 1.2)
                 self.logger.info("'O': zoom out (y0, y1) to ({1:.2f}, {3:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == 'I':
                 # zoom in flux
-
-                ywidth = self.plotting['box'][3] - self.plotting['box'][1]
-                self.plotting['box'][1] += ywidth / 12
-                self.plotting['box'][3] -= ywidth / 12
-                
+                self.session.zoom('y', 5 / 6)
                 self.logger.info("'I': zoom in (y0, y1) to ({1:.2f}, {3:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == "'":
                 # move up
-                ywidth = self.plotting['box'][3] - self.plotting['box'][1]
-                self.plotting['box'][1] += ywidth / 10
-                self.plotting['box'][3] += ywidth / 10
+                self.session.pan('y', 0.1)
                 self.logger.info("''': moving up (y0, y1) to ({1:.2f}, {3:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == '/':
                 # move down
-                ywidth = self.plotting['box'][3] - self.plotting['box'][1]
-                self.plotting['box'][1] -= ywidth / 10
-                self.plotting['box'][3] -= ywidth / 10
+                self.session.pan('y', -0.1)
                 self.logger.info("'/': moving down (y0, y1) to ({1:.2f}, {3:.2f})".format(*self.plotting['box']))
-                self.plotspec()
 
             elif event.key == 'm' and np.isfinite(self.last_x) and np.isfinite(self.last_y):
                 # mark line position to set redshift
 
                 self.input_mode = True
 
-                self.plotting['redshift_line'] = self.last_x
+                self.session.mark_line(self.last_x)
                 self.statusBar.showMessage("'m': input rest wavelength:")
-                self.plotspec()
                 self.plotting['blocking'] = 'm'
-            
+
             elif event.key == 't' and np.isfinite(self.last_x) and np.isfinite(self.last_y):
                 # mark a "trim" line
-                self.plotting['trim_lines'].append(self.last_x)
+                self.session.add_trim_line(self.last_x)
                 self.logger.info("'t': adding trim line at {0:.4f}".format(self.plotting['trim_lines'][-1]))
-                self.plotspec()
-                self.refresh_value_table()
 
             elif event.key == 'd' and np.isfinite(self.last_x) and np.isfinite(self.last_y):
                 # remove a "trim" line
-                if len(self.plotting['trim_lines']) > 0:
-                    index = np.argsort(np.abs(self.plotting['trim_lines'] - self.last_x))[0]
-                    tl_removed = self.plotting['trim_lines'].pop(index)
-
+                tl_removed = self.session.remove_trim_line(self.last_x)
+                if tl_removed is not None:
                     self.logger.info("'d': removing trim line at {0:.4f}".format(tl_removed))
-                    self.plotspec()
-                    self.refresh_value_table()
 
             elif event.key == 'r' and np.isfinite(self.last_x) and np.isfinite(self.last_y):
                 # reposition a "trim" line
-                if len(self.plotting['trim_lines']) > 0:
-                    index = np.argsort(np.abs(self.plotting['trim_lines'] - self.last_x))[0]
-                    tl_old = self.plotting['trim_lines'][index]
-                    self.plotting['trim_lines'][index] = self.last_x
-
-                    self.logger.info("'r': repositioning trim line from {0:.4f} to {1:.4f}".format(tl_old, self.plotting['trim_lines'][index]))
-                    self.plotspec()
-                    self.refresh_value_table()
-            
+                tl_old = self.session.move_trim_line(self.last_x)
+                if tl_old is not None:
+                    self.logger.info("'r': repositioning trim line from {0:.4f} to {1:.4f}".format(tl_old, float(self.last_x)))
+
             elif event.key == 's':
                 # smoothing
                 self.input_mode = True
                 self.statusBar.showMessage("'s': input smoothing width:")
                 self.plotting['blocking'] = 's'
-            
+
             else:
                 self.statusBar.showMessage("Key shortcut '{}' not recognized.".format(event.key))
 
@@ -648,20 +837,14 @@ class XtrimGUI(QWidget):
                         # finishing input
                         final_input = ''.join(self.input_buffer)
 
+                        self.input_mode = False
+                        self.input_buffer.clear()
+                        self.plotting['blocking'] = None
                         try:
-                            wave0 = float(final_input)
-                            self.plotting['redshift'] = (self.plotting['redshift_line'] - wave0) / wave0
+                            self.session.mark_redshift(float(final_input))
                             self.logger.info("'m': redshift set to {0:.6f}".format(self.plotting['redshift']))
                         except:
                             self.logger.info("'m': Input error - use non-zero numbers")
-                        
-                        self.input_mode = False
-                        self.plotting['redshift_line'] = np.nan
-                        self.plotspec()
-                        self.refresh_file_table()
-                        self.refresh_value_table()
-                        self.input_buffer.clear()
-                        self.plotting['blocking'] = None
                     else:
                         self.input_buffer.append(event.key)
                         self.statusBar.showMessage("'m': input rest wavelength: " + ''.join(self.input_buffer))
@@ -671,80 +854,184 @@ class XtrimGUI(QWidget):
                     if event.key == 'enter':
                         # input finished, act on spectra
                         final_input = ''.join(self.input_buffer)
-                        
+
+                        self.input_mode = False
+                        self.input_buffer.clear()
+                        self.plotting['blocking'] = None
                         try:
                             nsmooth = int(float(final_input))
-                            if len(self.specs) > 0:
-                                for i, spec in enumerate(self.specs):
-                                    spec.smooth(max(nsmooth, 0))
+                            self.session.smooth(nsmooth)
                             self.logger.info("'s': spectra smoothed with {0:d} pixels".format(nsmooth))
                         except:
                             self.logger.info("'s': input error - use integer numbers")
-
-                        self.input_mode = False
-                        self.plotspec()
-                        self.refresh_file_table()
-                        self.input_buffer.clear()
-                        self.plotting['blocking'] = None
                     else:
                         self.input_buffer.append(event.key)
                         self.statusBar.showMessage("'s': input smoothing width: " + ''.join(self.input_buffer))
-                            
+
+    def on_session_changed(self, events):
+        # redraw what a session action changed
+        if events == {'spec_data'} and self.update_traces(self.session.changed_specs):
+            self.navigator.refresh()
+            return
+        if 'specs' in events:
+            self.specModel.reset()
+        elif 'spec_params' in events:
+            self.specModel.specs_changed(self.session.changed_specs)
+        if len(events & {'annotations', 'measurements'}) > 0:
+            self.refresh_value_table()
+        self.plotspec()
+        self.navigator.refresh()
+
+        return
+
+    def update_traces(self, specs):
+        # only the artists of spectra whose data were read again; False if
+        # the plot has to be drawn again instead
+        index = [next((i for i, ws in enumerate(self.specs) if ws is spec), None) for spec in specs]
+        if None in index:
+            return False
+        # the automatic continuum of the EW window is of the first spectrum
+        if 0 in index and self.plotting.get('ew_window', [None, None])[1] is not None:
+            return False
+
+        self.session.apply_masks()
+        for i in index:
+            ws = self.specs[i]
+            if not self.renderer.update(self.ax, i, self.session.displayed(ws) + (ws.color,)):
+                return False
+        self.canvas.draw_idle()
+
+        return True
+
+    def set_watch(self, checked):
+        # reload spectra whose files change on disk
+        from . import watcher
+
+        if checked and self.watcher is None:
+            self.watcher = watcher.spec_watcher(self.session, mode=self.watch_mode, parent=self)
+            self.logger.info("Watching the files of the spectra for changes ({0})".format(self.watch_mode))
+        elif not checked and self.watcher is not None:
+            self.watcher.close()
+            self.watcher.deleteLater()
+            self.watcher = None
+            self.logger.info("Stopped watching the files of the spectra")
+
+        return
+
+    def mcerrorsDialog(self, checked):
+        if checked:
+            nreal, ok = QInputDialog.getInt(self, "Monte Carlo Errors", "Number of realizations:", \
+                                            value=1000, min=10, max=1000000)
+            if not ok:
+                self.mcerrorsAction.setChecked(False)
+                return
+            self.session.set_mc_errors(nreal)
+            self.logger.info("Monte Carlo errors on with {0:d} realizations".format(nreal))
+        else:
+            self.session.set_mc_errors(0)
+            self.logger.info("Monte Carlo errors off")
+
+    def opentemplateDialog(self, loader=sloader.default):
+        options = QFileDialog.Options()
+        filenames, _ = QFileDialog.getOpenFileNames(self, "Load redshift templates", "",
+                                                "All Files (*);;FITS Files (*.fits *.fit *.FTS)", options=options)
+        if filenames:
+            self.session.load_templates(filenames, loader=loader)
+            self.logger.info(f"Loaded redshift templates: " + str(filenames))
+
+    def cleartemplates(self):
+        self.session.clear_templates()
+        self.logger.info("Redshift templates cleared, using the line list")
+
+    def chi2scanDialog(self):
+        # chi2(z) of the first spectrum against the loaded templates
+        if len(self.specs) == 0 or len(self.template_specs) == 0:
+            self.showErrorDialog("Chi-square redshift scan", "Load a spectrum and a redshift template first.")
+            return
+
+        text, ok = QInputDialog.getText(self, "Chi-square Redshift Scan", "Redshift range (zmin, zmax):", text="0, 1")
+        if not ok:
+            return
+        try:
+            zmin, zmax = [float(t) for t in text.replace(',', ' ').split()]
+        except ValueError:
+            self.showErrorDialog("Chi-square redshift scan", "Input two numbers: zmin, zmax.")
+            return
+        if not -1 < zmin < zmax:
+            self.showErrorDialog("Chi-square redshift scan", "The range needs -1 < zmin < zmax.")
+            return
+
+        try:
+            zgrid, results = self.session.chi2_scan(zmin, zmax)
+        except Exception as e:
+            self.showErrorDialog("Chi-square redshift scan", str(e))
+            return
+
+        self.chi2dialog = QDialog(self)
+        self.chi2dialog.setWindowTitle("Chi-square Redshift Scan")
+        self.chi2dialog.resize(600, 300)
+        layout = QVBoxLayout(self.chi2dialog)
+        figure = Figure()
+        canvas = FigureCanvas(figure)
+        layout.addWidget(canvas)
+        ax = figure.add_subplot(111)
+
+        curves = []
+        for tspec, (chi2, npix) in zip(self.template_specs, results):
+            curves.append(chi2)
+            ax.plot(zgrid, chi2, label=tspec.label)
+            ibest = np.nanargmin(chi2)
+            self.logger.info("Chi-square scan: {0} best z = {1:.6f}, chi2 = {2:.2f} over {3:.0f} pixels".format(
+                tspec.label, zgrid[ibest], chi2[ibest], npix[ibest]))
+        ax.set_xlabel('Redshift')
+        ax.set_ylabel(r'$\chi^2$')
+        ax.legend(fontsize='small')
+        figure.tight_layout()
+
+        def on_click(event):
+            # pick the deepest minimum near the click
+            if event.inaxes is not ax:
+                return
+            xl = ax.get_xlim()
+            near = np.abs(zgrid - event.xdata) < 0.02 * (xl[1] - xl[0])
+            if not np.any(near):
+                return
+            best = np.nanmin([np.where(near, chi2, np.inf) for chi2 in curves], axis=0)
+            self.session.set_redshift(zgrid[np.argmin(best)])
+            self.logger.info("Chi-square scan: redshift set to {0:.6f}".format(self.plotting['redshift']))
+        canvas.mpl_connect('button_press_event', on_click)
+
+        canvas.draw()
+        self.chi2dialog.show()
 
     def get_all_loadspec_methods(self):
         func_names = []
         funcs = []
         for name, obj in inspect.getmembers(sloader, inspect.isfunction):
+            if name.startswith('_'):
+                continue
             func_names.append(name)
             funcs.append(obj)
 
         return func_names, funcs
 
-
-    def loadspec(self, fns, loader=sloader.default):
-
-        if type(fns) == str:
-            fns = [fns]
-        
-        if type(fns) == list:
-            for i, fn in enumerate(fns):
-                #try:
-                self.specs.append(wavespec.wavespec_obj(fn, loader=loader))
-                #except:
-                #    self.showErrorDialog("Error loading spectrum", "")
-        return
-    
-    def loadlinelist(self, fn):
-        waves, labels, kwargs = read_line_list(fn)
-
-        self.linelist['waves'] = waves
-        self.linelist['labels'] = labels
-        self.linelist['kwargs'] = kwargs
-
-        return
-
     def plotspec(self, reset_lim=False):
 
+        if reset_lim and self.session.reset_view():
+            # redrawn by the notification
+            return
+
         self.ax.cla()
 
         if len(self.specs) > 0:
             # do not plot if no spec has been loaded
 
-            for i, wavespec in enumerate(self.specs):
-                self.ax.step(wavespec.wave * (wavespec.addredshift + 1), \
-                            (wavespec.spec_display * wavespec.mult) + wavespec.add, \
-                            where='mid', color=wavespec.color)
-                if wavespec.error is not None:
-                    self.ax.errorbar(wavespec.wave * (wavespec.addredshift + 1), \
-                                (wavespec.spec_display * wavespec.mult) + wavespec.add, \
-                                yerr=wavespec.error_display * wavespec.mult, \
-                                ls='none', color=wavespec.color, alpha=0.8)
+            self.session.apply_masks()
 
-            xl = self.ax.get_xlim()
-            yl = self.ax.get_ylim()
+            traces = [self.session.displayed(wavespec) + (wavespec.color,) for wavespec in self.specs]
+            self.renderer.draw(self.ax, traces)
 
-            if reset_lim:
-                self.plotting['box'][:] = xl[0], yl[0], xl[1], yl[1]            
+            xl = self.ax.get_xlim()
             
             #if self.plotting['initial_box'][0] is None:
             #    self.plotting['initial_box'][:] = xl[0], yl[0], xl[1], yl[1]
@@ -752,11 +1039,29 @@ class XtrimGUI(QWidget):
             # reference lines
             self.ax.axhline(0, 0, 1, color='k', ls=':')
 
+            # masked regions
+            zfac = 1 + self.plotting['redshift']
+            starts, ends = self.masks.obs.overlapping(xl[0], xl[1])
+            rstarts, rends = self.masks.rest.overlapping(xl[0] / zfac, xl[1] / zfac)
+            for start, end in zip(np.concatenate([starts, rstarts * zfac]), np.concatenate([ends, rends * zfac])):
+                self.ax.axvspan(start, end, color='grey', alpha=0.2, lw=0)
+
             # ew lines
             if self.plotting['ew_cont'][3] is not None:
                 self.ax.plot([self.plotting['ew_cont'][0], self.plotting['ew_cont'][2]], \
                         [self.plotting['ew_cont'][1], self.plotting['ew_cont'][3]], \
                         color='red')
+            # automatic continuum of the EW window
+            if self.plotting.get('ew_window', [None, None])[1] is not None:
+                wavespec = self.specs[0]
+                wave = wavespec.wave * (wavespec.addredshift + 1)
+                index = (wave >= self.plotting['ew_window'][0]) & (wave < self.plotting['ew_window'][1])
+                if self.plotting.get('normalize', False):
+                    cont = np.ones(np.sum(index))
+                else:
+                    cont = self.session.continuum_of(wavespec)[index]
+                self.ax.plot(wave[index], cont * wavespec.mult + wavespec.add, color='red', ls='--')
+
             # gauss
             if self.gauss_wave is not None:
                 self.ax.plot(self.gauss_wave, self.gauss_model, color='red')
@@ -814,7 +1119,9 @@ class XtrimGUI(QWidget):
         # refresh value table
         self.vtableWidget.blockSignals(True)
 
-        self.vtableWidget.setRowCount(4 + len(self.plotting['trim_lines']))  # Set number of rows
+        lines_fit = self.plotting.get('lines_fit')
+        nlines_fit = 0 if lines_fit is None else 1 + 2 * len(lines_fit['labels'])
+        self.vtableWidget.setRowCount(4 + len(self.plotting['trim_lines']) + nlines_fit)  # Set number of rows
         # Redshift
         item = QTableWidgetItem('Redshift')
         item.setFlags(item.flags() & ~Qt.ItemIsEditable)
@@ -866,6 +1173,19 @@ class XtrimGUI(QWidget):
                 item.setFlags(item.flags() | Qt.ItemIsEditable)
                 self.vtableWidget.setItem(4+i, 1, item)
 
+        # Multi-line fit
+        if lines_fit is not None:
+            rows = [('Zfit', lines_fit['redshift'])]
+            for label, flux, ew in zip(lines_fit['labels'], lines_fit['flux'], lines_fit['ew']):
+                rows.append(('Flux ' + label, flux))
+                rows.append(('EW ' + label, ew))
+            row0 = 4 + len(self.plotting['trim_lines'])
+            for i, (name, values) in enumerate(rows):
+                for column, text in enumerate([name, str(values[0]), str(values[1])]):
+                    item = QTableWidgetItem(text)
+                    item.setFlags(item.flags() & ~Qt.ItemIsEditable)
+                    self.vtableWidget.setItem(row0+i, column, item)
+
         self.vtableWidget.blockSignals(False)
         return
 
@@ -874,89 +1194,26 @@ class XtrimGUI(QWidget):
         # refresh color assigments of the spectra
 
         if cycle=='default':
-            colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+            # hex strings for QColor; matplotlib may give RGB tuples
+            colors = [to_hex(c) for c in matplotlib.rcParams['axes.prop_cycle'].by_key()['color']]
 
         # TODO: Add other color maps
-        
-        if len(self.specs) > 0:
-            for i, spec in enumerate(self.specs):
-                spec.color = colors[i % len(colors)]
-
-        return
-    
-    def refresh_file_table(self):
-        # Populate the table and set columns 1 and 2 as editable
-        #self.tableWidget.setHorizontalHeaderLabels(["Filename", "Redshift", "smooth", "x", "+", "Color"])
 
-        self.tableWidget.blockSignals(True)
-
-        if len(self.specs) > 0:
-            self.tableWidget.setRowCount(len(self.specs))  # Set number of rows
-
-            for i, spec in enumerate(self.specs):
-                items = [
-                    QTableWidgetItem(os.path.basename(spec.filename)),
-                    QTableWidgetItem(str(spec.addredshift)),
-                    QTableWidgetItem(str(spec.smooth_width)),
-                    QTableWidgetItem(str(spec.mult)),
-                    QTableWidgetItem(str(spec.add)),
-                    QTableWidgetItem('C{0:d}'.format(i))
-                ]
-
-                items[5].setBackground(QColor(spec.color))
-
-                for column in range(6):
-                    item = QTableWidgetItem(items[column])
-                    if column in [1, 2, 3, 4]:  # Make columns 1 and 2 editable
-                        item.setFlags(item.flags() | Qt.ItemIsEditable)
-                    else:
-                        item.setFlags(item.flags() & ~Qt.ItemIsEditable)
-                    self.tableWidget.setItem(i, column, item)
-                
-                # delete button
-                btn_delete = QPushButton('Delete')
-                btn_delete.clicked.connect(lambda _, row=i: self.deleteRow(row))
-                self.tableWidget.setCellWidget(i, 6, btn_delete)
-        elif len(self.specs)==0:
-            self.tableWidget.setRowCount(len(self.specs))
-
-        self.tableWidget.blockSignals(False)
+        self.session.colors = colors
+        self.session.assign_colors()
 
         return
-
+    
+    @journaled
     def deleteRow(self, row):
-        # Find the button's row
+        # row of the spectrum in self.specs
         if row >= 0 and row < len(self.specs):
-            fn = self.tableWidget.item(row, 0).text()
-            self.specs.pop(row)
-            self.update_color()
+            fn = os.path.basename(self.specs[row].filename)
+            self.session.remove(row)
         
             self.logger.info(f"Removed spectra ({row}): {fn}")
-            self.plotspec()
-            self.refresh_file_table()
         
-    def TableItemChanged(self, item):
-        # This method is called whenever an item is changed in the table
-        row = item.row()
-        column = item.column()
-        column_name = self.tableWidget.horizontalHeaderItem(column).text()
-        text = item.text()
-
-        if column_name == '+Redshift':
-            self.specs[row].addredshift = float(text)
-        elif column_name == 'Smooth':
-            self.specs[row].smooth(int(float(text)))
-        elif column_name == 'x':
-            self.specs[row].mult = float(text)
-        elif column_name == '+':
-            self.specs[row].add = float(text)
-
-        self.logger.info(f"Modified spec table cell ({row+1}, {column_name}): {text}")
-        self.plotspec()
-        self.refresh_file_table()
-
-        return
-    
+    @journaled
     def ValueTableItemChanged(self, item):
         # When value table item is changed
         row = item.row()
@@ -965,17 +1222,16 @@ class XtrimGUI(QWidget):
         text = item.text()
 
         if self.vtableWidget.item(row, 0).text() == 'Redshift' and column_name == 'Value':
-            self.plotting['redshift'] = float(text)
-        elif row >= 4 and column_name == 'Value':
-            self.plotting['trim_lines'][row - 4] = float(text)
+            self.session.set_redshift(float(text))
+        elif 4 <= row < 4 + len(self.plotting['trim_lines']) and column_name == 'Value':
+            self.session.set_trim_line(row - 4, float(text))
 
         self.logger.info(f"Modified value table cell ({self.vtableWidget.item(row, 0).text()}, {column_name}): {text}")
-        self.plotspec()
-        self.refresh_value_table()
 
         return
 
     
+    @journaled
     def openFileNameDialog(self, loader=sloader.default):
 
         options = QFileDialog.Options()
@@ -984,35 +1240,77 @@ class XtrimGUI(QWidget):
         filenames, _ = QFileDialog.getOpenFileNames(self, "Load one or more files", "",
                                                 "All Files (*);;FITS Files (*.fits *.fit *.FTS);;tbl files (*.tbl)", options=options)
         if filenames:
-            self.loadspec(filenames, loader=loader)
-            #path_to_linelist = pkg_resources.resource_filename(__name__, 'lib/line_list.dat')
-            #self.loadlinelist(path_to_linelist)
-            self.update_color()
-            self.plotspec(reset_lim=True)
-            self.refresh_file_table()
+            self.session.load(filenames, loader=loader)
             self.logger.info(f"Loaded files: " + str(filenames))
 
+    def openspec2dDialog(self):
+        # the panel is imported when first used, to keep the start fast
+        from .WaveSpec import spec2d
+        from .spec2dview import spec2d_view
+
+        options = QFileDialog.Options()
+        fn, _ = QFileDialog.getOpenFileName(self, "Open 2D spectrum", "",
+                                            "All Files (*);;FITS Files (*.fits *.fit *.FTS)", options=options)
+        if fn:
+            try:
+                s2d = spec2d.open_spec2d(fn)
+            except Exception as e:
+                self.showErrorDialog("Error opening 2D spectrum", str(e))
+                return
+            view = spec2d_view(self.session, s2d, parent=self)
+            view.setAttribute(Qt.WA_DeleteOnClose)
+            view.show()
+            self.logger.info(f"Opened 2D spectrum: " + str(fn))
+
+    def opencubeDialog(self):
+        # the panel is imported when first used, to keep the start fast
+        from .WaveSpec import cube
+        from .cubeview import cube_view
+
+        options = QFileDialog.Options()
+        fn, _ = QFileDialog.getOpenFileName(self, "Open data cube", "",
+                                            "All Files (*);;FITS Files (*.fits *.fit *.FTS)", options=options)
+        if fn:
+            try:
+                c = cube.open_cube(fn)
+            except Exception as e:
+                self.showErrorDialog("Error opening data cube", str(e))
+                return
+            view = cube_view(self.session, c, parent=self)
+            view.setAttribute(Qt.WA_DeleteOnClose)
+            view.show()
+            self.logger.info(f"Opened data cube: " + str(fn))
+
+    @journaled
     def loadworkspaceDialog(self):
         options = QFileDialog.Options()
         wksfn, _ = QFileDialog.getOpenFileName(self, "Open workspace file", "",
                                                 "All Files (*);;Workspace Files (*.wks)", options=options)
         if wksfn:
-            version, self.specs, self.plotting, self.gauss_wave, self.gauss_model, self.linelist = \
-                pickle.load(open(wksfn, 'rb'))
-            
-            self.plotspec()
-            self.refresh_file_table()
-            self.refresh_value_table()
+            try:
+                # keys missing from older workspaces keep their defaults
+                missing = self.session.load_workspace(wksfn)
+            except Exception as e:
+                self.showErrorDialog("Error loading workspace", str(e))
+                return
+
             self.logger.info(f"Loaded workspace file: " + str(wksfn))
+            if len(missing) > 0:
+                self.showErrorDialog("Missing spectra", "Could not find the following files:\n" + \
+                                     "\n".join(missing))
 
     def saveworkspaceDialog(self):
         options = QFileDialog.Options()
-        fileName, _ = QFileDialog.getSaveFileName(self, "Save Workspace", "xtrim_workspace.wks",
-                                                  "All Files (*);;Workspace File (*.wks)", options=options)
+        filters = {
+            "Workspace File (*.wks)": None,
+            "Workspace File, Embedded Compressed Data (*.wks)": 'compressed',
+            "Workspace File, Embedded Memory-mappable Data (*.wks)": 'mmap'
+        }
+        fileName, selected = QFileDialog.getSaveFileName(self, "Save Workspace", "xtrim_workspace.wks",
+                                                  ";;".join(filters), options=options)
         if fileName:
             try:
-                pickle.dump((self.__version__, self.specs, self.plotting, self.gauss_wave, self.gauss_model, self.linelist), \
-                            open(fileName, 'wb'))
+                self.session.save_workspace(fileName, embed=filters.get(selected), version=self.__version__)
                 self.logger.info(f"Saved workspace file: " + str(fileName))
             except PermissionError:
                 self.showErrorDialog("Permission denied", "You do not have permission to save to this location.")
@@ -1028,7 +1326,11 @@ class XtrimGUI(QWidget):
         fileName, _ = QFileDialog.getSaveFileName(self, "Save Figure", "xtrim.png",
                                                   "PNG (*.png);;JPEG (*.jpg);;PDF (*.pdf)", options=options)
         if fileName:
+            # publication output with matplotlib artists
+            renderer = self.renderer
             try:
+                self.renderer = render.mpl_renderer()
+                self.plotspec()
                 self.figure.savefig(fileName)
                 self.logger.info(f"Saved figure file: " + str(fileName))
             except PermissionError:
@@ -1039,6 +1341,112 @@ class XtrimGUI(QWidget):
             except Exception as e:
                 # Handle other unforeseen errors
                 self.showErrorDialog("Error", f"An unexpected error occurred: {str(e)}")
+            finally:
+                self.renderer = renderer
+                self.plotspec()
+
+    def exportsheetsDialog(self):
+        # one panel per spectrum, drawn in a process pool
+        from PyQt5.QtWidgets import QProgressDialog
+        from . import qasheet
+
+        if len(self.specs) == 0:
+            self.showErrorDialog("No spectra", "There are no spectra to export.")
+            return
+        options = QFileDialog.Options()
+        fileName, _ = QFileDialog.getSaveFileName(self, "Export QA Sheets", "xtrim_qa.pdf",
+                                                  "PDF (*.pdf);;PNG, one file per page (*.png)", options=options)
+        if fileName:
+            self.session.apply_masks()
+            items = qasheet.session_items(self.session)
+            dialog = QProgressDialog("Drawing QA sheets...", "Cancel", 0, len(items), self)
+            dialog.setWindowModality(Qt.WindowModal)
+            dialog.setMinimumDuration(500)
+
+            def progress(n, ntotal, message):
+                if message:
+                    self.logger.warning("QA sheet panel {0}: {1}".format(items[n - 1]['label'], message))
+                dialog.setValue(n)
+                QApplication.processEvents()
+                return not dialog.wasCanceled()
+
+            try:
+                npages, nfail = qasheet.write_sheets(items, fileName, self.linelist, progress=progress)
+                self.logger.info(f"Exported {npages} pages of QA sheets: " + str(fileName))
+            except PermissionError:
+                self.showErrorDialog("Permission denied", "You do not have permission to save to this location.")
+            except OSError as e:
+                # Handle other issues like disk space errors
+                self.showErrorDialog("Error saving file", str(e))
+            except Exception as e:
+                # Handle other unforeseen errors
+                self.showErrorDialog("Error", f"An unexpected error occurred: {str(e)}")
+            finally:
+                dialog.close()
+
+    def start_journal(self):
+        # offer to recover a session that was not closed properly, then
+        # journal this one
+        sessions = journal.orphaned_sessions()
+        if len(sessions) > 0:
+            reply = QMessageBox.question(self, "Recover Session", \
+                                         "XTRIM was not closed properly. Recover the last session?", \
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if reply == QMessageBox.Yes:
+                self.recover_session(sessions[0])
+            for path in sessions:
+                shutil.rmtree(path, ignore_errors=True)
+
+        try:
+            self.session.start_journal()
+        except OSError as e:
+            self.logger.warning("Session journal disabled: " + str(e))
+
+        return
+
+    def recover_session(self, directory):
+        # replay the journal without drawing, then draw once
+        try:
+            recovered = self.session.recover(directory)
+        except Exception as e:
+            self.showErrorDialog("Error recovering session", str(e))
+            return
+        if recovered is None:
+            return
+
+        nreplay, missing = recovered
+        self.logger.info("Recovered session from {0} ({1} journal entries)".format(directory, nreplay))
+        if len(missing) > 0:
+            self.showErrorDialog("Missing spectra", "Could not find the following files:\n" + "\n".join(missing))
+
+        return
+
+    def undo(self):
+        self.restore_history(self.session.undo(), 'Undo')
+
+    def redo(self):
+        self.restore_history(self.session.redo(), 'Redo')
+
+    def restore_history(self, action, name):
+        if action is None:
+            self.logger.info("{0}: nothing to {1}".format(name, name.lower()))
+            return
+
+        self.input_mode = False
+        self.input_buffer = []
+        self.logger.info("{0}: {1}".format(name, action))
+
+        return
+
+    def closeEvent(self, event):
+        if self.watcher is not None:
+            self.watcher.close()
+        self.session.close()
+        if self.server is not None:
+            self.server.close()
+        logging.getLogger(__package__).removeHandler(self.handler)
+        self.handler.close()
+        super().closeEvent(event)
 
     def showErrorDialog(self, title, message):
         error_dialog = QMessageBox()
@@ -1047,13 +1455,25 @@ class XtrimGUI(QWidget):
         error_dialog.setText(message)
         error_dialog.exec_()
 
+    def openmaskDialog(self):
+        options = QFileDialog.Options()
+        maskfn, _ = QFileDialog.getOpenFileName(self, "Open mask list file", "",
+                                                "All Files (*);;Mask list File (*.dat)", options=options)
+        if maskfn:
+            self.session.load_masks(maskfn)
+            self.logger.info(f"Loaded mask list file: " + str(maskfn))
+
+    def clearmasks(self):
+        self.session.clear_masks()
+        self.logger.info("Masks cleared")
+
+    @journaled
     def openlinelistDialog(self):
         options = QFileDialog.Options()
         llfn, _ = QFileDialog.getOpenFileName(self, "Open line list file", "",
                                                 "All Files (*);;Line list File (*.dat)", options=options)
         if llfn:
-            self.loadlinelist(llfn)
-            self.plotspec()
+            self.session.load_linelist(llfn)
             self.logger.info(f"Loaded line list file: " + str(llfn))
 
     def showHelpDialog(self):
@@ -1067,8 +1487,7 @@ class XtrimGUI(QWidget):
             layout = QVBoxLayout(self.helpdialog)
 
             self.iconLabel = QLabel(self)
-            path_to_icon = pkg_resources.resource_filename(__name__, 'lib/xtrim_icon.png')
-            pixmap = QPixmap(path_to_icon)  # Replace with your icon path
+            pixmap = QPixmap(ICON)  # Replace with your icon path
             pixmap = pixmap.scaled(64, 64, Qt.KeepAspectRatio)
             self.iconLabel.setPixmap(pixmap)
             self.iconLabel.setAlignment(Qt.AlignCenter)  # Center the icon
@@ -1099,22 +1518,29 @@ class XtrimGUI(QWidget):
                         <li>'a': draw a zoom box</li>
                         <li>'b': set the y-baseline at flux=0</li>
                         <li>'c': reset the plotting range</li>
-                        <li>'z': set y-axis plotting range to 1-99% percentiles</li>
+                        <li>'z': set y-axis plotting range to 1-99% percentiles in the visible wavelength range</li>
                         <li>'d': delete the nearest trim line</li>
                         <li>'e': calculate an equivalent width</li>
+                        <li>Shift+'e': calculate an equivalent width on the automatic continuum</li>
                         <li>'i': zoom in on x-axis</li>
                         <li>Shift+'i': zoom in on y-axis</li>
                         <li>'k': fit a Gaussian function</li>
+                        <li>'l': detect lines as trim lines and propose redshifts</li>
+                        <li>Shift+'k': fit all line list features in a region</li>
                         <li>'m': mark a rest wavelength and calculate redshift</li>
+                        <li>'n': toggle continuum normalization</li>
                         <li>'o': zoom out on x-axis</li>
                         <li>Shift+'o': zoom out on y-axis</li>
                         <li>'r': reposition the nearest trim line</li>
                         <li>'s': smooth all spectra</li>
                         <li>'t': add a trim line</li>
+                        <li>'x': cross-correlate for the redshift; again for the next candidate, 'enter' to accept</li>
                         <li>'+': pan right</li>
                         <li>'-': pan left</li>
                         <li>'''': pan up</li>
                         <li>'/': pan down</li>
+                        <li>Ctrl+'z': undo</li>
+                        <li>Ctrl+'y' or Ctrl+Shift+'z': redo</li>
                     </ul>
                 </body>
                 </html>
@@ -1128,10 +1554,10 @@ class XtrimGUI(QWidget):
 
         return
 
-def main():
+def main(argv=None):
 
     arg_parser = parser_init()
-    args = arg_parser.parse_args()
+    args = arg_parser.parse_args(argv)
 
     app = QApplication(sys.argv)
     ex = XtrimGUI(**vars(args))